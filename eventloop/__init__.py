@@ -1,96 +1,314 @@
 import os
 import sys
 
-from .common import debug_print, walk
+from .common import debug_print, DEBUG, walk
+from . import stats
 from . import base
-from . import uv
-from . import qt
-from . import qta
-from .common import flavour, FLAVOUR_NONE, FLAVOUR_PYUV, FLAVOUR_PYSIDE2, FLAVOUR_PYQT5, FLAVOUR_PYQT6, FLAVOUR_PYSIDE6, USE_QASYNC
+from .common import get_flavour, use_qasync, FLAVOUR_NONE, FLAVOUR_PYUV, FLAVOUR_PYSIDE2, FLAVOUR_PYQT5, FLAVOUR_PYQT6, FLAVOUR_PYSIDE6, FLAVOUR_INOTIFY
+from .common import ContentFilter, FileEvent, KIND_RENAME, KIND_CHANGE
+from .common import OVERFLOW_RESCAN, OVERFLOW_DROP_OLDEST, DEBOUNCE_TRAILING, DEBOUNCE_LEADING
+from .common import RESTART_KILL, RESTART_TERM, RESTART_HANDOVER
+from .base import AsyncExecutor, PoolExecutor, AsyncFuncExecutor
+import time
+import functools
+import importlib
 
 """
 set DEBUG_EVENTLOOP=1
 set DEBUG_EVENTLOOP=0
 """
 
+# backend modules (and Qt bindings or pyuv) are imported on first use,
+# so are asyncio, servers and watch budget (name: module), stats is cheap and bound once for hot paths
+_LAZY = {
+    'awatch': 'aio',
+    'WatchBudget': 'budget',
+    'default_budget': 'budget',
+    'OutputPump': 'pump',
+    'PortProbe': 'restart',
+    'OutputProbe': 'restart',
+    'inherited_socket': 'restart',
+}
+
+def __getattr__(name):
+    if name in ['flavour', 'USE_QASYNC']:
+        from . import common
+        return getattr(common, name)
+    if name in ['uv', 'qt', 'qta', 'inotify']:
+        return importlib.import_module('.' + name, __name__)
+    if name in _LAZY:
+        return getattr(importlib.import_module('.' + _LAZY[name], __name__), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 def EventLoop(app = None):
-    if USE_QASYNC:
+    flavour = get_flavour()
+    if use_qasync():
+        from . import qta
         return qta.EventLoop(app)
     if flavour == FLAVOUR_PYUV:
+        from . import uv
         return uv.EventLoop()
+    if flavour == FLAVOUR_INOTIFY:
+        from . import inotify
+        return inotify.EventLoop()
+    from . import qt
     return qt.EventLoop(app)
 
-def Server(app = None, parent = None):
+def Server(app = None, parent = None, pump = None, label = None, strategy = RESTART_KILL, grace = 5, probe = None, probe_timeout = 30, listen = None, preload = None, on_exit = None):
+    """
+    pump is OutputPump shared by servers (process inherits stdio without it, OutputProbe gets new one), label is prefix of lines (basename of executable by default).
+    strategy is one of RESTART_KILL, RESTART_TERM (SIGTERM, SIGKILL after grace seconds), RESTART_HANDOVER (start new, wait for probe, stop old),
+    probe is PortProbe or OutputProbe, listen is port of listening socket passed to processes by fd (see eventloop.restart).
+    With preload (list of modules) python commands run in warm spare interpreters with modules imported (see eventloop.zygote).
+    on_exit(code) is called on loop thread when server process exits on its own (crashes), recent_output() has its last output
+    when output goes through pump (it is not captured when process inherits stdio).
+    """
+
+    kwargs = dict(pump=pump, label=label, strategy=strategy, grace=grace, probe=probe, probe_timeout=probe_timeout, listen=listen, preload=preload, on_exit=on_exit)
 
     def psutil_server(app, parent):
         from . import ps
-        return ps.Server()
+        return ps.Server(**kwargs)
 
-    if flavour == FLAVOUR_PYUV:
+    if get_flavour() in [FLAVOUR_PYUV, FLAVOUR_INOTIFY]:
         return psutil_server(app, parent)
 
-    return qt.Server(parent)
+    from . import qt
+    return qt.Server(parent, **kwargs)
 
-def FileSystemWatch(loop):
+def FileSystemWatch(loop, poll=False, threaded=False):
+    """
+    threaded=True runs Qt watcher on separate QThread (ignored for non-Qt flavours)
+    """
+    if poll:
+        from . import poll
+        return poll.FileSystemWatch(loop)
+    flavour = get_flavour()
     if flavour == FLAVOUR_PYUV:
+        from . import uv
         return uv.FileSystemWatch(loop)
-    else:
-        return qt.FileSystemWatch(loop)
+    elif flavour == FLAVOUR_INOTIFY:
+        from . import inotify
+        return inotify.FileSystemWatch(loop)
+    from . import qt
+    if threaded:
+        return qt.ThreadedFileSystemWatch(loop)
+    return qt.FileSystemWatch(loop)
 
 def SingleShotTimer():
+    flavour = get_flavour()
     if flavour == FLAVOUR_PYUV:
+        from . import uv
         return uv.SingleShotTimer()
-    else:
-        return qt.SingleShotTimer()
+    elif flavour == FLAVOUR_INOTIFY:
+        from . import inotify
+        return inotify.SingleShotTimer()
+    from . import qt
+    return qt.SingleShotTimer()
 
 def Timer():
+    flavour = get_flavour()
     if flavour == FLAVOUR_PYUV:
+        from . import uv
         return uv.Timer()
-    else:
-        return qt.Timer()
+    elif flavour == FLAVOUR_INOTIFY:
+        from . import inotify
+        return inotify.Timer()
+    from . import qt
+    return qt.Timer()
+
+_BATCH = object()
 
 class Schedule:
+    """
+    Deduplicates tasks appended within timeout and passes them to executor in order of arrival.
+    Events of each task are coalesced into one FileEvent (event can be EVENT_* constant or FileEvent),
+    BatchExecutor gets all of them in one call as {task: FileEvent}.
+    When max_pending is set and exceeded, pending tasks are either merged into single rescan_task
+    (OVERFLOW_RESCAN) or oldest tasks are dropped (OVERFLOW_DROP_OLDEST).
+    DEBOUNCE_TRAILING executes tasks when no new tasks were appended within timeout,
+    DEBOUNCE_LEADING also executes first task of quiet period immediately.
+    max_wait limits how long tasks can be postponed by steady stream of appends.
+    With AsyncExecutor tasks run without blocking loop, task that is still running is
+    kept pending until it's done.
+    Failed tasks are retried after retry_timeout doubled on each failure up to max_retry_timeout.
+    """
 
-    def __init__(self, executor):
+    def __init__(self, executor, max_pending=None, overflow=OVERFLOW_RESCAN, rescan_task=None, debounce=DEBOUNCE_TRAILING, max_wait=None,
+            retry_timeout=1, max_retry_timeout=60):
         self._executor = executor
-        self._tasks = []
+        self._tasks = dict()
         self._timeout = 10
+        self._retry_timeout = retry_timeout
+        self._max_retry_timeout = max_retry_timeout
+        # number of consecutive failures per task
+        self._attempts = dict()
+        self._running = set()
         self._timer = None
+        self._debounce = debounce
+        self._max_wait = max_wait
+        # start of current debounce window
+        self._window = None
+        self._max_pending = max_pending
+        self._overflow = overflow
+        self._rescan_task = rescan_task
+        self._rescan = False
+        # number of appended tasks merged into already pending ones
+        self.coalesced = 0
+        # number of tasks dropped by OVERFLOW_DROP_OLDEST
+        self.dropped = 0
     
-    def append(self, task, timeout):
+    def append(self, task, timeout, event=None):
         if isinstance(task, list):
             tasks = task
         else:
             tasks = [task]
+        pending = self._tasks
+        max_pending = self._max_pending
+        stats_ = stats.current
         for task in tasks:
-            if task not in self._tasks:
-                self._tasks.append(task)
+            if self._rescan:
+                task = self._rescan_task
+            record = pending.get(task)
+            if record is not None:
+                self.coalesced += 1
+                if stats_ is not None:
+                    stats_.incr('schedule_coalesced')
+            else:
+                if max_pending is not None and len(pending) >= max_pending:
+                    if self._overflow == OVERFLOW_DROP_OLDEST:
+                        del pending[next(iter(pending))]
+                        self.dropped += 1
+                    else:
+                        debug_print("Schedule overflow, coalescing {} tasks".format(len(pending) + 1))
+                        self.coalesced += len(pending)
+                        record = FileEvent(self._rescan_task)
+                        for record_ in pending.values():
+                            record.add(record_)
+                        pending.clear()
+                        task = self._rescan_task
+                        self._rescan = True
+                if record is None:
+                    record = FileEvent(task)
+                pending[task] = record
+            if event is not None:
+                record.add(event)
+        if stats_ is not None:
+            stats_.observe('schedule_pending', len(pending))
+        self._timeout = timeout
+        if self._debounce == DEBOUNCE_LEADING and self._window is None:
+            self._window = time.monotonic()
+            self._execute()
         self._schedule(timeout)
 
+    def pending(self):
+        return list(self._tasks)
+
     def on_timeout(self):
         debug_print("Schedule.on_timeout")
+        self._window = None
+        self._execute()
+
+    def _execute(self):
         executor = self._executor
-        tasks = []
-        for task in self._tasks:
-            debug_print("executing copy task", task)
-            res = executor.execute(task)
+        tasks = self._tasks
+        if len(tasks) == 0:
+            return
+        if isinstance(executor, AsyncExecutor):
+            self._submit(executor, tasks)
+            return
+        self._tasks = dict()
+        self._rescan = False
+        failed = dict()
+        stats_ = stats.current
+        if stats_ is not None:
+            t = time.perf_counter()
+        if isinstance(executor, base.BatchExecutor):
+            debug_print("executing batch of {} tasks".format(len(tasks)))
+            res = executor.execute_batch(tasks)
             if res == False:
-                debug_print("failed to execute task", task)
-                tasks.append(task)
-        self._tasks = tasks
-        if len(tasks) > 0:
-            debug_print("rescheduling failed tasks")
+                debug_print("failed to execute batch")
+                failed = tasks
+        else:
+            for task, events in tasks.items():
+                if DEBUG:
+                    debug_print("executing copy task", task)
+                res = executor.execute(task)
+                if res == False:
+                    debug_print("failed to execute task", task)
+                    failed[task] = events
+        if stats_ is not None:
+            stats_.observe('execute_seconds', time.perf_counter() - t)
+        self._done(tasks, failed)
+
+    def _submit(self, executor, tasks):
+        running = self._running
+        if executor.batch:
+            if len(running) > 0:
+                return
+            self._tasks = dict()
+            self._rescan = False
+            running.add(_BATCH)
+            debug_print("submitting batch of {} tasks".format(len(tasks)))
+            started = time.perf_counter()
+            executor.submit(tasks, lambda res: self._on_done(_BATCH, tasks, started, res))
+            return
+        self._tasks = dict((task, events) for task, events in tasks.items() if task in running)
+        self._rescan = False
+        for task, events in tasks.items():
+            if task in running:
+                continue
+            running.add(task)
+            if DEBUG:
+                debug_print("submitting task", task)
+            executor.submit(task, functools.partial(self._on_done, task, {task: events}, time.perf_counter()))
+
+    def _on_done(self, key, tasks, started, res):
+        self._running.discard(key)
+        stats_ = stats.current
+        if stats_ is not None:
+            stats_.observe('execute_seconds', time.perf_counter() - started)
+        if res == False:
+            debug_print("failed to execute", key)
+            self._done(tasks, tasks)
+        else:
+            self._done(tasks, dict())
+        if len(self._tasks) > 0 and self._window is None:
+            # tasks that waited for running ones
             self._schedule(self._timeout)
 
+    def _done(self, tasks, failed):
+        attempts = self._attempts
+        for task in tasks:
+            if task not in failed:
+                attempts.pop(task, None)
+        if len(failed) == 0:
+            return
+        delay = 0
+        for task in failed:
+            attempts[task] = attempts.get(task, 0) + 1
+            delay = max(delay, min(self._retry_timeout * 2 ** (attempts[task] - 1), self._max_retry_timeout))
+        failed = dict(failed)
+        failed.update(self._tasks)
+        self._tasks = failed
+        debug_print("rescheduling failed tasks in {}s".format(delay))
+        self._schedule(delay)
+
     def _schedule(self, timeout):
+        now = time.monotonic()
+        if self._window is None:
+            self._window = now
+        if self._max_wait is not None:
+            timeout = max(0, min(timeout, self._window + self._max_wait - now))
         timer = self._timer
         if timer:
-            timer.stop()
-        timer = SingleShotTimer()
-        timer.start(timeout, self.on_timeout)
-        self._timer = timer
+            timer.restart(timeout)
+        else:
+            timer = SingleShotTimer()
+            timer.start(timeout, self.on_timeout)
+            self._timer = timer
 
-def on_file_changed(path, include=None, exclude=None, timeout=1, loop=None, recursive=True, terminate_after=None):
+def on_file_changed(path, include=None, exclude=None, timeout=1, loop=None, recursive=True, terminate_after=None, max_pending=None, overflow=OVERFLOW_RESCAN, rescan_task=None, batch=False, debounce=DEBOUNCE_TRAILING, max_wait=None, workers=None, processes=False, content_filter=False, index=False, index_save_timeout=5, poll=False, threaded=False):
 
     def decorator(func):
 
@@ -98,15 +316,78 @@ def on_file_changed(path, include=None, exclude=None, timeout=1, loop=None, recu
         if loop is None:
             loop_ = EventLoop()
 
+        content_filter_ = content_filter
+        if content_filter_ == True:
+            content_filter_ = ContentFilter()
+        if content_filter_:
+            # files are hashed before watch starts, so touching unchanged file is not reported
+            _, files = walk(path, include, exclude, recursive=recursive)
+            content_filter_.add(files)
+
+        index_ = None
+        index_timer = None
+        # save is scheduled (not postponed by later changes, so steady stream of changes doesn't starve it)
+        index_pending = False
+
+        def save_index():
+            nonlocal index_pending
+            index_pending = False
+            index_.save()
+
+        if index and os.path.isdir(path):
+            from .index import SnapshotIndex
+            index_ = SnapshotIndex(path, include, exclude, path=None if index == True else index)
+            index_timer = SingleShotTimer()
+            index_timer.start(index_save_timeout, save_index)
+            index_pending = True
+
         def on_change(file_path, event):
-            debug_print("on_change", file_path)
-            schedule.append(file_path, timeout)
+            nonlocal index_pending
+            if DEBUG:
+                debug_print("on_change", file_path)
+            if index_ is not None:
+                index_.update(file_path)
+                if not index_pending:
+                    index_timer.restart(index_save_timeout)
+                    index_pending = True
+            if content_filter_ and not content_filter_.changed(file_path):
+                debug_print("content not changed", file_path)
+                return
+            schedule.append(file_path, timeout, event)
 
-        executor = base.FuncExecutor(func)
+        import inspect
+        if isinstance(func, base.Executor):
+            executor = func
+        elif inspect.iscoroutinefunction(func):
+            executor = AsyncFuncExecutor(func, batch=batch, max_concurrent=workers)
+        else:
+            if batch:
+                executor = base.FuncBatchExecutor(func)
+            else:
+                executor = base.FuncExecutor(func)
+            if workers is not None:
+                executor = PoolExecutor(executor, max_workers=workers, processes=processes)
         
-        watch = FileSystemWatch(loop_)
-        schedule = Schedule(executor)
-        watch.start(path, on_change, recursive=recursive, include=include, exclude=exclude)
+        # on overflow handler gets watched root instead of changed files
+        rescan_task_ = path if rescan_task is None else rescan_task
+        schedule = Schedule(executor, max_pending=max_pending, overflow=overflow, rescan_task=rescan_task_, debounce=debounce, max_wait=max_wait)
+        watch = FileSystemWatch(loop_, poll=poll, threaded=threaded)
+        try:
+            watch.start(path, on_change, recursive=recursive, include=include, exclude=exclude)
+        except Exception as e:
+            if poll:
+                raise
+            print("eventloop: failed to watch {} ({}), falling back to polling".format(path, e), file=sys.stderr)
+            watch.stop()
+            watch = FileSystemWatch(loop_, poll=True)
+            watch.start(path, on_change, recursive=recursive, include=include, exclude=exclude)
+
+        if index_ is not None:
+            changes = index_.scan()
+            index_.save()
+            debug_print("{} offline changes".format(len(changes)))
+            for file_path, event in changes:
+                on_change(file_path, event)
 
         terminate_timer = None
         if terminate_after is not None:
@@ -120,8 +401,17 @@ def on_file_changed(path, include=None, exclude=None, timeout=1, loop=None, recu
         loop_._handles.append(schedule)
         loop_._handles.append(executor)
         loop_._handles.append(terminate_timer)
+        loop_._handles.append(index_timer)
 
         return func
     
     return decorator
-    
+
+def on_files_changed(path, **kwargs):
+    """
+    Same as on_file_changed but decorated function is called once per timeout
+    with {path: FileEvent} of all changed files.
+    """
+    return on_file_changed(path, batch=True, **kwargs)
+
+from .manager import WatchManager
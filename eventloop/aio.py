@@ -0,0 +1,172 @@
+"""
+asyncio interface: async for batch in awatch(path) works on plain asyncio loop and on qasync loop.
+On Linux inotify fd is read with loop.add_reader, elsewhere (or with poll=True) tree is polled in a thread.
+"""
+
+from .common import debug_print, FileEvent
+from . import base
+import asyncio
+import collections
+import sys
+import threading
+
+class BatchQueue:
+    """
+    Bounded queue of {path: FileEvent} batches, when full new batch is merged into the last one
+    so slow consumer gets fewer bigger batches instead of unbounded memory growth.
+    """
+
+    def __init__(self, maxsize = 16):
+        self._batches = collections.deque()
+        self._maxsize = maxsize
+        self._event = asyncio.Event()
+        # number of batches merged into queued ones
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._batches)
+
+    def put(self, batch):
+        batches = self._batches
+        if len(batches) >= self._maxsize:
+            last = batches[-1]
+            for path, record in batch.items():
+                if path in last:
+                    last[path].add(record)
+                else:
+                    last[path] = record
+            self.coalesced += 1
+        else:
+            batches.append(batch)
+        self._event.set()
+
+    async def get(self):
+        while len(self._batches) == 0:
+            self._event.clear()
+            await self._event.wait()
+        return self._batches.popleft()
+
+class _AsyncioTimer(base.Timer):
+    """
+    SingleShotTimer on asyncio loop, start() can be called from any thread (watch starts in executor),
+    callback is called on loop thread.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._handle = None
+        self._stopped = False
+
+    def start(self, timeout, callback, once = True):
+        super().start(timeout, callback, True)
+        self._loop.call_soon_threadsafe(self.restart, timeout)
+
+    def restart(self, timeout):
+        if self._stopped:
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._loop.call_later(timeout, self.on_timeout)
+
+    def on_timeout(self):
+        self._handle = None
+        self._callback()
+
+    def stop(self):
+        self._stopped = True
+        handle = self._handle
+        self._handle = None
+        if handle is not None:
+            handle.cancel()
+
+class _AsyncioLoop:
+    """
+    Loop interface for inotify.FileSystemWatch on top of asyncio loop, add_reader is thread safe.
+    Provides timers for polling fallback (paths over watch budget).
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def addWatcher(self, watcher):
+        pass
+
+    def SingleShotTimer(self):
+        return _AsyncioTimer(self._loop)
+
+    def add_reader(self, fd, callback):
+        self._loop.call_soon_threadsafe(self._loop.add_reader, fd, callback)
+
+    def remove_reader(self, fd):
+        self._loop.remove_reader(fd)
+
+class _PollThread(threading.Thread):
+
+    def __init__(self, watch):
+        super().__init__(daemon=True)
+        self._watch = watch
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            interval = self._watch.tick()
+            self._stopped.wait(interval)
+
+    def stop(self):
+        self._stopped.set()
+
+async def awatch(path, include = None, exclude = None, debounce = 0.5, recursive = True, maxsize = 16, poll = False):
+    """
+    Yields {path: FileEvent} for changes debounced within debounce seconds.
+    At most maxsize batches are kept while consumer is busy, further changes are merged into the last one.
+    """
+    loop = asyncio.get_running_loop()
+    queue = BatchQueue(maxsize)
+    pending = dict()
+    handle = None
+
+    def flush():
+        nonlocal handle
+        handle = None
+        if len(pending) > 0:
+            queue.put(dict(pending))
+            pending.clear()
+
+    def on_change(file_path, event):
+        nonlocal handle
+        debug_print("awatch on_change", file_path)
+        record = pending.get(file_path)
+        if record is None:
+            record = FileEvent(file_path)
+            pending[file_path] = record
+        record.add(event)
+        if handle is not None:
+            handle.cancel()
+        handle = loop.call_later(debounce, flush)
+
+    watch = None
+    thread = None
+    if sys.platform.startswith('linux') and not poll:
+        from . import inotify
+        watch = inotify.FileSystemWatch(_AsyncioLoop(loop))
+        # initial walk doesn't block loop
+        await loop.run_in_executor(None, watch.start, path, on_change, include, exclude, recursive)
+    else:
+        from . import poll as poll_
+        def on_change_threadsafe(file_path, event):
+            loop.call_soon_threadsafe(on_change, file_path, event)
+        watch_ = poll_.FileSystemWatch(None)
+        await loop.run_in_executor(None, watch_.start, path, on_change_threadsafe, include, exclude, recursive, False)
+        thread = _PollThread(watch_)
+        thread.start()
+
+    try:
+        while True:
+            yield await queue.get()
+    finally:
+        if handle is not None:
+            handle.cancel()
+        if watch is not None:
+            watch.stop()
+        if thread is not None:
+            thread.stop()
@@ -1,5 +1,8 @@
 
-from .common import debug_print
+from . import stats
+from .common import debug_print, PathMatcher, FileEvent, use_qasync, get_flavour
+import sys
+import traceback
 
 class EventLoop:
 
@@ -12,6 +15,25 @@ class EventLoop:
     def stop(self):
         pass
 
+    @property
+    def stats(self):
+        """
+        Stats object or None if stats are not enabled.
+        """
+        return stats.current
+
+    def enable_stats(self, signal = False, interval = None, file = None):
+        """
+        With signal=True stats are dumped as json to file (stderr by default) on SIGUSR1,
+        with interval they are dumped every interval seconds.
+        """
+        stats_ = stats.enable()
+        if signal:
+            stats.install_signal(file=file)
+        if interval is not None:
+            self._handles.append(stats.StatsLogger(interval, file))
+        return stats_
+
 class Executor:
     def execute(self, task):
         return True
@@ -24,6 +46,141 @@ class FuncExecutor(Executor):
         debug_print("FuncExecutor.execute")
         return self._func(task)
 
+class BatchExecutor(Executor):
+    def execute(self, task):
+        return self.execute_batch({task: FileEvent(task)})
+    def execute_batch(self, tasks):
+        return True
+
+class FuncBatchExecutor(BatchExecutor):
+    def __init__(self, func):
+        super().__init__()
+        self._func = func
+    def execute_batch(self, tasks):
+        debug_print("FuncBatchExecutor.execute_batch")
+        return self._func(tasks)
+
+def report_failure(task, e):
+    """
+    Prints exception of handler (with traceback) to stderr. Raised exceptions are not retried
+    (like exceptions of blocking executors, which propagate), handler returns False to be retried.
+    """
+    if isinstance(task, dict):
+        task = "batch of {} tasks".format(len(task))
+    print("eventloop: handler failed for {!r}".format(task), file=sys.stderr)
+    traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+
+class AsyncExecutor(Executor):
+    """
+    Executor that doesn't block loop: submit(task, callback) starts task and
+    callback(result) is called on loop thread when it's done.
+    If batch is True task is {task: FileEvent} dict.
+    """
+    batch = False
+
+    def submit(self, task, callback):
+        callback(True)
+
+class PoolExecutor(AsyncExecutor):
+    """
+    Runs executor.execute (or execute_batch for BatchExecutor) in thread or process pool
+    with at most max_workers tasks at once, completion is polled by timer on loop thread.
+    For processes=True executor must be picklable (function must be reachable by its module and name), ValueError is raised otherwise.
+    Exception raised by task is reported (see report_failure) and task is not retried.
+    """
+
+    def __init__(self, executor, max_workers=None, processes=False, poll_interval=0.05):
+        super().__init__()
+        self._executor = executor
+        self.batch = isinstance(executor, BatchExecutor)
+        import concurrent.futures
+        if processes:
+            import pickle
+            try:
+                pickle.dumps(executor)
+            except Exception as e:
+                raise ValueError("processes=True needs picklable handler (module level function, pass it to on_file_changed(...)(handler) after it's defined): {}".format(e)) from e
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers)
+        else:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._futures = dict()
+        self._poll_interval = poll_interval
+        self._timer = None
+
+    def submit(self, task, callback):
+        if self.batch:
+            future = self._pool.submit(self._executor.execute_batch, task)
+        else:
+            future = self._pool.submit(self._executor.execute, task)
+        self._futures[future] = (task, callback)
+        if self._timer is None:
+            from . import Timer
+            self._timer = Timer()
+            self._timer.start(self._poll_interval, self._poll)
+
+    def _poll(self):
+        done = [future for future in self._futures if future.done()]
+        for future in done:
+            task, callback = self._futures.pop(future)
+            try:
+                res = future.result()
+            except Exception as e:
+                report_failure(task, e)
+                res = None
+            callback(res)
+        if len(self._futures) == 0 and self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+def _asyncio_loop():
+    # other flavours run their own loop and nothing runs asyncio one
+    import asyncio
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    if use_qasync():
+        return asyncio.get_event_loop()
+    raise RuntimeError("coroutine handlers need qta flavour (qasync) or running asyncio loop, {} flavour doesn't run asyncio loop".format(get_flavour()))
+
+class AsyncFuncExecutor(AsyncExecutor):
+    """
+    Runs coroutine function as asyncio task on qasync loop (qta flavour) or asyncio loop running when executor is created,
+    at most max_concurrent at once. Raises RuntimeError if there's no such loop.
+    """
+
+    def __init__(self, func, batch=False, max_concurrent=None):
+        super().__init__()
+        self._loop = _asyncio_loop()
+        self._func = func
+        self.batch = batch
+        self._semaphore = None
+        self._max_concurrent = max_concurrent
+
+    async def _run(self, task):
+        if self._max_concurrent is None:
+            return await self._func(task)
+        if self._semaphore is None:
+            import asyncio
+            self._semaphore = asyncio.Semaphore(self._max_concurrent)
+        async with self._semaphore:
+            return await self._func(task)
+
+    def submit(self, task, callback):
+        def on_done(future):
+            if future.cancelled():
+                callback(False)
+            elif future.exception() is not None:
+                report_failure(task, future.exception())
+                callback(None)
+            else:
+                callback(future.result())
+        future = self._loop.create_task(self._run(task))
+        future.add_done_callback(on_done)
+
 class Logger:
     def print_info(self, msg):
         print(msg)
@@ -32,6 +189,11 @@ class Logger:
 
 class FileSystemWatch:
 
+    # number of threads used to list directories on start, None for serial walk
+    walk_workers = None
+    # budget.WatchBudget shared by native watches, None for budget.default_budget()
+    budget = None
+
     def start(self, path, callback, include = None, exclude = None, recursive = False):
         self._callback = callback
         self._path = path
@@ -42,6 +204,7 @@ class FileSystemWatch:
         self._include = include
         self._exclude = exclude
         self._recursive = recursive
+        self._matcher = PathMatcher(include, exclude)
     
     def stop(self):
         pass
@@ -51,5 +214,9 @@ class Timer:
         self._callback = callback
         self._once = once
 
+    def restart(self, interval):
+        self.stop()
+        self.start(interval, self._callback, self._once)
+
     def stop(self):
         pass
\ No newline at end of file
@@ -0,0 +1,312 @@
+"""
+python -m eventloop.bench matcher
+python -m eventloop.bench watch --sizes 1000 10000 100000 --output bench.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from .common import path_matches, PathMatcher
+
+def synthetic_paths(count, root = '/src/project'):
+    exts = ['.c', '.h', '.cpp', '.py', '.o', '.txt', '.js', '.json']
+    dirs = ['src', 'lib', 'build', 'node_modules', '.git', 'tests', 'docs']
+    paths = []
+    for i in range(count):
+        d = os.path.join(root, dirs[i % len(dirs)], 'sub{}'.format(i % 97))
+        paths.append(os.path.join(d, 'file{}{}'.format(i, exts[i % len(exts)])))
+    return paths
+
+def synthetic_patterns(count):
+    include = ['*.c', '*.h', '*.cpp', '*.py', '*.js']
+    exclude = ['.git', 'node_modules', 'build', '*.o', 'moc_*', '*/docs/*']
+    i = 0
+    while len(include) + len(exclude) < count:
+        exclude.append('gen{}_*'.format(i))
+        exclude.append('vendor{}'.format(i))
+        i += 1
+    return include, exclude
+
+def bench_matcher(files = 100000, patterns = 30):
+    paths = synthetic_paths(files)
+    include, exclude = synthetic_patterns(patterns)
+
+    t1 = time.perf_counter()
+    expected = [path_matches(path, include, exclude) for path in paths]
+    t2 = time.perf_counter()
+    matcher = PathMatcher(include, exclude)
+    actual = [matcher.matches(path) for path in paths]
+    t3 = time.perf_counter()
+
+    if expected != actual:
+        raise ValueError('PathMatcher results differ from path_matches')
+
+    return {
+        'files': files,
+        'patterns': len(include) + len(exclude),
+        'path_matches': t2 - t1,
+        'PathMatcher': t3 - t2,
+        'speedup': (t2 - t1) / (t3 - t2),
+    }
+
+# flavour name: (env, module that must be importable)
+FLAVOURS = {
+    'pyuv': ({'USE_PYUV': '1'}, 'pyuv'),
+    'pyside6': ({'QT_API': 'pyside6'}, 'PySide6'),
+    'pyqt6': ({'QT_API': 'pyqt6'}, 'PyQt6'),
+    'pyside2': ({'QT_API': 'pyside2'}, 'PySide2'),
+    'pyqt5': ({'QT_API': 'pyqt5'}, 'PyQt5'),
+    'inotify': ({'USE_INOTIFY': '1'}, None),
+}
+
+def available_flavours():
+    res = []
+    for name, (env, module) in FLAVOURS.items():
+        if name == 'inotify':
+            if sys.platform.startswith('linux'):
+                res.append(name)
+        elif importlib.util.find_spec(module) is not None:
+            res.append(name)
+    return res
+
+def flavour_env(name):
+    env = {k: v for k, v in os.environ.items() if k not in ['USE_PYUV', 'USE_INOTIFY', 'USE_QASYNC', 'QT_API', 'DEBUG_EVENTLOOP']}
+    env.update(FLAVOURS[name][0])
+    return env
+
+def synthetic_tree(root, count, per_dir = 100):
+    """
+    Creates count empty files in root/dN/sM directories, returns number of created files and directories.
+    """
+    dirs = set()
+    for i in range(count):
+        d = os.path.join(root, 'd{}'.format(i // (per_dir * 10)), 's{}'.format((i // per_dir) % 10))
+        if d not in dirs:
+            os.makedirs(d, exist_ok=True)
+            dirs.add(d)
+            dirs.add(os.path.dirname(d))
+        with open(os.path.join(d, 'f{}.txt'.format(i)), 'w'):
+            pass
+    return count + len(dirs)
+
+def rss():
+    """
+    Resident memory in bytes or None if it cannot be measured.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def _write(path, data = 'data'):
+    with open(path, 'w') as f:
+        f.write(data)
+
+def bench_start(root, entries, poll = False):
+    """
+    Time-to-ready of FileSystemWatch.start and resident memory per watched path.
+    """
+    from . import EventLoop, FileSystemWatch
+    loop = EventLoop()
+    rss1 = rss()
+    t1 = time.perf_counter()
+    watch = FileSystemWatch(loop, poll=poll)
+    watch.start(root, lambda path, event: None, recursive=True)
+    t2 = time.perf_counter()
+    rss2 = rss()
+    watch.stop()
+    loop.stop()
+    res = {'entries': entries, 'seconds': t2 - t1}
+    if rss1 is not None and rss2 is not None:
+        res['rss_per_path'] = (rss2 - rss1) / entries
+    return res
+
+def bench_latency(count = 20, interval = 0.1, poll = False):
+    """
+    Seconds from write of new file to watch callback for this file.
+    """
+    from . import EventLoop, FileSystemWatch, Timer, SingleShotTimer
+    root = tempfile.mkdtemp()
+    loop = EventLoop()
+    written = dict()
+    latencies = []
+
+    def on_change(path, event):
+        t = written.pop(path, None)
+        if t is not None:
+            latencies.append(time.perf_counter() - t)
+            if len(latencies) == count:
+                loop.stop()
+
+    watch = FileSystemWatch(loop, poll=poll)
+    watch.start(root, on_change, recursive=True)
+
+    def on_timeout():
+        if len(written) + len(latencies) >= count:
+            timer.stop()
+            return
+        path = os.path.join(root, 'file{}.txt'.format(len(written) + len(latencies)))
+        written[path] = time.perf_counter()
+        _write(path)
+
+    timer = Timer()
+    timer.start(interval, on_timeout)
+    deadline = SingleShotTimer()
+    deadline.start(count * interval + 10, loop.stop)
+    loop.start()
+    timer.stop()
+    deadline.stop()
+    watch.stop()
+    shutil.rmtree(root, ignore_errors=True)
+
+    res = {'count': count, 'missed': count - len(latencies)}
+    if len(latencies) > 0:
+        latencies.sort()
+        res.update({
+            'min': latencies[0],
+            'median': latencies[len(latencies) // 2],
+            'max': latencies[-1],
+        })
+    return res
+
+def bench_throughput(count = 1000, quiet = 1, poll = False):
+    """
+    Writes count files at once and counts callbacks until watch is quiet for quiet seconds.
+    """
+    from . import EventLoop, FileSystemWatch, SingleShotTimer
+    root = tempfile.mkdtemp()
+    loop = EventLoop()
+    events = 0
+    paths = set()
+    t1 = None
+    t2 = None
+
+    def on_change(path, event):
+        nonlocal events, t2
+        events += 1
+        paths.add(path)
+        t2 = time.perf_counter()
+        idle.restart(quiet)
+
+    watch = FileSystemWatch(loop, poll=poll)
+    watch.start(root, on_change, recursive=True)
+
+    def on_start():
+        nonlocal t1
+        t1 = time.perf_counter()
+        for i in range(count):
+            _write(os.path.join(root, 'file{}.txt'.format(i)))
+        idle.start(quiet + 2, loop.stop)
+
+    idle = SingleShotTimer()
+    start = SingleShotTimer()
+    start.start(0.1, on_start)
+    deadline = SingleShotTimer()
+    deadline.start(60, loop.stop)
+    loop.start()
+    idle.stop()
+    deadline.stop()
+    watch.stop()
+    shutil.rmtree(root, ignore_errors=True)
+
+    res = {'files': count, 'events': events, 'paths': len(paths)}
+    if t2 is not None and t2 > t1:
+        res['seconds'] = t2 - t1
+        res['events_per_second'] = events / (t2 - t1)
+    return res
+
+def _run_child(name, child, args):
+    cmd = [sys.executable, '-m', 'eventloop.bench', 'watch', '--child', child] + args
+    proc = subprocess.run(cmd, env=flavour_env(name), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return {'error': '\n'.join(proc.stderr.strip().splitlines()[-1:])}
+    return json.loads(proc.stdout)
+
+def run_flavours(names, sizes, latency_count, throughput_count, poll):
+    """
+    Runs watch benchmarks for each flavour in subprocesses (flavour is detected once per process),
+    start benchmark gets fresh process for each tree so memory of previous watch doesn't skew rss.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        trees = []
+        for files in sizes:
+            root = os.path.join(tmp, str(files))
+            trees.append((files, synthetic_tree(root, files), root))
+        extra = ['--poll'] if poll else []
+        res = dict()
+        for name in names:
+            print("running", name, file=sys.stderr)
+            res[name] = {
+                'start': [dict(_run_child(name, 'start', ['--tree', root, '--entries', str(entries)] + extra), files=files) for files, entries, root in trees],
+                'latency': _run_child(name, 'latency', ['--latency-count', str(latency_count)] + extra),
+                'throughput': _run_child(name, 'throughput', ['--throughput-count', str(throughput_count)] + extra),
+            }
+        return res
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m eventloop.bench")
+    parser.add_argument('names', nargs='*', choices=['matcher', 'watch', 'all'], default='all')
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--patterns', type=int, default=30)
+    parser.add_argument('--flavours', nargs='+', choices=list(FLAVOURS), help="flavours to benchmark (default: all available)")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], help="synthetic tree sizes for start benchmark")
+    parser.add_argument('--latency-count', type=int, default=20, help="number of files written one by one for latency benchmark")
+    parser.add_argument('--throughput-count', type=int, default=1000, help="number of files written at once for throughput benchmark")
+    parser.add_argument('--poll', action='store_true', help="benchmark polling watch on top of each flavour")
+    parser.add_argument('--output', help="write json report to file")
+    parser.add_argument('--child', choices=['start', 'latency', 'throughput'], help=argparse.SUPPRESS)
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    parser.add_argument('--entries', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    names = args.names
+    if 'all' in names:
+        names = ['matcher', 'watch']
+
+    if args.child is not None:
+        # one benchmark of current flavour, see run_flavours()
+        if args.child == 'start':
+            res = bench_start(args.tree, args.entries, args.poll)
+        elif args.child == 'latency':
+            res = bench_latency(args.latency_count, poll=args.poll)
+        else:
+            res = bench_throughput(args.throughput_count, poll=args.poll)
+        print(json.dumps(res))
+        return
+
+    report = {
+        'python': sys.version,
+        'platform': sys.platform,
+    }
+    if 'matcher' in names:
+        res = bench_matcher(args.files, args.patterns)
+        print("path_matches {:.3f}s PathMatcher {:.3f}s speedup {:.1f}x ({} files, {} patterns)".format(
+            res['path_matches'], res['PathMatcher'], res['speedup'], res['files'], res['patterns']), file=sys.stderr)
+        report['matcher'] = res
+    if 'watch' in names:
+        flavours = args.flavours if args.flavours else available_flavours()
+        report['watch'] = run_flavours(flavours, args.sizes, args.latency_count, args.throughput_count, args.poll)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Budget of native watches: inotify watches on Linux (fs.inotify.max_user_watches), file descriptors elsewhere.
+Backends take watches from it and poll what doesn't fit.
+"""
+
+from .common import debug_print
+import os
+import sys
+
+def inotify_limit():
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return soft
+
+def system_limit():
+    """
+    Number of native watches process can have or None if it's not limited (Windows).
+    """
+    if sys.platform.startswith('linux'):
+        return inotify_limit()
+    if sys.platform == 'win32':
+        return None
+    return fd_limit()
+
+def system_in_use():
+    """
+    Native watches already used by process: inotify watches on Linux, open fds elsewhere.
+    """
+    if sys.platform.startswith('linux'):
+        count = 0
+        try:
+            names = os.listdir('/proc/self/fdinfo')
+        except OSError:
+            return 0
+        for name in names:
+            try:
+                with open(os.path.join('/proc/self/fdinfo', name)) as f:
+                    count += sum(1 for line in f if line.startswith('inotify wd:'))
+            except OSError:
+                pass
+        return count
+    try:
+        return len(os.listdir('/dev/fd'))
+    except OSError:
+        return 0
+
+class WatchBudget:
+    """
+    Counts native watches in use, left is limit minus reserve (left for other processes and files) minus in_use.
+    limit None means unlimited.
+    in_use counts watches of this process only while inotify limit is per-user, when kernel refuses watch (ENOSPC)
+    backend calls exhaust() and polls the rest.
+    """
+
+    def __init__(self, limit = None, reserve = None, in_use = None):
+        if limit is None:
+            limit = system_limit()
+        if reserve is None:
+            reserve = 0 if limit is None else limit // 10
+        if in_use is None:
+            in_use = system_in_use()
+        self.limit = limit
+        self.reserve = reserve
+        self.in_use = in_use
+        # number of roots that did not fit and are polled
+        self.polled = 0
+
+    @property
+    def left(self):
+        if self.limit is None:
+            return None
+        return max(0, self.limit - self.reserve - self.in_use)
+
+    def take(self, count):
+        """
+        Takes at most count watches, returns number of taken ones.
+        """
+        left = self.left
+        if left is not None:
+            count = min(count, left)
+        self.in_use += count
+        return count
+
+    def release(self, count):
+        self.in_use = max(0, self.in_use - count)
+
+    def exhaust(self):
+        """
+        Limit is lowered to watches in use (other processes of user took the rest), released ones can be taken again.
+        """
+        debug_print("WatchBudget exhausted", self.in_use)
+        self.limit = self.reserve + self.in_use
+
+    def report(self):
+        return {
+            'limit': self.limit,
+            'reserve': self.reserve,
+            'in_use': self.in_use,
+            'left': self.left,
+            'polled': self.polled,
+        }
+
+_default = None
+
+def default_budget():
+    global _default
+    if _default is None:
+        _default = WatchBudget()
+        debug_print("WatchBudget", _default.report())
+    return _default
+
+def poll_roots(dirs, files):
+    """
+    Splits paths that didn't fit into top-most directories (polled with subtrees) and files outside of them.
+    dirs must contain all directories of their subtrees (as walk returns them).
+    """
+    dirs_ = set(dirs)
+    roots = [path for path in dirs if os.path.dirname(path) not in dirs_]
+    files = [path for path in files if os.path.dirname(path) not in dirs_]
+    return roots, files
+
+class Fallback:
+    """
+    Polling watch for paths that don't fit into budget, created on first add().
+    """
+
+    def __init__(self, loop, watch):
+        self._loop = loop
+        self._watch = watch
+        self._poll = None
+
+    def add(self, paths):
+        """
+        Polls paths that didn't fit: directories (breadth first, with their subtrees) and files.
+        """
+        roots, files = poll_roots([p for p in paths if os.path.isdir(p)], [p for p in paths if not os.path.isdir(p)])
+        if len(roots) + len(files) == 0:
+            return
+        watch = self._watch
+        if self._poll is None:
+            print("eventloop: watch limit reached, polling {} directories and {} files (see fs.inotify.max_user_watches or ulimit -n)".format(len(roots), len(files)), file=sys.stderr)
+            from . import poll
+            self._poll = poll.FileSystemWatch(self._loop)
+            self._poll.start(roots + files, watch._callback, watch._include, watch._exclude, watch._recursive)
+        else:
+            for path in roots + files:
+                self._poll.add(path)
+        watch._budget.polled += len(roots) + len(files)
+
+    def stop(self):
+        poll_ = self._poll
+        self._poll = None
+        if poll_ is not None:
+            poll_.stop()
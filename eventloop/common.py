@@ -1,9 +1,18 @@
 import os
 import glob
+import collections
+import importlib.util
+import stat
 import re
 import sys
+import time
 
-if os.environ.get('DEBUG_EVENTLOOP') == "1":
+from . import stats
+
+# check DEBUG before building debug_print arguments in hot paths
+DEBUG = os.environ.get('DEBUG_EVENTLOOP') == "1"
+
+if DEBUG:
     debug_print = lambda *args, **kwargs: print(*args, **kwargs, file=sys.stderr)
 else:
     debug_print = lambda *args, **kwargs: None
@@ -56,7 +65,89 @@ def path_matches(path, include, exclude):
                 return False
     return True
 
-def walk(path, include, exclude, all_dirs = False, recursive=True):
+_SEP_RE = re.compile('[\\\\/]')
+
+class PathMatcher:
+    """
+    Precompiled equivalent of path_matches(path, include, exclude).
+    Globs are compiled into one regex that is matched against both basename and full path,
+    plain names (no magic, no slashes) go to a set and are matched against path components.
+    """
+
+    def __init__(self, include = None, exclude = None):
+        self.include = include
+        self.exclude = exclude
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            return None
+        globs = []
+        names = set()
+        for pat in patterns:
+            if not glob.has_magic(pat) and '/' not in pat and '\\' not in pat:
+                names.add(pat.lower() if sys.platform == 'win32' else pat)
+            globs.append(glob.fnmatch.translate(os.path.normcase(pat)))
+        return re.compile('|'.join(globs)).match, names
+
+    @staticmethod
+    def _test(compiled, path):
+        match, names = compiled
+        path_ = os.path.normcase(path)
+        if match(os.path.basename(path_)) or match(path_):
+            return True
+        if names:
+            if sys.platform == 'win32':
+                path = path.lower()
+            return not names.isdisjoint(_SEP_RE.split(path))
+        return False
+
+    def included(self, path):
+        if self._include is None:
+            return True
+        return self._test(self._include, path)
+
+    def excluded(self, path):
+        if self._exclude is None:
+            return False
+        return self._test(self._exclude, path)
+
+    def matches(self, path):
+        return self.included(path) and not self.excluded(path)
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as it:
+            return [(entry.path, entry.is_dir()) for entry in it]
+    except PermissionError as e:
+        debug_print(e)
+    except FileNotFoundError as e:
+        debug_print(e)
+    except NotADirectoryError as e:
+        debug_print(e)
+    return []
+
+def scandir_snapshot(path, mtime = True):
+    """
+    Returns {name: (is_dir, mtime_ns, inode)} for directory entries or None if path is not a readable directory.
+    With mtime=False mtime_ns is None and entries are not stat()ed (inode comes from directory listing on posix).
+    """
+    snapshot = dict()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    snapshot[entry.name] = (entry.is_dir(), entry.stat().st_mtime_ns if mtime else None, entry.inode())
+                except FileNotFoundError:
+                    pass
+    except (PermissionError, FileNotFoundError, NotADirectoryError) as e:
+        debug_print(e)
+        return None
+    return snapshot
+
+def walk(path, include, exclude, all_dirs = False, recursive=True, matcher=None, workers=None):
     """
     Examples:
         return only cpp files that don't start with moc_:
@@ -66,14 +157,24 @@ def walk(path, include, exclude, all_dirs = False, recursive=True):
         return all files and directories:
             include = [] exclude = []
     Initial path is not checked and always returned.
+    Excluded directories are not descended into.
+    Pass precompiled PathMatcher as matcher to skip compiling include and exclude.
+    Pass workers > 1 to list directories concurrently in a thread pool, result order is the same as in serial mode.
     """
 
+    stats_ = stats.current
+    if stats_ is not None:
+        t = time.perf_counter()
+
+    if matcher is None:
+        matcher = PathMatcher(include, exclude)
+
     if glob.has_magic(path):
         paths = glob.glob(path)
     else:
         paths = [path]
 
-    queue = []
+    queue = collections.deque()
     dirs = []
     files = []
 
@@ -84,35 +185,184 @@ def walk(path, include, exclude, all_dirs = False, recursive=True):
             dirs.append(path)
             queue.append(path)
 
-    while len(queue) > 0:
-        path = queue.pop(0)
-        try:
-            for n in os.listdir(path):
-                path_ = os.path.join(path, n)
-                is_dir = os.path.isdir(path_)
-                if path_matches(path_, include, exclude):
-                    if is_dir:
-                        dirs.append(path_)
-                        queue.append(path_)
-                    else:
-                        files.append(path_)
-                elif all_dirs and is_dir:
+    def visit(entries):
+        for path_, is_dir in entries:
+            if is_dir:
+                if matcher.excluded(path_):
+                    continue
+                if all_dirs or matcher.included(path_):
                     dirs.append(path_)
-                if is_dir and recursive:
+                if recursive:
                     queue.append(path_)
-        except PermissionError as e:
-            debug_print(e)
-        except FileNotFoundError as e:
-            debug_print(e)
-        except NotADirectoryError as e:
-            debug_print(e)
+            elif matcher.matches(path_):
+                files.append(path_)
+
+    if workers is not None and workers > 1:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            while len(queue) > 0:
+                level = list(queue)
+                queue.clear()
+                # map yields in submission order, so output is deterministic
+                for entries in pool.map(_scandir, level):
+                    visit(entries)
+    else:
+        while len(queue) > 0:
+            visit(_scandir(queue.popleft()))
+
+    if stats_ is not None:
+        stats_.observe('walk_seconds', time.perf_counter() - t)
+
     return dirs, files
 
+class ContentFilter:
+    """
+    Tells whether file content changed since last call for same path.
+    Keeps (size, mtime_ns) and content digest per file and hashes content only when they differ,
+    unknown and missing files are always reported as changed, add() remembers files in advance (first touch is not reported then).
+    At most max_entries files are remembered, least recently used are evicted.
+    """
+
+    def __init__(self, max_entries = 100000, chunk_size = 1024 * 1024):
+        self._cache = collections.OrderedDict()
+        self._max_entries = max_entries
+        self._chunk_size = chunk_size
+        # number of events reported as unchanged
+        self.suppressed = 0
+
+    def _digest(self, path):
+        import hashlib
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self._chunk_size)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.digest()
+
+    def add(self, paths):
+        """
+        Hashes files (of initial walk) until max_entries files are remembered.
+        """
+        cache = self._cache
+        for path in paths:
+            if len(cache) >= self._max_entries:
+                break
+            try:
+                st = os.stat(path)
+                cache[path] = ((st.st_size, st.st_mtime_ns), self._digest(path))
+            except OSError as e:
+                debug_print(e)
+
+    def changed(self, path):
+        cache = self._cache
+        try:
+            st = os.stat(path)
+            if stat.S_ISDIR(st.st_mode):
+                return True
+            key = (st.st_size, st.st_mtime_ns)
+            entry = cache.get(path)
+            if entry is not None:
+                cache.move_to_end(path)
+                if entry[0] == key:
+                    self.suppressed += 1
+                    return False
+                # size differs: changed, but digest is kept for next event of same size
+                digest = self._digest(path)
+                if entry[0][0] == key[0] and digest == entry[1]:
+                    cache[path] = (key, digest)
+                    self.suppressed += 1
+                    return False
+                cache[path] = (key, digest)
+                return True
+            digest = self._digest(path)
+        except OSError as e:
+            debug_print(e)
+            cache.pop(path, None)
+            return True
+        cache[path] = (key, digest)
+        if len(cache) > self._max_entries:
+            cache.popitem(last=False)
+        return True
+
+def new_session_kwargs():
+    """
+    subprocess.Popen kwargs to start child in new session (process group) so whole group can be killed.
+    """
+    if sys.platform == 'win32':
+        import subprocess
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
 (
     EVENT_RENAME,
     EVENT_CHANGE
 ) = range(2)
 
+# FileEvent.kinds bits
+KIND_RENAME = 1 << EVENT_RENAME
+KIND_CHANGE = 1 << EVENT_CHANGE
+
+class FileEvent:
+    """
+    Coalesced changes of one path: kinds is bitmask of KIND_RENAME and KIND_CHANGE,
+    timestamp is time of latest change, old_path is previous path of renamed file when backend reports it.
+    Iterating yields EVENT_* constants and `EVENT_CHANGE in event` works, so it can be used as set of events.
+    """
+
+    __slots__ = ('path', 'kinds', 'timestamp', 'is_dir', 'old_path')
+
+    def __init__(self, path, kinds = 0, timestamp = None, is_dir = False, old_path = None):
+        self.path = path
+        self.kinds = kinds
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.is_dir = is_dir
+        self.old_path = old_path
+
+    def add(self, event):
+        """
+        Merges EVENT_* constant or other FileEvent into this one.
+        """
+        if isinstance(event, FileEvent):
+            self.kinds |= event.kinds
+            self.timestamp = max(self.timestamp, event.timestamp)
+            self.is_dir = self.is_dir or event.is_dir
+            if event.old_path is not None:
+                self.old_path = event.old_path
+        else:
+            self.kinds |= 1 << event
+            self.timestamp = time.time()
+
+    def __contains__(self, event):
+        return self.kinds & (1 << event) != 0
+
+    def __iter__(self):
+        for event in (EVENT_RENAME, EVENT_CHANGE):
+            if self.kinds & (1 << event):
+                yield event
+
+    def __len__(self):
+        return bin(self.kinds).count('1')
+
+    def __repr__(self):
+        return "FileEvent({!r}, {}, old_path={!r})".format(self.path, sorted(self), self.old_path)
+
+(
+    OVERFLOW_RESCAN,
+    OVERFLOW_DROP_OLDEST
+) = range(2)
+
+(
+    DEBOUNCE_TRAILING,
+    DEBOUNCE_LEADING
+) = range(2)
+
+# Server restart strategies, see eventloop.restart
+RESTART_KILL = 'kill'
+RESTART_TERM = 'term'
+RESTART_HANDOVER = 'handover'
+
 (
     FLAVOUR_NONE,
     FLAVOUR_PYUV,
@@ -120,9 +370,10 @@ def walk(path, include, exclude, all_dirs = False, recursive=True):
     FLAVOUR_PYQT6,
     FLAVOUR_PYSIDE2,
     FLAVOUR_PYQT5,
-) = range(6)
+    FLAVOUR_INOTIFY,
+) = range(7)
 
-flavour = FLAVOUR_NONE
+_flavour = None
 
 """
 test = {n: os.environ.get(n) for n in ['USE_PYUV', 'USE_PYSIDE2', 'USE_PYQT5']}
@@ -132,42 +383,46 @@ if len(ones) > 1:
     print("warning: {} env variables are set to 1, you should only set one of them".format(" and ".join(keys)))
 """
 
-if os.environ.get('USE_PYUV') is not None:
-    import pyuv
-    flavour = FLAVOUR_PYUV
-else:
+def _installed(name):
+    return importlib.util.find_spec(name) is not None
+
+def _detect_flavour():
+    if os.environ.get('USE_INOTIFY') is not None:
+        return FLAVOUR_INOTIFY
+    if os.environ.get('USE_PYUV') is not None:
+        return FLAVOUR_PYUV
     QT_API = os.environ.get('QT_API')
     if QT_API is not None:
-        flavour = {
+        return {
             'pyqt5':FLAVOUR_PYQT5,
             'pyside2':FLAVOUR_PYSIDE2,
             'pyqt6':FLAVOUR_PYQT6,
             'pyside6':FLAVOUR_PYSIDE6,
         }[QT_API]
-    else:
-        try:
-            import pyuv
-            flavour = FLAVOUR_PYUV
-        except ImportError:
-            try:
-                from PySide6 import QtCore
-                flavour = FLAVOUR_PYSIDE6
-            except ImportError:
-                try:
-                    from PyQt6 import QtCore
-                    flavour = FLAVOUR_PYQT6
-                except ImportError:
-                    try:
-                        from PySide2 import QtCore
-                        flavour = FLAVOUR_PYSIDE2
-                    except ImportError:
-                        try:
-                            from PyQt5 import QtCore
-                            flavour = FLAVOUR_PYQT5
-                        except ImportError:
-                            raise ValueError('Eventloop needs one of packages: pyuv, pyqt5, pyside2, pyqt6, pyside6')
-
-USE_QASYNC = False
-if os.environ.get('USE_QASYNC') is not None:
-    import qasync
-    USE_QASYNC = True
\ No newline at end of file
+    # find_spec doesn't import package, binding is imported by backend module
+    for name, flavour in [('pyuv', FLAVOUR_PYUV), ('PySide6', FLAVOUR_PYSIDE6), ('PyQt6', FLAVOUR_PYQT6), ('PySide2', FLAVOUR_PYSIDE2), ('PyQt5', FLAVOUR_PYQT5)]:
+        if _installed(name):
+            return flavour
+    if sys.platform.startswith('linux'):
+        return FLAVOUR_INOTIFY
+    raise ValueError('Eventloop needs one of packages: pyuv, pyqt5, pyside2, pyqt6, pyside6')
+
+def get_flavour():
+    """
+    Detects flavour on first call (env variables USE_INOTIFY, USE_PYUV, QT_API, then installed packages), result is cached.
+    """
+    global _flavour
+    if _flavour is None:
+        _flavour = _detect_flavour()
+    return _flavour
+
+def use_qasync():
+    return os.environ.get('USE_QASYNC') is not None
+
+def __getattr__(name):
+    # flavour and USE_QASYNC used to be computed on import
+    if name == 'flavour':
+        return get_flavour()
+    if name == 'USE_QASYNC':
+        return use_qasync()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
\ No newline at end of file
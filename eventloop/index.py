@@ -0,0 +1,227 @@
+"""
+Persistent snapshot of watched tree: (size, mtime_ns, inode) of files and mtimes of directories.
+Used to detect changes made while watcher was not running.
+"""
+
+from .common import debug_print, PathMatcher, EVENT_RENAME, EVENT_CHANGE
+import collections
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import sys
+
+MAGIC = b'ELIDX001'
+
+# magic, digest of include and exclude patterns
+_HEADER = struct.Struct('<8s16s')
+# is_dir, size, mtime_ns, inode, length of relative path
+_RECORD = struct.Struct('<BqqQH')
+
+# mtime of directory which listing is not known to be up to date
+STALE = -1
+
+def cache_dir():
+    """
+    $XDG_CACHE_HOME/eventloop (~/.cache/eventloop by default, %LOCALAPPDATA%\\eventloop on Windows).
+    """
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base and sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'eventloop')
+
+def default_index_path(root):
+    """
+    Index file in cache dir keyed by hash of absolute root, watched tree and its parent are not touched.
+    """
+    root = os.path.abspath(root)
+    key = hashlib.blake2b(root.encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+    return os.path.join(cache_dir(), '{}-{}.index'.format(os.path.basename(root), key))
+
+def patterns_digest(include, exclude):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((sorted(include or []), sorted(exclude or []))).encode('utf-8'))
+    return h.digest()
+
+class SnapshotIndex:
+    """
+    Entries are {relative path: (is_dir, size, mtime_ns, inode)}, root has relative path ''.
+    scan() compares tree with saved entries and returns changes as [(path, event)],
+    only directories with changed mtime are listed, files of other directories are just stat'ed.
+    """
+
+    def __init__(self, root, include = None, exclude = None, path = None, matcher = None):
+        self._root = root
+        if path is None:
+            path = default_index_path(root)
+        self._path = path
+        if matcher is None:
+            matcher = PathMatcher(include, exclude)
+        self._matcher = matcher
+        self._digest = patterns_digest(include, exclude)
+        self.entries = dict()
+        self._dirty = False
+
+    def _abs(self, rel):
+        if rel == '':
+            return self._root
+        return os.path.join(self._root, rel)
+
+    def _rel(self, path):
+        rel = os.path.relpath(path, self._root)
+        if rel == '.':
+            return ''
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            return None
+        return rel
+
+    def load(self):
+        """
+        Returns saved entries or None if there is no index or it was saved with other patterns.
+        """
+        try:
+            with open(self._path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return self._parse(data)
+        except (OSError, ValueError, struct.error) as e:
+            debug_print("SnapshotIndex.load", e)
+            return None
+
+    def _parse(self, data):
+        magic, digest = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or digest != self._digest:
+            return None
+        entries = dict()
+        offset = _HEADER.size
+        size = len(data)
+        record_size = _RECORD.size
+        while offset < size:
+            is_dir, size_, mtime, inode, length = _RECORD.unpack_from(data, offset)
+            offset += record_size
+            rel = data[offset:offset + length].decode('utf-8', 'surrogateescape')
+            offset += length
+            entries[rel] = (is_dir == 1, size_, mtime, inode)
+        return entries
+
+    def save(self):
+        if not self._dirty:
+            return
+        chunks = [_HEADER.pack(MAGIC, self._digest)]
+        for rel, (is_dir, size, mtime, inode) in self.entries.items():
+            rel_ = rel.encode('utf-8', 'surrogateescape')
+            chunks.append(_RECORD.pack(1 if is_dir else 0, size, mtime, inode, len(rel_)))
+            chunks.append(rel_)
+        tmp = self._path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(b''.join(chunks))
+            os.replace(tmp, self._path)
+            self._dirty = False
+        except OSError as e:
+            debug_print("SnapshotIndex.save", e)
+
+    def scan(self):
+        """
+        Walks tree and returns changes since saved index, first scan returns no changes.
+        """
+        prev = self.load()
+        known = prev is not None
+        if prev is None:
+            prev = dict()
+
+        children = collections.defaultdict(list)
+        for rel in prev:
+            if rel != '':
+                children[os.path.dirname(rel)].append(rel)
+
+        matcher = self._matcher
+        entries = dict()
+        changes = []
+        queue = collections.deque([''])
+        while len(queue) > 0:
+            rel = queue.popleft()
+            path = self._abs(rel)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                debug_print(e)
+                continue
+            entries[rel] = (True, 0, st.st_mtime_ns, st.st_ino)
+            entry = prev.get(rel)
+            if entry is not None and entry[0] and entry[2] == st.st_mtime_ns and entry[3] == st.st_ino:
+                # listing didn't change
+                candidates = []
+                for rel_ in children.get(rel, []):
+                    try:
+                        candidates.append((rel_, os.stat(self._abs(rel_))))
+                    except OSError:
+                        pass
+            else:
+                candidates = []
+                try:
+                    with os.scandir(path) as it:
+                        for e in it:
+                            try:
+                                rel_ = e.name if rel == '' else os.path.join(rel, e.name)
+                                candidates.append((rel_, e.stat()))
+                            except OSError:
+                                pass
+                except OSError as e:
+                    debug_print(e)
+            for rel_, st_ in candidates:
+                path_ = self._abs(rel_)
+                if stat.S_ISDIR(st_.st_mode):
+                    if not matcher.excluded(path_):
+                        queue.append(rel_)
+                    continue
+                if not matcher.matches(path_):
+                    continue
+                record = (False, st_.st_size, st_.st_mtime_ns, st_.st_ino)
+                entries[rel_] = record
+                if not known:
+                    continue
+                entry = prev.get(rel_)
+                if entry is None or entry[0]:
+                    changes.append((path_, EVENT_RENAME))
+                elif entry != record:
+                    changes.append((path_, EVENT_CHANGE))
+
+        if known:
+            for rel, entry in prev.items():
+                if not entry[0] and rel not in entries:
+                    changes.append((self._abs(rel), EVENT_RENAME))
+
+        self.entries = entries
+        self._dirty = True
+        return changes
+
+    def update(self, path):
+        """
+        Updates entry for path on filesystem event.
+        """
+        rel = self._rel(path)
+        if rel is None:
+            return
+        entries = self.entries
+        try:
+            st = os.stat(path)
+        except OSError:
+            entry = entries.pop(rel, None)
+            if entry is not None and entry[0]:
+                prefix = os.path.join(rel, '')
+                for rel_ in [r for r in entries if r.startswith(prefix)]:
+                    del entries[rel_]
+            st = None
+        if st is not None and not stat.S_ISDIR(st.st_mode) and self._matcher.matches(path):
+            entries[rel] = (False, st.st_size, st.st_mtime_ns, st.st_ino)
+        if rel != '':
+            # parent listing could change, it will be listed on next scan
+            parent = os.path.dirname(rel)
+            entry = entries.get(parent)
+            if entry is not None:
+                entries[parent] = (True, 0, STALE, entry[3])
+        self._dirty = True
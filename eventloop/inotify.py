@@ -0,0 +1,407 @@
+"""
+Linux backend without third-party dependencies: inotify through ctypes and a selectors based loop.
+One inotify fd serves whole recursive tree, watches for new directories are added as they appear.
+On queue overflow watched roots are reported as changed so handlers rescan them.
+"""
+
+from . import base
+from . import stats
+from .common import debug_print, walk, FileEvent, KIND_RENAME, KIND_CHANGE
+from .budget import default_budget, Fallback
+import ctypes
+import ctypes.util
+import errno
+import glob
+import heapq
+import itertools
+import os
+import selectors
+import signal
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+CHANGE_MASK = IN_MODIFY | IN_ATTRIB
+RENAME_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+# IN_MOVED_FROM paths kept for pairing with IN_MOVED_TO of next read
+_MOVED_SIZE = 64
+
+_libc = None
+
+def libc():
+    global _libc
+    if _libc is None:
+        lib = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        lib.inotify_init1.argtypes = [ctypes.c_int]
+        lib.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        lib.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = lib
+    return _libc
+
+class Loop:
+    """
+    Minimal loop: fd readers on selector plus heap of timers.
+    """
+
+    _default = None
+
+    @classmethod
+    def default_loop(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._timers = []
+        self._seq = itertools.count()
+        self._stopped = False
+
+    def add_reader(self, fd, callback):
+        self._selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd):
+        try:
+            self._selector.unregister(fd)
+        except KeyError:
+            pass
+
+    def call_later(self, delay, callback):
+        entry = [time.monotonic() + delay, next(self._seq), callback]
+        heapq.heappush(self._timers, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def run(self):
+        self._stopped = False
+        timers = self._timers
+        while not self._stopped:
+            while len(timers) > 0 and timers[0][2] is None:
+                heapq.heappop(timers)
+            timeout = None
+            if len(timers) > 0:
+                timeout = max(0, timers[0][0] - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                key.data()
+            now = time.monotonic()
+            due = []
+            while len(timers) > 0 and timers[0][0] <= now:
+                due.append(heapq.heappop(timers))
+            for entry in due:
+                callback = entry[2]
+                if callback is not None:
+                    callback()
+
+    def stop(self):
+        self._stopped = True
+
+class EventLoop(base.EventLoop):
+
+    def __init__(self):
+        super().__init__()
+        self._watchers = []
+
+    def start(self):
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        debug_print("EventLoop started")
+        Loop.default_loop().run()
+
+    def addWatcher(self, watcher):
+        self._watchers.append(watcher)
+
+    def stop(self):
+        for watcher in self._watchers:
+            watcher.stop()
+        self._watchers = []
+        Loop.default_loop().stop()
+        debug_print("EventLoop stoped")
+
+class Timer(base.Timer):
+
+    def start(self, interval, callback, once = False):
+        super().start(interval, callback, once)
+        self._interval = interval
+        self._entry = Loop.default_loop().call_later(interval, self.on_timeout)
+
+    def restart(self, interval):
+        loop = Loop.default_loop()
+        if self._entry:
+            loop.cancel(self._entry)
+        self._interval = interval
+        self._entry = loop.call_later(interval, self.on_timeout)
+
+    def on_timeout(self):
+        if self._once:
+            self._entry = None
+        else:
+            self._entry = Loop.default_loop().call_later(self._interval, self.on_timeout)
+        self._callback()
+
+    def stop(self):
+        entry = self._entry
+        self._entry = None
+        if entry:
+            Loop.default_loop().cancel(entry)
+
+class SingleShotTimer(Timer):
+    def start(self, timeout, callback, once = True):
+        super().start(timeout, callback, True)
+
+class FileSystemWatch(base.FileSystemWatch):
+
+    def __init__(self, loop):
+        super().__init__()
+        self._loop = loop
+        # loop that provides add_reader and remove_reader
+        if hasattr(loop, 'add_reader'):
+            self._reactor = loop
+        else:
+            self._reactor = Loop.default_loop()
+        self._fd = None
+        self._wd_to_path = dict()
+        self._path_to_wd = dict()
+        self._file_dirs = dict()
+        self._files = set()
+        # file roots are watched by their directory (atomic save replaces inode of file): {dir: {name: path}}
+        self._file_dirs = dict()
+        self._roots = []
+        # IN_MOVED_FROM paths by cookie, pair can be split between reads
+        self._moved = dict()
+        self._budget = None
+        self._fallback = None
+
+    def start(self, path, callback, include = None, exclude = None, recursive = False):
+        super().start(path, callback, include, exclude, recursive)
+
+        fd = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self._fd = fd
+        self._budget = self.budget or default_budget()
+        self._fallback = Fallback(self._loop, self)
+
+        if glob.has_magic(path):
+            paths = glob.glob(path)
+        else:
+            paths = [path]
+        self._roots = paths
+
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                if recursive:
+                    self._addTree(path)
+                else:
+                    self._addWatches([path])
+            else:
+                files.append(path)
+        for path in files:
+            self._addFile(path)
+
+        self._reactor.add_reader(fd, self.onReadable)
+        self._loop.addWatcher(self)
+
+    def _addWatch(self, path):
+        """
+        Returns False if watch limit is reached (ENOSPC, watches of other processes count too).
+        """
+        wd = libc().inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                return False
+            debug_print("inotify_add_watch", path, os.strerror(code))
+            return True
+        self._wd_to_path[wd] = path
+        self._path_to_wd[path] = wd
+        return True
+
+    def _addFile(self, path):
+        self._files.add(path)
+        dir_ = os.path.dirname(path) or os.curdir
+        if dir_ in self._path_to_wd and dir_ not in self._file_dirs:
+            # directory is watched as root
+            return
+        if dir_ not in self._path_to_wd:
+            taken = self._budget.take(1)
+            exhausted = taken > 0 and not self._addWatch(dir_)
+            if taken == 0 or exhausted or dir_ not in self._path_to_wd:
+                self._budget.release(taken)
+                if exhausted:
+                    self._budget.exhaust()
+                # file alone is polled, not its directory
+                self._fallback.add([path])
+                return
+        self._file_dirs.setdefault(dir_, dict())[os.path.basename(path)] = path
+
+    def _addWatches(self, paths):
+        # paths are breadth first, so ones that don't fit are whole subtrees and they are polled
+        budget = self._budget
+        taken = budget.take(len(paths))
+        added = 0
+        for path in paths[:taken]:
+            if not self._addWatch(path):
+                break
+            added += 1
+        budget.release(taken - added)
+        if added < taken:
+            budget.exhaust()
+        if added < len(paths):
+            self._fallback.add(paths[added:])
+
+    def _addTree(self, path):
+        dirs, files = walk(path, self._include, self._exclude, all_dirs=True, matcher=self._matcher, workers=self.walk_workers)
+        self._addWatches(dirs)
+        return files
+
+    def _removeTree(self, path):
+        prefix = os.path.join(path, '')
+        for path_ in [p for p in self._path_to_wd if p == path or p.startswith(prefix)]:
+            wd = self._path_to_wd.pop(path_)
+            self._wd_to_path.pop(wd, None)
+            self._budget.release(1)
+            libc().inotify_rm_watch(self._fd, wd)
+
+    def onReadable(self):
+        fd = self._fd
+        while fd is not None:
+            try:
+                data = os.read(fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self._onData(data)
+            fd = self._fd
+
+    def _onData(self, data):
+        offset = 0
+        size = len(data)
+        wd_to_path = self._wd_to_path
+        stats_ = stats.current
+        now = time.time()
+        moved = self._moved
+        while offset < size:
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self._onOverflow()
+                continue
+
+            root = wd_to_path.get(wd)
+            if root is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del wd_to_path[wd]
+                self._budget.release(1)
+                if self._path_to_wd.get(root) == wd:
+                    del self._path_to_wd[root]
+                continue
+
+            if name:
+                path = os.path.join(root, os.fsdecode(name))
+            else:
+                path = root
+
+            file_names = self._file_dirs.get(root)
+            if file_names is not None:
+                # directory of file roots, other entries are not watched
+                path = file_names.get(os.fsdecode(name))
+                if path is None:
+                    continue
+
+            if mask & IN_ISDIR:
+                self._onDirEvent(path, mask)
+                continue
+
+            if stats_ is not None:
+                stats_.incr('events_received')
+
+            if mask & IN_MOVED_FROM:
+                moved[cookie] = path
+                if len(moved) > _MOVED_SIZE:
+                    # moved out of watched tree, never paired
+                    del moved[next(iter(moved))]
+
+            if path not in self._files and not self._matcher.matches(path):
+                if stats_ is not None:
+                    stats_.incr('events_filtered')
+                continue
+
+            kinds = 0
+            if mask & RENAME_MASK:
+                kinds |= KIND_RENAME
+            if mask & CHANGE_MASK:
+                kinds |= KIND_CHANGE
+            if kinds == 0:
+                continue
+            old_path = None
+            if mask & IN_MOVED_TO:
+                old_path = moved.pop(cookie, None)
+            self._callback(path, FileEvent(path, kinds, now, old_path=old_path))
+
+    def _onOverflow(self):
+        """
+        Events are lost: watches directories created meanwhile and reports roots as changed (rescan).
+        """
+        debug_print("inotify queue overflow")
+        if stats.current is not None:
+            stats.current.incr('events_overflow')
+        self._moved.clear()
+        for root in self._roots:
+            is_dir = os.path.isdir(root)
+            if is_dir and self._recursive:
+                dirs, files = walk(root, self._include, self._exclude, all_dirs=True, matcher=self._matcher, workers=self.walk_workers)
+                self._addWatches([path for path in dirs if path not in self._path_to_wd])
+            self._callback(root, FileEvent(root, KIND_RENAME | KIND_CHANGE, is_dir=is_dir))
+
+    def _onDirEvent(self, path, mask):
+        if not self._recursive:
+            return
+        if mask & IN_MOVED_FROM:
+            self._removeTree(path)
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            if self._matcher.excluded(path) or path in self._path_to_wd:
+                return
+            debug_print('install watch for {}'.format(path))
+            # files could be created before watch is installed
+            for path_ in self._addTree(path):
+                self._callback(path_, FileEvent(path_, KIND_CHANGE))
+
+    def stop(self):
+        fd = self._fd
+        self._fd = None
+        if fd is not None:
+            self._reactor.remove_reader(fd)
+            os.close(fd)
+            self._budget.release(len(self._wd_to_path))
+        if self._fallback is not None:
+            self._fallback.stop()
+        self._wd_to_path = dict()
+        self._path_to_wd = dict()
+        self._file_dirs = dict()
@@ -0,0 +1,132 @@
+"""
+WatchManager: many handlers on possibly overlapping paths served by one set of watches.
+"""
+
+from . import base, FileSystemWatch, Schedule
+from .common import debug_print, PathMatcher
+import glob
+import os
+
+def _parts(path):
+    return os.path.abspath(path).split(os.sep)
+
+def _covered(path, root):
+    return path == root or path.startswith(os.path.join(root, ''))
+
+class PrefixTrie:
+    """
+    Maps paths to values, find(path) returns values of path and all of its ancestors.
+    """
+
+    def __init__(self):
+        self._root = dict()
+
+    def add(self, path, value):
+        node = self._root
+        for part in _parts(path):
+            node = node.setdefault(part, dict())
+        node.setdefault(None, []).append(value)
+
+    def find(self, path):
+        res = []
+        node = self._root
+        for part in _parts(path):
+            node = node.get(part)
+            if node is None:
+                break
+            res += node.get(None, [])
+        return res
+
+class Subscription:
+
+    def __init__(self, root, handler, include = None, exclude = None, recursive = True, timeout = 1, batch = False):
+        self.root = root
+        self.include = include
+        self.exclude = exclude
+        self.recursive = recursive
+        self.timeout = timeout
+        self.matcher = PathMatcher(include, exclude)
+        if batch:
+            self.executor = base.FuncBatchExecutor(handler)
+        else:
+            self.executor = base.FuncExecutor(handler)
+        self.schedule = Schedule(self.executor)
+
+    def accepts(self, path):
+        if not self.recursive and path != self.root and os.path.dirname(path) != self.root:
+            return False
+        return self.matcher.matches(path)
+
+class WatchManager:
+    """
+    Collects (root, include, exclude, handler) registrations and on start() merges them:
+    roots inside recursively watched roots share their watch, so every directory is walked and watched once.
+    Events are dispatched to subscriptions through PrefixTrie of their roots.
+    Handlers get absolute paths.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._subscriptions = []
+        self._trie = PrefixTrie()
+        self._watches = []
+
+    def add(self, root, handler, include = None, exclude = None, recursive = True, timeout = 1, batch = False):
+        if glob.has_magic(root):
+            raise ValueError("WatchManager does not support globs: {}".format(root))
+        root = os.path.abspath(root)
+        subscription = Subscription(root, handler, include, exclude, recursive, timeout, batch)
+        self._subscriptions.append(subscription)
+        self._trie.add(root, subscription)
+        return subscription
+
+    def on_file_changed(self, root, **kwargs):
+        def decorator(func):
+            self.add(root, func, **kwargs)
+            return func
+        return decorator
+
+    def _plan(self):
+        """
+        Returns [(root, recursive, exclude)] of watches to start.
+        """
+        subscriptions = self._subscriptions
+        tops = []
+        for root in sorted(set(s.root for s in subscriptions if s.recursive)):
+            if not any(_covered(root, top) for top in tops):
+                tops.append(root)
+        plain = []
+        for root in sorted(set(s.root for s in subscriptions if not s.recursive)):
+            if not any(_covered(root, top) for top in tops):
+                plain.append(root)
+
+        plan = []
+        for root, recursive in [(root, True) for root in tops] + [(root, False) for root in plain]:
+            # directory can be skipped only if every subscription inside excludes it
+            exclude = None
+            for s in subscriptions:
+                if _covered(s.root, root):
+                    if exclude is None:
+                        exclude = set(s.exclude or [])
+                    else:
+                        exclude &= set(s.exclude or [])
+            plan.append((root, recursive, sorted(exclude)))
+        return plan
+
+    def start(self):
+        for root, recursive, exclude in self._plan():
+            debug_print("WatchManager watch", root, recursive, exclude)
+            watch = FileSystemWatch(self._loop)
+            watch.start(root, self.on_change, exclude=exclude, recursive=recursive)
+            self._watches.append(watch)
+        self._loop._handles.append(self)
+
+    def on_change(self, path, event):
+        for subscription in self._trie.find(path):
+            if subscription.accepts(path):
+                subscription.schedule.append(path, subscription.timeout, event)
+
+    def stop(self):
+        for watch in self._watches:
+            watch.stop()
+        self._watches = []
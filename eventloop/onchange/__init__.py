@@ -3,18 +3,26 @@ import subprocess
 import eventloop
 from eventloop import on_file_changed, Server
 import datetime
-from colorama import Fore, Back, Style, init as colorama_init
 import os
 import sys
 import shutil
 
+# lines of recent server output shown when it crashes
+RECENT_LINES = 20
+
+# chime and colorama are imported when needed to keep startup fast
 chime = None
 
-try:
-    import chime
-    chime.theme('big-sur')
-except ImportError:
-    pass
+def import_chime():
+    global chime
+    if chime is None:
+        try:
+            import chime as chime_
+            chime_.theme('big-sur')
+            chime = chime_
+        except ImportError:
+            pass
+    return chime
 
 def beep_success():
     try:
@@ -58,17 +66,126 @@ def replace(cmd_orig, path):
     cmd = [path if arg == 'FILE' else arg for arg in cmd]
     return cmd
 
+def replace_files(cmd_orig, paths):
+    cmd = cmd_orig[:]
+    if paths is None:
+        return cmd
+    if sys.platform == 'win32' and cmd[0] in WIN_BUILTINS:
+        cmd = ['cmd','/c'] + cmd
+    res = []
+    for arg in cmd:
+        if arg == 'FILES':
+            res += paths
+        else:
+            res.append(arg)
+    return res
+
 def now_str():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+_colorama_ready = False
+
+def colorama_fore():
+    global _colorama_ready
+    from colorama import Fore, init as colorama_init
+    if not _colorama_ready:
+        colorama_init()
+        _colorama_ready = True
+    return Fore
+
 class Logger(eventloop.base.Logger):
 
     def print_error(self, msg):
+        Fore = colorama_fore()
         print(Fore.WHITE + now_str() + " " + Fore.RED + msg + Fore.RESET)
 
-def main():
-    colorama_init()
-    logger = Logger()
+class ChainRunner:
+    """
+    Runs commands one after another without blocking event loop, every command is started by Server
+    (new session, inherited stdio), restart() kills running chain (whole process tree) and starts new one when tree exited.
+    """
+
+    def __init__(self, logger, cwd=None, on_done=None, poll_interval=0.05):
+        self._logger = logger
+        self._cwd = cwd
+        self._on_done = on_done
+        self._poll_interval = poll_interval
+        self._server = None
+        self._queue = []
+        self._timer = None
+
+    def restart(self, cmds):
+        self._queue = list(cmds)
+        if self._timer is None:
+            self._timer = eventloop.Timer()
+            self._timer.start(self._poll_interval, self._poll)
+        self._next()
+
+    def kill(self):
+        self._queue = []
+        self._stop_timer()
+        if self._server is not None:
+            self._server.stop()
+
+    def _next(self):
+        if len(self._queue) == 0:
+            self._finish(True)
+            return
+        cmd = self._queue.pop(0)
+        debug_print("cmd", cmd)
+        if self._server is None:
+            self._server = Server()
+        # kills previous command (running one on restart) with its descendants
+        self._server.restart(cmd, cwd=self._cwd)
+
+    def _poll(self):
+        code = self._server.exit_code()
+        if code is None:
+            return
+        if code != 0:
+            self._finish(False)
+        else:
+            self._next()
+
+    def _stop_timer(self):
+        timer = self._timer
+        self._timer = None
+        if timer:
+            timer.stop()
+
+    def _finish(self, success):
+        self._queue = []
+        self._stop_timer()
+        if self._on_done:
+            self._on_done(success)
+
+def batch_paths(tasks):
+    if tasks is None:
+        return None
+    return [path for path in tasks if path is not None]
+
+def run_rules(args, logger):
+    from .rules import Rules, watch_rules
+    try:
+        rules = Rules.load(args.rules)
+    except (OSError, ValueError, KeyError) as e:
+        logger.print_error("failed to load rules {}: {}".format(args.rules, e))
+        exit(1)
+
+    if args.beep:
+        import_chime()
+
+    def on_done(success):
+        if args.beep:
+            if success:
+                beep_success()
+            else:
+                beep_error()
+
+    cwd = args.cwd if args.cwd else rules.root
+    watch_rules(rules, logger, cwd=cwd, jobs=args.jobs, on_done=on_done, poll=args.poll)
+
+def make_parser():
     example_text = """
 examples:
   python -m eventloop.onchange D:\\dev\\app -- echo FILE
@@ -76,19 +193,52 @@ examples:
   onchange D:\\dev\\app -i *.cpp *.ui --cwd D:\\dev\\app\\build -- ninja "&&" ctest
   onchange . -i "*.pyx" --beep -- python setup.py build_ext --inplace
   onchange http-server.py --server -- python -u http-server.py
+  onchange src --server --restart handover --listen 8000 --ready-output "Serving" -- python -u src/app.py
+  onchange src --server --preload django numpy -- python -u manage.py runserver --noreload
+  onchange src -i *.py --batch -- pylint FILES
+  onchange src -i *.c --restart-on-change -- make "&&" make test
+  onchange --rules onchange.json -j 4
     """
     parser = argparse.ArgumentParser(prog="onchange", epilog=example_text, formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('src', help="directory or file to watch")
+    parser.add_argument('src', nargs='?', help="directory or file to watch")
     parser.add_argument('-i','--include', nargs='+', help="include globs")
     parser.add_argument('-e','--exclude', nargs='+', help="exclude globs")
     parser.add_argument('-c','--cwd', help='cwd for command')
     parser.add_argument('-t', '--timeout', type=float, default=1)
     parser.add_argument('-n', '--non-recursive', action='store_true', help="non recursive (do not look for changes in subdirectories)")
-    parser.add_argument('cmd', nargs='+', help="command to execute")
+    parser.add_argument('cmd', nargs='*', help="command to execute")
     parser.add_argument('--beep', action='store_true', help='beep when done')
     parser.add_argument('--server', action='store_true', help="server mode: restart (kill) process on file change")
-    args = parser.parse_args()
+    parser.add_argument('-j', '--jobs', type=int, help="run commands in background with at most JOBS commands at once (does not block watching while command runs)")
+    parser.add_argument('-r', '--restart-on-change', action='store_true', help="kill running commands when new changes arrive and start them again")
+    parser.add_argument('--poll', action='store_true', help="poll filesystem instead of native events (for network filesystems and containers)")
+    parser.add_argument('--content-hash', action='store_true', help="ignore events for files which content did not change")
+    parser.add_argument('--batch', action='store_true', help="batch mode: run command once per timeout with all changed files substituted for FILES")
+    parser.add_argument('--timestamps', action='store_true', help="prefix server output lines with time")
+    parser.add_argument('--labels', action='store_true', help="prefix server output lines with executable name")
+    parser.add_argument('--restart', choices=['kill', 'term', 'handover'], default='kill', help="server restart: kill old process, terminate it (kill after --grace seconds) or start new one and stop old one when new one is ready")
+    parser.add_argument('--grace', type=float, default=5, help="seconds terminated server has to exit before it's killed")
+    parser.add_argument('--ready-port', type=int, help="server is ready when this port accepts connections")
+    parser.add_argument('--ready-output', help="server is ready when its stdout matches this regex")
+    parser.add_argument('--ready-timeout', type=float, default=30, help="seconds new server has to get ready (--restart handover)")
+    parser.add_argument('--preload', nargs='+', help="warm spare mode: keep spare python interpreter with these modules imported and run python server command in it")
+    parser.add_argument('--listen', type=int, help="create listening socket on port once and pass it to server processes (fd number in EVENTLOOP_LISTEN_FD)")
+    parser.add_argument('--rules', help="rules mode: run commands of rules from json config which inputs changed (see eventloop.onchange.rules)")
+    return parser
+
+def main():
+    logger = Logger()
+    parser = make_parser()
+    # src and cmd are optional (--rules), intermixed parsing keeps options between them working
+    args = parser.parse_intermixed_args()
     #print(args); exit(0)
+
+    if args.rules:
+        run_rules(args, logger)
+        return
+
+    if args.src is None or len(args.cmd) == 0:
+        parser.error("src and cmd are required")
     cmds = list(split(args.cmd, '&&'))
 
     for cmd in cmds:
@@ -107,7 +257,7 @@ examples:
 
     recursive = not args.non_recursive
 
-    if args.beep and 'chime' not in sys.modules:
+    if args.beep and import_chime() is None:
         print("install chime for better sound notifications\n  pip install chime")
 
     if args.server:
@@ -120,27 +270,74 @@ examples:
             print("--beep not implemented for --server mode")
             exit(1)
 
-        server = Server()
+        probe = None
+        if args.ready_output:
+            probe = eventloop.OutputProbe(args.ready_output)
+        elif args.ready_port:
+            probe = eventloop.PortProbe(args.ready_port)
+
+        # server keeps terminal unless output needs prefixes
+        pump = None
+        if args.timestamps or args.labels:
+            pump = eventloop.OutputPump(timestamps=args.timestamps, labels=args.labels)
+
+        def on_exit(code):
+            if code == 0:
+                return
+            logger.print_error("server exited with code {}".format(code))
+            # inherited stdio is not captured, output is on terminal already
+            recent = server.recent_output()
+            if recent:
+                tail = b'\n'.join(recent.rstrip(b'\n').split(b'\n')[-RECENT_LINES:])
+                print(tail.decode('utf-8', 'replace'), file=sys.stderr)
+
+        server = Server(pump=pump, strategy=args.restart, grace=args.grace, probe=probe, probe_timeout=args.ready_timeout, listen=args.listen, preload=args.preload, on_exit=on_exit)
 
         loop = eventloop.EventLoop()
 
-        @on_file_changed(args.src, recursive=recursive, include=args.include, exclude=args.exclude, timeout=args.timeout, loop=loop)
+        @on_file_changed(args.src, recursive=recursive, include=args.include, exclude=args.exclude, timeout=args.timeout, loop=loop, batch=args.batch, content_filter=args.content_hash, poll=args.poll)
         def handler(path):
             debug_print("handler for {}".format(path))
-            cmd = replace(cmds[0], path)
+            if args.batch:
+                cmd = replace_files(cmds[0], batch_paths(path))
+            else:
+                cmd = replace(cmds[0], path)
             server.restart(cmd, cwd=args.cwd)
 
         handler(None)
 
         loop.start()
 
+    elif args.restart_on_change:
+
+        def on_done(success):
+            if args.beep:
+                if success:
+                    beep_success()
+                else:
+                    beep_error()
+
+        runner = ChainRunner(logger, cwd=args.cwd, on_done=on_done)
+
+        @on_file_changed(args.src, recursive=recursive, include=args.include, exclude=args.exclude, timeout=args.timeout, batch=True, content_filter=args.content_hash, poll=args.poll)
+        def handler(tasks):
+            debug_print("handler for {}".format(list(tasks)))
+            if args.batch:
+                chain = [replace_files(cmd, batch_paths(tasks)) for cmd in cmds]
+            else:
+                chain = [replace(cmd, path) for path in tasks for cmd in cmds]
+            runner.restart(chain)
+
     else:
-        @on_file_changed(args.src, recursive=recursive, include=args.include, exclude=args.exclude, timeout=args.timeout)
+        @on_file_changed(args.src, recursive=recursive, include=args.include, exclude=args.exclude, timeout=args.timeout, batch=args.batch, workers=args.jobs, content_filter=args.content_hash, poll=args.poll)
         def handler(path):
             debug_print("handler for {}".format(path))
             success = True
             for cmd in cmds:
-                cmd = replace(cmd, path)
+                if args.batch:
+                    cmd = replace_files(cmd, batch_paths(path))
+                else:
+                    cmd = replace(cmd, path)
                 debug_print("cmd", cmd)
                 try:
                     proc = subprocess.run(cmd, cwd=args.cwd)
@@ -0,0 +1,201 @@
+"""
+Rules mode: config file maps include globs to command pipelines,
+only rules which inputs changed (and rules that depend on them) are executed.
+
+{
+    "root": ".",
+    "exclude": [".git", "build"],
+    "timeout": 1,
+    "rules": [
+        {"name": "proto", "include": ["*.proto"], "outputs": ["gen/*"], "cmd": "protoc --python_out=gen FILES"},
+        {"name": "lint", "include": ["*.py"], "cmd": "pylint FILES"},
+        {"name": "test", "include": ["*.py"], "deps": ["proto"], "cmd": "pytest -q && echo ok"}
+    ]
+}
+
+root is relative to config file, outputs are globs relative to root, changes of outputs don't trigger rules.
+FILES in cmd is replaced with changed inputs of the rule.
+"""
+
+import eventloop
+from eventloop import base
+from eventloop.common import PathMatcher
+from . import ChainRunner, split, replace_files, debug_print
+import fnmatch
+import json
+import os
+import shlex
+
+class Rule:
+
+    def __init__(self, name, cmd, include = None, exclude = None, outputs = None, deps = None):
+        self.name = name
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        self.cmds = list(split(cmd, '&&'))
+        self.include = include
+        self.exclude = exclude
+        self.outputs = outputs or []
+        self.deps = deps or []
+        self._matcher = PathMatcher(include, exclude)
+
+    def matches(self, path):
+        return self._matcher.matches(path)
+
+def _is_output(rules, path, root):
+    rel = os.path.relpath(path, root)
+    for rule in rules:
+        for pat in rule.outputs:
+            if fnmatch.fnmatch(rel, pat) or fnmatch.fnmatch(os.path.basename(path), pat):
+                return True
+    return False
+
+def toposort(rules):
+    """
+    Returns rules ordered so that every rule goes after its deps, raises ValueError on unknown dep or cycle.
+    """
+    by_name = {rule.name: rule for rule in rules}
+    res = []
+    state = dict()
+    def visit(rule, chain):
+        if state.get(rule.name) == 'done':
+            return
+        if state.get(rule.name) == 'visiting':
+            raise ValueError("rules dependency cycle: {}".format(" -> ".join(chain + [rule.name])))
+        state[rule.name] = 'visiting'
+        for dep in rule.deps:
+            if dep not in by_name:
+                raise ValueError("rule {} depends on unknown rule {}".format(rule.name, dep))
+            visit(by_name[dep], chain + [rule.name])
+        state[rule.name] = 'done'
+        res.append(rule)
+    for rule in rules:
+        visit(rule, [])
+    return res
+
+class Rules:
+
+    def __init__(self, rules, root = '.', exclude = None, timeout = 1):
+        self.rules = toposort(rules)
+        self.root = os.path.abspath(root)
+        self.exclude = exclude
+        self.timeout = timeout
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        names = set()
+        rules = []
+        for item in config['rules']:
+            if item['name'] in names:
+                raise ValueError("duplicate rule {}".format(item['name']))
+            names.add(item['name'])
+            rules.append(Rule(item['name'], item['cmd'], item.get('include'), item.get('exclude'), item.get('outputs'), item.get('deps')))
+        root = os.path.join(os.path.dirname(os.path.abspath(path)), config.get('root', '.'))
+        return cls(rules, root, config.get('exclude'), config.get('timeout', 1))
+
+    def include(self):
+        """
+        Union of rules include globs for watch, None if some rule watches everything.
+        """
+        res = set()
+        for rule in self.rules:
+            if not rule.include:
+                return None
+            res.update(rule.include)
+        return sorted(res)
+
+    def dirty(self, paths):
+        """
+        Returns {rule name: changed inputs} for rules which inputs changed and rules that depend on them.
+        """
+        res = dict()
+        for path in paths:
+            if path is None or _is_output(self.rules, path, self.root):
+                continue
+            for rule in self.rules:
+                if rule.matches(path):
+                    res.setdefault(rule.name, []).append(path)
+        for rule in self.rules:
+            # deps go first in self.rules
+            if rule.name not in res and any(dep in res for dep in rule.deps):
+                res[rule.name] = []
+        return res
+
+class RulesExecutor(base.AsyncExecutor):
+    """
+    Runs dirty rules of batch in topological order, rules which deps are done run in parallel (at most jobs at once).
+    Dependents of failed rule are skipped. Batch that arrives while rules run waits in Schedule.
+    """
+    batch = True
+
+    def __init__(self, rules, logger, cwd = None, jobs = None, on_done = None):
+        super().__init__()
+        self._rules = rules
+        self._logger = logger
+        self._cwd = cwd
+        self._jobs = jobs
+        self._on_done = on_done
+        self._runners = dict()
+
+    def submit(self, tasks, callback):
+        dirty = self._rules.dirty(tasks)
+        debug_print("dirty rules", list(dirty))
+        self._dirty = dirty
+        self._done = set()
+        self._failed = set()
+        self._callback = callback
+        self._next()
+
+    def _next(self):
+        rules = [rule for rule in self._rules.rules if rule.name in self._dirty]
+        for rule in rules:
+            if rule.name in self._done or rule.name in self._runners:
+                continue
+            if self._jobs is not None and len(self._runners) >= self._jobs:
+                break
+            if any(dep in self._failed for dep in rule.deps):
+                debug_print("skipping rule", rule.name)
+                self._failed.add(rule.name)
+                self._done.add(rule.name)
+                continue
+            if all(dep in self._done or dep not in self._dirty for dep in rule.deps):
+                self._start(rule)
+        callback = self._callback
+        if callback is not None and len(self._runners) == 0 and len(self._done) == len(rules):
+            # _next can be reentered from runner that finished synchronously
+            self._callback = None
+            if self._on_done:
+                self._on_done(len(self._failed) == 0)
+            # failed rules are not retried until their inputs change again
+            callback(True)
+
+    def _start(self, rule):
+        files = self._dirty[rule.name]
+        chain = [replace_files(cmd, files) for cmd in rule.cmds]
+        debug_print("starting rule", rule.name, chain)
+        runner = ChainRunner(self._logger, cwd=self._cwd, on_done=lambda success: self._finish(rule, success))
+        self._runners[rule.name] = runner
+        runner.restart(chain)
+
+    def _finish(self, rule, success):
+        self._runners.pop(rule.name, None)
+        self._done.add(rule.name)
+        if not success:
+            self._logger.print_error("rule {} failed".format(rule.name))
+            self._failed.add(rule.name)
+        self._next()
+
+    def kill(self):
+        for runner in list(self._runners.values()):
+            runner.kill()
+        self._runners = dict()
+
+def watch_rules(rules, logger, loop = None, cwd = None, jobs = None, on_done = None, poll = False):
+    """
+    Watches rules root and runs rules on changes, returns executor.
+    """
+    executor = RulesExecutor(rules, logger, cwd=cwd, jobs=jobs, on_done=on_done)
+    eventloop.on_file_changed(rules.root, include=rules.include(), exclude=rules.exclude, timeout=rules.timeout, loop=loop, batch=True, poll=poll)(executor)
+    return executor
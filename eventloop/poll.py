@@ -0,0 +1,238 @@
+"""
+Polling FileSystemWatch for filesystems without native events (NFS, SMB, bind mounts in containers).
+Works on top of any flavour's timers.
+"""
+
+from . import base
+from . import stats
+from .common import debug_print, walk, scandir_snapshot, FileEvent, KIND_RENAME, KIND_CHANGE
+import glob
+import os
+
+class _RoundRobin:
+
+    def __init__(self):
+        self._keys = []
+        self._pos = 0
+
+    def take(self, source, count):
+        # items added to source are picked up on next round
+        res = []
+        while len(res) < count:
+            if self._pos >= len(self._keys):
+                if len(res) > 0 or len(source) == 0:
+                    break
+                self._keys = list(source)
+                self._pos = 0
+            end = min(len(self._keys), self._pos + count - len(res))
+            res += [key for key in self._keys[self._pos:end] if key in source]
+            self._pos = end
+        return res
+
+class FileSystemWatch(base.FileSystemWatch):
+    """
+    Each tick stats at most batch_size directories (listing again those with changed mtime)
+    and at most batch_size files, so full scan of big tree is spread across several ticks.
+    Interval drops to min_interval when changes are found and grows up to max_interval while tree is idle.
+    """
+
+    def __init__(self, loop, min_interval = 0.2, max_interval = 2, batch_size = 2000):
+        super().__init__()
+        self._loop = loop
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._batch_size = batch_size
+        self._interval = min_interval
+        self._dirs = dict()
+        self._children = dict()
+        self._files = dict()
+        self._dirs_cursor = _RoundRobin()
+        self._files_cursor = _RoundRobin()
+        self._timer = None
+
+    def start(self, path, callback, include = None, exclude = None, recursive = False, timer = True):
+        """
+        path can be list of paths.
+        With timer=False caller is responsible for calling tick() and waiting for interval it returns.
+        """
+        super().start(path, callback, include, exclude, recursive)
+
+        if isinstance(path, list):
+            roots = path
+        elif glob.has_magic(path):
+            roots = glob.glob(path)
+        else:
+            roots = [path]
+
+        for root in roots:
+            self.add(root)
+
+        if timer:
+            if hasattr(self._loop, 'SingleShotTimer'):
+                # loop that is not flavour loop (asyncio) provides its own timers
+                self._timer = self._loop.SingleShotTimer()
+            else:
+                from . import SingleShotTimer
+                self._timer = SingleShotTimer()
+            self._timer.start(self._interval, self.on_timeout)
+
+    def add(self, path):
+        """
+        Adds directory (with subtree if recursive) or file to polled paths.
+        """
+        if os.path.isdir(path):
+            self._addTree(path)
+        else:
+            self._children.setdefault(os.path.dirname(path), set())
+            self._addFile(path)
+
+    def _addTree(self, path):
+        dirs, files = walk(path, self._include, self._exclude, all_dirs=True, recursive=self._recursive, matcher=self._matcher)
+        if not self._recursive:
+            dirs = [path]
+            files = [f for f in files if os.path.dirname(f) == path]
+        for path_ in dirs:
+            try:
+                self._dirs[path_] = os.stat(path_).st_mtime_ns
+            except OSError as e:
+                debug_print(e)
+                continue
+            self._children[path_] = set()
+            parent = self._children.get(os.path.dirname(path_))
+            if parent is not None and path_ != path:
+                parent.add(os.path.basename(path_))
+        res = []
+        for path_ in files:
+            if self._addFile(path_):
+                res.append(path_)
+        return res
+
+    def _addFile(self, path):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            debug_print(e)
+            return False
+        self._files[path] = (st.st_mtime_ns, st.st_ino)
+        parent = self._children.get(os.path.dirname(path))
+        if parent is not None:
+            parent.add(os.path.basename(path))
+        return True
+
+    def _removeFile(self, path):
+        self._files.pop(path, None)
+        parent = self._children.get(os.path.dirname(path))
+        if parent is not None:
+            parent.discard(os.path.basename(path))
+
+    def _removeTree(self, path):
+        prefix = os.path.join(path, '')
+        removed = [p for p in self._files if p.startswith(prefix)]
+        for path_ in removed:
+            del self._files[path_]
+        for path_ in [p for p in self._dirs if p == path or p.startswith(prefix)]:
+            del self._dirs[path_]
+            del self._children[path_]
+        parent = self._children.get(os.path.dirname(path))
+        if parent is not None:
+            parent.discard(os.path.basename(path))
+        return removed
+
+    def _rescanDir(self, path, mtime):
+        snapshot = scandir_snapshot(path)
+        if snapshot is None:
+            return []
+        self._dirs[path] = mtime
+        children = self._children[path]
+        events = []
+        # files that disappeared by inode, new file with same inode is renamed one
+        removed = dict()
+        for name in children:
+            if name not in snapshot:
+                record = self._files.get(os.path.join(path, name))
+                if record is not None:
+                    removed[record[1]] = os.path.join(path, name)
+        for name, (is_dir, mtime_, inode) in snapshot.items():
+            path_ = os.path.join(path, name)
+            if name in children:
+                record = self._files.get(path_)
+                if record is not None and record != (mtime_, inode):
+                    self._files[path_] = (mtime_, inode)
+                    events.append(FileEvent(path_, KIND_CHANGE))
+                continue
+            if is_dir:
+                if self._recursive and not self._matcher.excluded(path_):
+                    debug_print("poll new directory", path_)
+                    children.add(name)
+                    events += [FileEvent(p, KIND_RENAME) for p in self._addTree(path_)]
+            elif self._matcher.matches(path_):
+                children.add(name)
+                self._files[path_] = (mtime_, inode)
+                events.append(FileEvent(path_, KIND_RENAME, old_path=removed.get(inode)))
+        for name in [n for n in children if n not in snapshot]:
+            path_ = os.path.join(path, name)
+            if path_ in self._dirs:
+                events += [FileEvent(p, KIND_RENAME) for p in self._removeTree(path_)]
+            else:
+                self._removeFile(path_)
+                events.append(FileEvent(path_, KIND_RENAME))
+        return events
+
+    def _pollDirs(self):
+        events = []
+        for path in self._dirs_cursor.take(self._dirs, self._batch_size):
+            mtime = self._dirs.get(path)
+            if mtime is None:
+                # removed while polling this batch
+                continue
+            try:
+                mtime_ = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime_ != mtime:
+                events += self._rescanDir(path, mtime_)
+        return events
+
+    def _pollFiles(self):
+        events = []
+        for path in self._files_cursor.take(self._files, self._batch_size):
+            record = self._files.get(path)
+            if record is None:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._removeFile(path)
+                events.append(FileEvent(path, KIND_RENAME))
+                continue
+            record_ = (st.st_mtime_ns, st.st_ino)
+            if record_ != record:
+                self._files[path] = record_
+                events.append(FileEvent(path, KIND_CHANGE))
+        return events
+
+    def tick(self):
+        events = self._pollDirs() + self._pollFiles()
+        if len(events) > 0:
+            self._interval = self._min_interval
+        else:
+            self._interval = min(self._interval * 1.5, self._max_interval)
+        stats_ = stats.current
+        if stats_ is not None:
+            stats_.incr('events_received', len(events))
+        for event in events:
+            self._callback(event.path, event)
+        return self._interval
+
+    def on_timeout(self):
+        if self._timer is None:
+            return
+        interval = self.tick()
+        if self._timer is not None:
+            self._timer.restart(interval)
+
+    def stop(self):
+        timer = self._timer
+        self._timer = None
+        if timer:
+            timer.stop()
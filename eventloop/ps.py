@@ -1,21 +1,162 @@
-import psutil
 import subprocess
-from .common import debug_print
+import threading
+from .common import debug_print, new_session_kwargs
+from .pump import OutputPump, STDOUT, STDERR, piped_env
+from .restart import Restarter, Process, RESTART_KILL
+from . import zygote
+import os
 import sys
+import time
+
+class PsProcess(Process):
+
+    def __init__(self, proc, pump, label):
+        super().__init__(proc.pid)
+        self.proc = proc
+        self._pump = pump
+        self._label = label
+        self.attached = False
+        # threads reading pipes into pump
+        self.readers = []
+        # spare_cmd, cwd and label of warm spare
+        self.key = None
+
+    def exited(self):
+        return self.proc.poll() is not None
+
+    def returncode(self):
+        return self.proc.returncode
+
+    def attach(self):
+        self.attached = True
+        self.started = time.monotonic()
+        if self._pump is not None:
+            self._pump.attach(self._label)
+
+    def send(self, data):
+        with self.proc.stdin:
+            self.proc.stdin.write(data)
+
+    def discard(self):
+        self.kill()
+        self.proc.wait()
+        if self.proc.stdin is not None:
+            self.proc.stdin.close()
+
+    def close(self):
+        # tree exited, rest of output is read before process is detached (and reported)
+        for thread in self.readers:
+            thread.join(1)
+        self.readers = []
+        if self.attached:
+            self.attached = False
+            if self._pump is not None:
+                self._pump.detach(self._label)
 
 class Server:
-    def __init__(self, parent = None):
-        self._pid = None
+    """
+    Process inherits stdio (keeps terminal) unless pump is given or probe reads output (OutputProbe, default pump then):
+    output goes through OutputPump (read by threads), see recent_output() for last output,
+    PYTHONUNBUFFERED is set so python processes don't buffer piped output.
+    Process is started in new session, old one is stopped with its descendants according to strategy, see eventloop.restart.
+    With preload python commands run in warm spare interpreter with preload modules imported (see eventloop.zygote),
+    next spare is started as soon as previous one is taken.
+    """
+
+    def __init__(self, parent = None, pump = None, label = None, strategy = RESTART_KILL, grace = 5, probe = None, probe_timeout = 30, listen = None, preload = None, on_exit = None):
+        if pump is None and getattr(probe, 'output', False):
+            pump = OutputPump()
+        self._pump = pump
+        self._label = label
+        self._current = None
+        self._preload = preload
+        self._spare = None
+        self._restarter = Restarter(self._spawn, strategy, grace, probe, probe_timeout, listen, on_exit=on_exit)
 
     def restart(self, cmd, cwd = None):
-        if self._pid is not None:
-            try:
-                proc = psutil.Process(self._pid)
-                debug_print("killing")
-                proc.kill()
-                debug_print("killed")
-            except psutil.NoSuchProcess:
-                debug_print("psutil.NoSuchProcess")
-        proc = subprocess.Popen(cmd, cwd=cwd)
-        self._pid = proc.pid
-        debug_print("self._pid", self._pid)
\ No newline at end of file
+        self._restarter.restart(cmd, cwd)
+
+    def _spawn(self, cmd, cwd, env, pass_fds):
+        label = self._label if self._label is not None else os.path.basename(cmd[0])
+        env = piped_env(env) if self._pump is not None else env
+        process = None
+        split = zygote.split_cmd(cmd) if self._preload is not None else None
+        if split is not None:
+            interpreter, rest = split
+            spare_cmd = zygote.spare_cmd(interpreter, zygote.path0(rest, cwd), self._preload)
+            key = (spare_cmd, cwd, label)
+            process = self._take_spare(key, cmd, cwd, env, pass_fds)
+            # next spare imports modules while this one runs
+            self._spare = self._start(spare_cmd, cwd, env, pass_fds, label, stdin=subprocess.PIPE)
+            self._spare.key = key
+        if process is None:
+            process = self._start(cmd, cwd, env, pass_fds, label)
+        self._current = label
+        process.attach()
+        return process
+
+    def _take_spare(self, key, cmd, cwd, env, pass_fds):
+        spare = self._spare
+        self._spare = None
+        if spare is not None and (spare.key != key or spare.exited()):
+            debug_print("discarding spare")
+            spare.discard()
+            spare = None
+        if spare is None:
+            spare_cmd, cwd, label = key
+            spare = self._start(spare_cmd, cwd, env, pass_fds, label, stdin=subprocess.PIPE)
+        try:
+            spare.send(zygote.request(cmd))
+        except OSError as e:
+            debug_print(e)
+            spare.discard()
+            return None
+        return spare
+
+    def _start(self, cmd, cwd, env, pass_fds, label, stdin = None):
+        output = subprocess.PIPE if self._pump is not None else None
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, pass_fds=pass_fds, stdin=stdin, stdout=output, stderr=output, **new_session_kwargs())
+        debug_print("pid", proc.pid)
+        process = PsProcess(proc, self._pump, label)
+        if self._pump is not None:
+            for stream, pipe in [(STDOUT, proc.stdout), (STDERR, proc.stderr)]:
+                thread = threading.Thread(target=self._read, args=(process, label, stream, pipe), daemon=True)
+                thread.start()
+                process.readers.append(thread)
+        return process
+
+    def _read(self, process, label, stream, pipe):
+        with pipe:
+            while True:
+                data = pipe.read1(64 * 1024)
+                if not data:
+                    break
+                if stream == STDOUT:
+                    self._restarter.feed(process, data)
+                self._pump.write(label, data, stream)
+
+    def stop(self):
+        """
+        Kills server and spare (with their descendants).
+        """
+        for process in [self._restarter.current, self._restarter.candidate, self._spare]:
+            if process is not None:
+                process.discard()
+                process.close()
+        self._restarter.current = None
+        self._restarter.candidate = None
+        self._spare = None
+
+    def exit_code(self):
+        """
+        Exit code of current process, see Restarter.exit_code().
+        """
+        return self._restarter.exit_code()
+
+    def recent_output(self):
+        """
+        Last output of current (or last exited) process, b'' when process inherits stdio (there is no pump).
+        """
+        if self._current is None or self._pump is None:
+            return b''
+        return self._pump.recent(self._current)
@@ -0,0 +1,210 @@
+"""
+Output pump for Server processes: coalesces output chunks and writes them in bigger pieces.
+"""
+
+from .common import debug_print
+import collections
+import datetime
+import os
+import sys
+import threading
+
+STDOUT, STDERR = range(2)
+
+def piped_env(env = None):
+    """
+    Environment for process which output is piped: python doesn't buffer its stdout then (it does when stdout is not a tty).
+    """
+    env = dict(os.environ if env is None else env)
+    env['PYTHONUNBUFFERED'] = '1'
+    return env
+
+class RingBuffer:
+    """
+    Keeps last size bytes written to it.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._chunks = collections.deque()
+        self._length = 0
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self._chunks.append(data)
+        self._length += len(data)
+        while self._length - len(self._chunks[0]) >= self._size:
+            self._length -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        data = b''.join(self._chunks)
+        return data[-self._size:]
+
+class OutputPump:
+    """
+    Collects output of processes (write() can be called from any thread) and writes it to stdout or stderr
+    every flush_interval seconds or when more than max_buffer bytes are collected (up to last complete line).
+    With timestamps or labels each line is prefixed with time of arrival and process label.
+    Last ring_size bytes of every label are kept for post-mortem display, see recent().
+    """
+
+    def __init__(self, flush_interval = 0.05, max_buffer = 64 * 1024, ring_size = 64 * 1024, timestamps = False, labels = False, stdout = None, stderr = None):
+        self._flush_interval = flush_interval
+        self._max_buffer = max_buffer
+        self._ring_size = ring_size
+        self._timestamps = timestamps
+        self._labels = labels
+        self._streams = [stdout, stderr]
+        self._buffers = [bytearray(), bytearray()]
+        self._rings = dict()
+        self._line_start = dict()
+        # number of running processes per label
+        self._attached = collections.Counter()
+        self._lock = threading.Lock()
+        # one thread writes to stream at a time without holding _lock (write can block on pipe or slow terminal)
+        self._stream_locks = [threading.Lock(), threading.Lock()]
+        self._flushing = [False, False]
+        self._timer = None
+
+    def _stream(self, stream):
+        res = self._streams[stream]
+        if res is None:
+            res = (sys.stdout, sys.stderr)[stream]
+            res = getattr(res, 'buffer', res)
+        return res
+
+    def attach(self, label):
+        """
+        Called on loop thread when process starts, flush timer runs while there are attached processes.
+        """
+        with self._lock:
+            self._attached[label] += 1
+            self._rings.setdefault(label, RingBuffer(self._ring_size))
+            self._line_start[(label, STDOUT)] = True
+            self._line_start[(label, STDERR)] = True
+        if self._timer is None:
+            from . import Timer
+            self._timer = Timer()
+            self._timer.start(self._flush_interval, self.flush)
+
+    def detach(self, label):
+        """
+        Called on loop thread when process is finished.
+        """
+        with self._lock:
+            self._attached[label] -= 1
+            if self._attached[label] <= 0:
+                del self._attached[label]
+            attached = len(self._attached)
+        self.flush()
+        if attached == 0 and self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def _prefix(self, label):
+        res = ''
+        if self._timestamps:
+            res += datetime.datetime.now().strftime("%H:%M:%S.%f")[:-3] + " "
+        if self._labels:
+            res += "[{}] ".format(label)
+        return res.encode('utf-8')
+
+    def _format(self, label, stream, data):
+        if not self._timestamps and not self._labels:
+            return data
+        key = (label, stream)
+        line_start = self._line_start.get(key, True)
+        prefix = self._prefix(label)
+        res = []
+        lines = data.split(b'\n')
+        for i, line in enumerate(lines):
+            last = i == len(lines) - 1
+            if last and line == b'':
+                break
+            if line_start:
+                res.append(prefix)
+            res.append(line)
+            if last:
+                line_start = False
+            else:
+                res.append(b'\n')
+                line_start = True
+        self._line_start[key] = line_start
+        return b''.join(res)
+
+    def write(self, label, data, stream = STDOUT):
+        if len(data) == 0:
+            return
+        with self._lock:
+            data = self._format(label, stream, data)
+            ring = self._rings.get(label)
+            if ring is None:
+                ring = RingBuffer(self._ring_size)
+                self._rings[label] = ring
+            ring.write(data)
+            buffer = self._buffers[stream]
+            buffer += data
+            if len(buffer) < self._max_buffer:
+                return
+        self._drain(stream)
+
+    def _take(self, stream):
+        # called under _lock, returns chunk to write now
+        buffer = self._buffers[stream]
+        if self._flushing[stream]:
+            self._flushing[stream] = False
+            end = len(buffer)
+        elif len(buffer) >= self._max_buffer:
+            # write complete lines now, rest goes with next flush
+            end = buffer.rfind(b'\n') + 1
+            if end == 0:
+                end = len(buffer)
+        else:
+            return b''
+        chunk = bytes(buffer[:end])
+        del buffer[:end]
+        return chunk
+
+    def _drain(self, stream):
+        # chunks collected while stream is written by other thread are written by that thread
+        lock = self._stream_locks[stream]
+        while lock.acquire(blocking=False):
+            try:
+                while True:
+                    with self._lock:
+                        chunk = self._take(stream)
+                    if len(chunk) == 0:
+                        break
+                    self._write(stream, chunk)
+            finally:
+                lock.release()
+            with self._lock:
+                if not self._flushing[stream] and len(self._buffers[stream]) < self._max_buffer:
+                    return
+
+    def _write(self, stream, data):
+        out = self._stream(stream)
+        try:
+            out.write(data)
+            out.flush()
+        except (OSError, ValueError) as e:
+            debug_print("OutputPump", e)
+
+    def flush(self):
+        with self._lock:
+            for stream, buffer in enumerate(self._buffers):
+                if len(buffer) > 0:
+                    self._flushing[stream] = True
+        for stream in [STDOUT, STDERR]:
+            self._drain(stream)
+
+    def recent(self, label):
+        """
+        Last ring_size bytes of output of process with label (prefixed as written).
+        """
+        with self._lock:
+            ring = self._rings.get(label)
+            if ring is None:
+                return b''
+            return ring.getvalue()
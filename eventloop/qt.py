@@ -1,27 +1,41 @@
 from . import base
 import signal
-from .common import debug_print, walk, EVENT_CHANGE, debug_print, path_matches
+from . import stats
+from .common import debug_print, walk, scandir_snapshot, FileEvent, KIND_RENAME, KIND_CHANGE
+from .budget import default_budget, Fallback
+from .pump import OutputPump, STDOUT, STDERR, piped_env
+from .restart import Restarter, Process, RESTART_KILL
+from . import zygote
 import glob
 import os
 from .common import flavour, FLAVOUR_NONE, FLAVOUR_PYUV, FLAVOUR_PYSIDE2, FLAVOUR_PYQT5, FLAVOUR_PYQT6, FLAVOUR_PYSIDE6
 import sys
+import time
 
 if flavour in [FLAVOUR_PYSIDE2]:
     debug_print("PySide2")
     from PySide2 import QtCore
+    Signal = QtCore.Signal
+    Slot = QtCore.Slot
     class ServerBase(QtCore.QObject):
         pass
 elif flavour in [FLAVOUR_PYQT5]:
     debug_print("PyQt5")
     from PyQt5 import QtCore
+    Signal = QtCore.pyqtSignal
+    Slot = QtCore.pyqtSlot
     class ServerBase(QtCore.QObject):
         pass
 elif flavour == FLAVOUR_PYSIDE6:
     from PySide6 import QtCore
+    Signal = QtCore.Signal
+    Slot = QtCore.Slot
     class ServerBase(QtCore.QObject):
         pass
 elif flavour == FLAVOUR_PYQT6:
     from PyQt6 import QtCore
+    Signal = QtCore.pyqtSignal
+    Slot = QtCore.pyqtSlot
     class ServerBase(QtCore.QObject):
         pass
 else:
@@ -74,6 +88,12 @@ class Timer(base.Timer):
         timer.start(int(interval * 1000))
         self._timer = timer
 
+    def restart(self, interval):
+        timer = self._timer
+        if timer is None:
+            return super().restart(interval)
+        timer.start(int(interval * 1000))
+
     def stop(self):
         timer = self._timer
         self._timer = None
@@ -84,7 +104,7 @@ class Timer(base.Timer):
         self._callback()
 
 class SingleShotTimer(Timer):
-    def start(self, timeout, callback):
+    def start(self, timeout, callback, once = True):
         super().start(timeout, callback, True)
 
 class FileSystemWatch(base.FileSystemWatch):
@@ -92,12 +112,18 @@ class FileSystemWatch(base.FileSystemWatch):
     def __init__(self, loop):
         super().__init__()
         self._loop = loop
+        self._watched = set()
+        self._snapshots = dict()
+        self._budget = None
+        self._fallback = None
 
     def start(self, path, callback, include = None, exclude = None, recursive = False):
         super().start(path, callback, include, exclude, recursive)
         watcher = QtCore.QFileSystemWatcher()
         self._watch = watcher
         self._loop.addWatcher(watcher)
+        self._budget = self.budget or default_budget()
+        self._fallback = Fallback(self._loop, self)
 
         if not recursive:
             if glob.has_magic(path):
@@ -106,119 +132,437 @@ class FileSystemWatch(base.FileSystemWatch):
             for root, dirs_, files in os.walk(path):
                 for f in files:
                     p = os.path.join(root, f)
-                    if path_matches(p, include, exclude):
+                    if self._matcher.matches(p):
                         paths_to_add.append(p)
-            self._addPaths(paths_to_add)
+            self._addPaths([path], paths_to_add[1:])
+            self._initSnapshots([path], paths_to_add[1:])
         else:
-            dirs, files = walk(path, include, exclude, all_dirs=True, recursive=recursive)
-            self._addPaths(dirs + files)
+            dirs, files = walk(path, include, exclude, all_dirs=True, recursive=recursive, matcher=self._matcher, workers=self.walk_workers)
+            self._addPaths(dirs, files)
+            self._initSnapshots(dirs, files)
         
         watcher.fileChanged.connect(self.on_file_changed)
         watcher.directoryChanged.connect(self.on_directory_changed)
-        
-    def on_directory_changed(self, path):
-        include = self._include
-        exclude = self._exclude
-        watcher = self._watch
 
-        # todo do glob instead of walk if _orig_path has magic
-        dirs, files = walk(path, include, exclude, all_dirs=True, recursive=self._recursive)
+    def _initSnapshots(self, dirs, files):
+        # inodes tell replaced files from modified ones, mtimes are not needed: content changes come from fileChanged
+        snapshots = self._snapshots
+        for path in dirs:
+            snapshots[path] = scandir_snapshot(path, mtime=False) or dict()
 
-        watched = watcher.files()
-        if self._recursive:
-            self._addPaths(dirs + files)
-        else:
-            self._addPaths(files)
-            
-        for path in files:
-            if path not in watched:
-                self._callback(path, EVENT_CHANGE)
-
-    def _addPaths(self, paths):
-        watcher = self._watch
-        watcher.addPaths(paths)
+    def on_directory_changed(self, path):
+        new = scandir_snapshot(path, mtime=False)
+        if new is None:
+            self._forget(path)
+            return
+        old = self._snapshots.get(path, dict())
+        self._snapshots[path] = new
+
+        # files that disappeared by inode, new file with same inode is renamed one
+        removed = dict()
+        for name in old.keys() - new.keys():
+            is_dir, mtime, inode = old[name]
+            if not is_dir:
+                removed[inode] = os.path.join(path, name)
+
+        changed = []
+        for name, (is_dir, mtime, inode) in new.items():
+            prev = old.get(name)
+            # content changes are reported by fileChanged, here we look for new and replaced entries
+            if prev is not None and prev[0] == is_dir and prev[2] == inode:
+                continue
+            path_ = os.path.join(path, name)
+            if prev is not None:
+                # replaced (atomic save) or re-created, qt dropped watch on old inode
+                self._forget(path_)
+            if is_dir:
+                if self._recursive and not self._matcher.excluded(path_):
+                    # todo do glob instead of walk if _orig_path has magic
+                    dirs, files = walk(path_, self._include, self._exclude, all_dirs=True, recursive=True, matcher=self._matcher, workers=self.walk_workers)
+                    self._addPaths(dirs, files)
+                    self._initSnapshots(dirs, files)
+                    changed += [FileEvent(p, KIND_CHANGE) for p in files]
+            elif self._matcher.matches(path_):
+                self._addPaths([], [path_])
+                old_path = removed.get(inode) if prev is None else None
+                if old_path is not None:
+                    changed.append(FileEvent(path_, KIND_CHANGE | KIND_RENAME, old_path=old_path))
+                else:
+                    changed.append(FileEvent(path_, KIND_CHANGE))
+
+        for name in old.keys() - new.keys():
+            self._forget(os.path.join(path, name))
+
+        stats_ = stats.current
+        if stats_ is not None:
+            stats_.incr('events_received', len(changed))
+
+        for event in changed:
+            self._callback(event.path, event)
+
+    def _forget(self, path):
+        # drops path and its subtree (found through snapshots) from watcher
+        dropped = []
+        queue = [path]
+        while len(queue) > 0:
+            path_ = queue.pop()
+            if path_ in self._watched:
+                self._watched.discard(path_)
+                dropped.append(path_)
+            snapshot = self._snapshots.pop(path_, None)
+            if snapshot is not None:
+                queue += [os.path.join(path_, name) for name in snapshot]
+        if len(dropped) > 0:
+            self._watch.removePaths(dropped)
+            self._budget.release(len(dropped))
+
+    def _addPaths(self, dirs, files):
+        # directories go first: with directory watched new, removed and replaced files are still noticed,
+        # paths that don't fit into budget are polled
+        watched = self._watched
+        paths = [p for p in dirs + files if p not in watched]
+        if len(paths) == 0:
+            return
+        taken = self._budget.take(len(paths))
+        rest = paths[taken:]
+        paths = paths[:taken]
+        if len(paths) > 0:
+            failed = self._watch.addPaths(paths) or []
+            watched.update(paths)
+            watched.difference_update(failed)
+            self._budget.release(len(failed))
+            rest = list(failed) + rest
+        if len(rest) > 0:
+            self._fallback.add(rest)
         #debug_print('watcher.addPaths', paths)
 
     def on_file_changed(self, path):
-        if not path_matches(path, self._include, self._exclude):
+        stats_ = stats.current
+        if stats_ is not None:
+            stats_.incr('events_received')
+        if not self._matcher.matches(path):
+            if stats_ is not None:
+                stats_.incr('events_filtered')
             return
-        self._callback(path, EVENT_CHANGE)
+        self._callback(path, FileEvent(path, KIND_CHANGE))
 
     def stop(self):
-        pass
-
+        if self._budget is not None and len(self._watched) > 0:
+            self._watch.removePaths(list(self._watched))
+            self._budget.release(len(self._watched))
+            self._watched = set()
+        if self._fallback is not None:
+            self._fallback.stop()
+
+
+
+
+
+
+if flavour in [FLAVOUR_PYSIDE2, FLAVOUR_PYQT5, FLAVOUR_PYSIDE6, FLAVOUR_PYQT6]:
+
+    class _WatchWorker(QtCore.QObject):
+        """
+        Lives in watch thread, runs FileSystemWatch there and emits collected events in batches.
+        """
+        batch = Signal(object)
+
+        def __init__(self, flush_interval):
+            super().__init__()
+            self._flush_interval = flush_interval
+            self._watch = None
+            self._watchers = []
+            self._events = []
+            self._timer = None
+
+        def addWatcher(self, watcher):
+            self._watchers.append(watcher)
+
+        @Slot(object)
+        def start(self, args):
+            path, include, exclude, recursive, walk_workers = args
+            timer = QtCore.QTimer()
+            timer.setSingleShot(True)
+            timer.timeout.connect(self.flush)
+            self._timer = timer
+            watch = FileSystemWatch(self)
+            watch.walk_workers = walk_workers
+            watch.start(path, self.on_change, include=include, exclude=exclude, recursive=recursive)
+            self._watch = watch
+
+        def on_change(self, path, event):
+            self._events.append((path, event))
+            if not self._timer.isActive():
+                self._timer.start(int(self._flush_interval * 1000))
+
+        def flush(self):
+            events = self._events
+            self._events = []
+            if len(events) > 0:
+                self.batch.emit(events)
+
+        @Slot()
+        def stop(self):
+            if self._timer:
+                self._timer.stop()
+            for watcher in self._watchers:
+                paths = watcher.files() + watcher.directories()
+                if len(paths):
+                    watcher.removePaths(paths)
+            self._watchers = []
+            self._watch = None
+            self.thread().quit()
+
+    class _WatchReceiver(QtCore.QObject):
+        """
+        Lives in main thread, passes batches from worker to callback.
+        """
+        startRequested = Signal(object)
+        stopRequested = Signal()
+
+        def __init__(self, callback):
+            super().__init__()
+            self._callback = callback
+
+        @Slot(object)
+        def on_batch(self, events):
+            for path, event in events:
+                self._callback(path, event)
+
+class ThreadedFileSystemWatch(base.FileSystemWatch):
+    """
+    FileSystemWatch that runs QFileSystemWatcher and directory rescans on dedicated QThread,
+    callback is called on main thread with events collected within flush_interval.
+    """
+
+    def __init__(self, loop, flush_interval = 0.05):
+        super().__init__()
+        self._loop = loop
+        self._flush_interval = flush_interval
+        self._thread = None
 
+    def start(self, path, callback, include = None, exclude = None, recursive = False):
+        super().start(path, callback, include, exclude, recursive)
+        queued = QtCore.Qt.ConnectionType.QueuedConnection
+        thread = QtCore.QThread()
+        worker = _WatchWorker(self._flush_interval)
+        worker.moveToThread(thread)
+        receiver = _WatchReceiver(callback)
+        receiver.startRequested.connect(worker.start, queued)
+        receiver.stopRequested.connect(worker.stop, queued)
+        worker.batch.connect(receiver.on_batch, queued)
+        self._thread = thread
+        self._worker = worker
+        self._receiver = receiver
+        thread.start()
+        receiver.startRequested.emit((path, include, exclude, recursive, self.walk_workers))
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
 
+    def stop(self):
+        thread = self._thread
+        self._thread = None
+        if thread is None:
+            return
+        self._receiver.stopRequested.emit()
+        thread.wait()
 
+class QtProcess(Process):
 
+    def __init__(self, process, pump, label):
+        super().__init__()
+        self.process = process
+        self._pump = pump
+        self._label = label
+        self.attached = False
+        # spare_cmd, cwd and label of warm spare
+        self.key = None
+
+    def exited(self):
+        return self.process.state() == QtCore.QProcess.ProcessState.NotRunning
+
+    def returncode(self):
+        # crashed or failed to start
+        if self.process.exitStatus() != QtCore.QProcess.ExitStatus.NormalExit or self.process.error() == QtCore.QProcess.ProcessError.FailedToStart:
+            return None
+        return self.process.exitCode()
+
+    def attach(self):
+        self.attached = True
+        self.started = time.monotonic()
+        if self._pump is not None:
+            self._pump.attach(self._label)
+
+    def send(self, data):
+        # written when process starts, fails if process is not running (anymore)
+        if self.process.write(data) < 0:
+            raise OSError("failed to write to process: {}".format(self.process.errorString()))
+        self.process.closeWriteChannel()
+
+    def discard(self):
+        self.kill()
+
+    def close(self):
+        if self.attached:
+            self.attached = False
+            if self._pump is not None:
+                self._pump.detach(self._label)
+
+def _new_session(process):
+    # process group is created only by Qt 6.6+ (or bindings with setChildProcessModifier), otherwise tree is found by parent pid
+    if sys.platform == 'win32':
+        return
+    if hasattr(process, 'setUnixProcessParameters'):
+        process.setUnixProcessParameters(QtCore.QProcess.UnixProcessFlag.CreateNewSession)
+    elif hasattr(process, 'setChildProcessModifier'):
+        process.setChildProcessModifier(os.setsid)
 
 class Server(ServerBase):
-    def __init__(self, parent = None):
+    """
+    Process output is forwarded to stdio unless pump is given or probe reads output (OutputProbe, default pump then):
+    output goes through OutputPump, see recent_output() for last output, PYTHONUNBUFFERED is set for python processes.
+    Process is started in new session, old one is stopped with its descendants according to strategy, see eventloop.restart.
+    With preload python commands run in warm spare interpreter with preload modules imported (see eventloop.zygote),
+    next spare is started as soon as previous one is taken.
+    """
+
+    def __init__(self, parent = None, pump = None, label = None, strategy = RESTART_KILL, grace = 5, probe = None, probe_timeout = 30, listen = None, preload = None, on_exit = None):
         super().__init__(parent)
-        self._process = None
-        self._terminated = None
-        
-    def restart(self, cmd, cwd = None):
-        process = self._process
-        if process is not None:
-            if process.state() == QtCore.QProcess.ProcessState.Running:
-                debug_print("terminating", process)
-                process.kill()
-                self._terminated = process
-            self._process = None
+        if pump is None and getattr(probe, 'output', False):
+            pump = OutputPump()
+        self._pump = pump
+        self._label = label
+        self._current = None
+        self._preload = preload
+        self._spare = None
+        # QProcess must outlive its process, killed ones are kept until finished
+        self._processes = []
+        self._restarter = Restarter(self._spawn, strategy, grace, probe, probe_timeout, listen, on_exit=on_exit)
 
+    def restart(self, cmd, cwd = None):
         debug_print("Server.start cmd", cmd)
-
+        self._restarter.restart(cmd, cwd)
+
+    def _spawn(self, cmd, cwd, env, pass_fds):
+        label = self._label if self._label is not None else os.path.basename(cmd[0])
+        env = piped_env(env) if self._pump is not None else env
+        handle = None
+        split = zygote.split_cmd(cmd) if self._preload is not None else None
+        if split is not None:
+            interpreter, rest = split
+            spare_cmd = zygote.spare_cmd(interpreter, zygote.path0(rest, cwd), self._preload)
+            key = (spare_cmd, cwd, label)
+            handle = self._take_spare(key, cmd, env)
+            # next spare imports modules while this one runs
+            self._spare = self._start(spare_cmd, cwd, env, label, True)
+            self._spare.key = key
+        if handle is None:
+            handle = self._start(cmd, cwd, env, label)
+        self._current = label
+        handle.attach()
+        return handle
+
+    def _take_spare(self, key, cmd, env):
+        spare = self._spare
+        self._spare = None
+        if spare is not None and (spare.key != key or spare.exited()):
+            debug_print("discarding spare")
+            spare.discard()
+            spare = None
+        if spare is None:
+            spare_cmd, cwd, label = key
+            spare = self._start(spare_cmd, cwd, env, label, True)
+        try:
+            spare.send(zygote.request(cmd))
+        except OSError as e:
+            # command is started cold
+            debug_print(e)
+            spare.discard()
+            return None
+        return spare
+
+    def _start(self, cmd, cwd, env, label, spare = False):
+        # QProcess doesn't close inherited descriptors, listening socket is inheritable
         process = QtCore.QProcess()
         process.setProgram(cmd[0])
         process.setArguments(cmd[1:])
         if cwd is not None:
             process.setWorkingDirectory(cwd)
-        
-        process.readyReadStandardOutput.connect(self.onStdOut)
-        process.readyReadStandardError.connect(self.onStdErr)
+        if env is not None:
+            environment = QtCore.QProcessEnvironment()
+            for key, value in env.items():
+                environment.insert(key, value)
+            process.setProcessEnvironment(environment)
+        _new_session(process)
+
+        handle = QtProcess(process, self._pump, label)
+
+        if self._pump is not None:
+            process.readyReadStandardOutput.connect(lambda: self.onStdOut(handle, label))
+            process.readyReadStandardError.connect(lambda: self.onStdErr(handle, label))
+        else:
+            process.setProcessChannelMode(QtCore.QProcess.ProcessChannelMode.ForwardedChannels)
         process.started.connect(self.onStarted)
         
-        process.error.connect(self.onError)
+        process.errorOccurred.connect(self.onError)
 
+        process.finished.connect(lambda *args: handle.close())
+        process.finished.connect(lambda *args: self._processes.remove(handle))
         process.finished.connect(self.onFinished)
 
-        process.start(QtCore.QIODevice.OpenModeFlag.ReadOnly)
-
-        #debug_print("readChannelCount", process.readChannelCount())
-
-        self._process = process
+        if spare:
+            # spare reads command from stdin
+            process.start(QtCore.QIODevice.OpenModeFlag.ReadWrite)
+        else:
+            process.start(QtCore.QIODevice.OpenModeFlag.ReadOnly)
+        handle.pid = process.processId() or None
+        self._processes.append(handle)
 
         debug_print("state", process.state())
-
-        #QtCore.QTimer.singleShot(1000, lambda: debug_print("state", process.state()))
-        #QtCore.QTimer.singleShot(1000, self.onStdErr)
-        #QtCore.QTimer.singleShot(1000, self.onStdOut)
+        return handle
     
     def onError(self, code):
         debug_print("error", code)
 
     def onStarted(self):
-        process = self._process
-        debug_print(process, "started")
+        debug_print("started")
 
     def onFinished(self):
         debug_print("onFinished")
 
-    def onStdOut(self):
+    def onStdOut(self, handle, label):
         debug_print("onStdOut")
-        process = self._process
-        if process is None:
-            return
-        data = process.readAllStandardOutput()
-        sys.stdout.buffer.write(data.data())
-        sys.stdout.buffer.flush()
+        data = handle.process.readAllStandardOutput().data()
+        self._restarter.feed(handle, data)
+        self._pump.write(label, data, STDOUT)
         
-    def onStdErr(self):
+    def onStdErr(self, handle, label):
         debug_print("onStdErr")
-        process = self._process
-        if process is None:
-            return
-        data = process.readAllStandardError()
-        sys.stderr.buffer.write(data.data())
-        sys.stderr.buffer.flush()
\ No newline at end of file
+        data = handle.process.readAllStandardError().data()
+        self._pump.write(label, data, STDERR)
+
+    def stop(self):
+        """
+        Kills server and spare (with their descendants).
+        """
+        for handle in [self._restarter.current, self._restarter.candidate, self._spare]:
+            if handle is not None:
+                handle.discard()
+        self._restarter.current = None
+        self._restarter.candidate = None
+        self._spare = None
+
+    def exit_code(self):
+        """
+        Exit code of current process, see Restarter.exit_code().
+        """
+        return self._restarter.exit_code()
+
+    def recent_output(self):
+        """
+        Last output of current (or last exited) process, b'' when process inherits stdio (there is no pump).
+        """
+        if self._current is None or self._pump is None:
+            return b''
+        return self._pump.recent(self._current)
@@ -0,0 +1,467 @@
+"""
+Server restart strategies and readiness probes.
+
+RESTART_KILL - kill old process and start new one when it exited
+RESTART_TERM - terminate (SIGTERM) old process, kill it if it's still running after grace seconds, then start new one
+RESTART_HANDOVER - start new process, wait until probe reports it ready, then stop old one as RESTART_TERM does
+
+With listen, listening socket is created once and passed to every process by fd (number in EVENTLOOP_LISTEN_FD,
+see inherited_socket()), so old and new process accept on the same socket and port is never closed (not on Windows).
+PortProbe is useless with listen (port accepts connections into backlog), use OutputProbe.
+
+Processes are stopped with their descendants (wrappers like sh -c or npm run leave them otherwise):
+servers start process in new session and signal its process group and descendants.
+"""
+
+from .common import debug_print, RESTART_KILL, RESTART_TERM, RESTART_HANDOVER
+from . import stats
+import collections
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+LISTEN_FD_ENV = 'EVENTLOOP_LISTEN_FD'
+
+def _proc_stat(pid):
+    # (state, parent, process group) from /proc on Linux
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            data = f.read()
+    except (OSError, ValueError):
+        return None
+    fields = data[data.rindex(')') + 2:].split()
+    return fields[0], int(fields[1]), int(fields[2])
+
+def _descendants(pid):
+    # descendants that left process group (setsid) are found with psutil or /proc on Linux
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            return {proc.pid for proc in psutil.Process(pid).children(recursive=True)}
+        except psutil.Error as e:
+            debug_print(e)
+            return set()
+    if not sys.platform.startswith('linux'):
+        return set()
+    children = collections.defaultdict(list)
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            stat = _proc_stat(name)
+            if stat is not None:
+                children[stat[1]].append(int(name))
+    res = set()
+    queue = [pid]
+    while len(queue) > 0:
+        for child in children.get(queue.pop(), []):
+            if child not in res:
+                res.add(child)
+                queue.append(child)
+    return res
+
+def signal_process_tree(pid, sig = None, reaped = False):
+    """
+    Sends sig (SIGKILL by default) to process group of process started with new_session_kwargs() and to its descendants
+    that left the group (found with psutil or /proc on Linux), returns set of pids of its descendants.
+    reaped means process itself is reaped: its pid can belong to another process now, only group is signalled.
+    On Windows tree is killed with taskkill whatever sig is.
+    """
+    if reaped:
+        # descendants were reparented, the ones seen before are signalled by caller
+        if sys.platform != 'win32':
+            try:
+                os.killpg(pid, sig if sig is not None else signal.SIGKILL)
+            except (ProcessLookupError, PermissionError) as e:
+                debug_print(e)
+        return set()
+    pids = _descendants(pid)
+    if sys.platform == 'win32':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return pids
+    if sig is None:
+        sig = signal.SIGKILL
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError) as e:
+        debug_print(e)
+    # process itself in case it was not started in new session
+    for child in [pid] + list(pids):
+        try:
+            os.kill(child, sig)
+        except (ProcessLookupError, PermissionError) as e:
+            debug_print(e)
+    return pids
+
+def _alive(pid):
+    # zombies are dead: they wait for parent (or init) to reap them
+    if sys.platform.startswith('linux'):
+        stat = _proc_stat(pid)
+        return stat is not None and stat[0] != 'Z'
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+    if sys.platform == 'win32':
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _group_alive(pgid):
+    if sys.platform.startswith('linux'):
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                stat = _proc_stat(name)
+                if stat is not None and stat[2] == pgid and stat[0] != 'Z':
+                    return True
+        return False
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def process_tree_running(pid, pids = ()):
+    """
+    True while process group pid (leader must be reaped by caller) or any of pids is alive.
+    """
+    if sys.platform != 'win32' and _group_alive(pid):
+        return True
+    return any(_alive(child) for child in pids)
+
+def listen_socket(port, host = ''):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+def inherited_socket():
+    """
+    Listening socket passed by server (in child process), None if there is no one.
+    """
+    fd = os.environ.get(LISTEN_FD_ENV)
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+class Process:
+    """
+    Process started by server in new session (process group), pid is its pid.
+    Servers implement exited() (process itself exited and is reaped), close() is called once when restarter forgets process.
+    terminate() and kill() signal whole tree: process group and descendants that left it (psutil or /proc),
+    running() is True while any of them is alive.
+    """
+
+    def __init__(self, pid = None):
+        self.pid = pid
+        self.started = time.monotonic()
+        self.ready = False
+        # end of output for OutputProbe, pattern can be split between chunks
+        self.tail = b''
+        # pids of descendants seen when tree was signalled
+        self.tree = set()
+        self.killed = False
+        self.deadline = None
+
+    def exited(self):
+        return True
+
+    def returncode(self):
+        """
+        Exit code of exited process, None if it's unknown.
+        """
+        return None
+
+    def running(self):
+        if not self.exited():
+            return True
+        if self.pid is None:
+            return False
+        return process_tree_running(self.pid, self.tree)
+
+    def terminate(self):
+        self._signal(signal.SIGTERM if sys.platform != 'win32' else None)
+
+    def kill(self):
+        self.killed = True
+        self._signal(None)
+
+    def _signal(self, sig):
+        if self.pid is None:
+            return
+        reaped = self.exited()
+        self.tree |= signal_process_tree(self.pid, sig, reaped)
+        if reaped and sys.platform != 'win32':
+            for child in self.tree:
+                if _alive(child):
+                    try:
+                        os.kill(child, sig if sig is not None else signal.SIGKILL)
+                    except (ProcessLookupError, PermissionError) as e:
+                        debug_print(e)
+
+    def close(self):
+        pass
+
+class PortProbe:
+    """
+    Process is ready when port accepts connections.
+    """
+
+    # server doesn't need to read output
+    output = False
+
+    def __init__(self, port, host = '127.0.0.1'):
+        self.port = port
+        self.host = host
+
+    def feed(self, process, data):
+        pass
+
+    def check(self, process):
+        try:
+            with socket.create_connection((self.host, self.port), timeout=0.1):
+                return True
+        except OSError:
+            return False
+
+class OutputProbe:
+    """
+    Process is ready when its stdout matches pattern (str or bytes regex).
+    """
+
+    # server pipes output of process
+    output = True
+
+    def __init__(self, pattern, tail = 4096):
+        if isinstance(pattern, str):
+            pattern = pattern.encode('utf-8')
+        self.pattern = re.compile(pattern)
+        self._tail = tail
+        # feed() is called from reader threads, check() from loop thread
+        self._lock = threading.Lock()
+
+    def feed(self, process, data):
+        with self._lock:
+            if process.ready:
+                return
+            tail = process.tail + data
+            if self.pattern.search(tail):
+                process.ready = True
+                tail = b''
+            process.tail = tail[-self._tail:]
+
+    def check(self, process):
+        with self._lock:
+            return process.ready
+
+class Restarter:
+    """
+    Restarts server process according to strategy, spawn(cmd, cwd, env, pass_fds) starts process and returns Process.
+    New process is started only when whole tree of old one exited (RESTART_KILL, RESTART_TERM),
+    tree that survives kill_timeout seconds after SIGKILL is reported and forgotten.
+    Waiting (grace, readiness, exit) is polled by loop timer, restart() never blocks, current process that exits on its own
+    (with its tree) is closed and forgotten, its exit code is kept in returncode and passed to on_exit(code) if given.
+    With RESTART_HANDOVER new process that exits or doesn't get ready in probe_timeout seconds is dropped and old one keeps running.
+    """
+
+    def __init__(self, spawn, strategy = RESTART_KILL, grace = 5, probe = None, probe_timeout = 30, listen = None, poll_interval = 0.05, kill_timeout = 5, on_exit = None):
+        if strategy not in [RESTART_KILL, RESTART_TERM, RESTART_HANDOVER]:
+            raise ValueError("unknown restart strategy {}".format(strategy))
+        self._spawn = spawn
+        self._strategy = strategy
+        self._grace = grace
+        self._probe = probe
+        self._probe_timeout = probe_timeout
+        self._listen = listen
+        self._poll_interval = poll_interval
+        self._kill_timeout = kill_timeout
+        self._on_exit = on_exit
+        self._socket = None
+        # running process
+        self.current = None
+        # handover: started process that is not ready yet
+        self.candidate = None
+        # terminated or killed processes which trees are still running
+        self._stopping = []
+        # (cmd, cwd) that waits for old process to exit
+        self._pending = None
+        self._timer = None
+        # number of processes of stopped trees (servers with their descendants)
+        self.reaped = 0
+        # exit code of last process that exited on its own (with its tree), -1 if it failed to start
+        self.returncode = None
+
+    def restart(self, cmd, cwd = None):
+        if self._strategy == RESTART_HANDOVER:
+            if self.candidate is not None:
+                # newer change arrived before candidate got ready
+                debug_print("dropping candidate")
+                self._kill(self.candidate)
+            self.candidate = self._start(cmd, cwd)
+            if self.current is None:
+                # nothing to hand over
+                self.current = self.candidate
+                self.candidate = None
+        else:
+            if self.current is not None:
+                if self._strategy == RESTART_TERM:
+                    self._stop(self.current)
+                else:
+                    self._kill(self.current)
+                self.current = None
+            self._pending = (cmd, cwd)
+        self._poll()
+
+    def exit_code(self):
+        """
+        Exit code of current process, None while it runs or waits for old tree to exit, -1 if there is no process (failed to start or stopped).
+        """
+        if self._pending is not None:
+            return None
+        if self.current is None:
+            return -1 if self.returncode is None else self.returncode
+        if not self.current.exited():
+            return None
+        code = self.current.returncode()
+        return -1 if code is None else code
+
+    def feed(self, process, data):
+        """
+        Called by server with stdout of process.
+        """
+        if self._probe is not None:
+            self._probe.feed(process, data)
+
+    def socket(self):
+        if self._socket is None and self._listen is not None:
+            self._socket = listen_socket(self._listen)
+        return self._socket
+
+    def _start(self, cmd, cwd):
+        env = None
+        pass_fds = ()
+        sock = self.socket()
+        if sock is not None:
+            env = dict(os.environ)
+            env[LISTEN_FD_ENV] = str(sock.fileno())
+            pass_fds = (sock.fileno(),)
+        debug_print("Restarter start", cmd)
+        self.returncode = None
+        try:
+            return self._spawn(cmd, cwd, env, pass_fds)
+        except OSError as e:
+            print("eventloop: failed to start {}: {}".format(cmd[0], e), file=sys.stderr)
+            self.returncode = -1
+            return None
+
+    def _kill(self, process):
+        debug_print("killing")
+        process.kill()
+        process.deadline = time.monotonic() + self._kill_timeout
+        self._stopping.append(process)
+
+    def _stop(self, process):
+        debug_print("terminating")
+        process.terminate()
+        process.deadline = time.monotonic() + self._grace
+        self._stopping.append(process)
+
+    def _reap(self, process):
+        count = 1 + len(process.tree)
+        debug_print("reaped", count)
+        self.reaped += count
+        if stats.current is not None:
+            stats.current.incr('server_reaped', count)
+        process.close()
+
+    def _ready(self, process):
+        if process.ready or self._probe is None:
+            return True
+        if self._probe.check(process):
+            process.ready = True
+        return process.ready
+
+    def _poll(self):
+        now = time.monotonic()
+
+        stopping = []
+        for process in self._stopping:
+            if not process.running():
+                self._reap(process)
+            elif now < process.deadline:
+                stopping.append(process)
+            elif not process.killed:
+                debug_print("grace timeout, killing")
+                process.kill()
+                process.deadline = now + self._kill_timeout
+                stopping.append(process)
+            else:
+                print("eventloop: server process tree (pid {}) is still running after SIGKILL".format(process.pid), file=sys.stderr)
+                process.close()
+        self._stopping = stopping
+
+        candidate = self.candidate
+        if candidate is not None:
+            if candidate.exited():
+                print("eventloop: new server process exited before it got ready, old one keeps running", file=sys.stderr)
+                self.candidate = None
+                self._kill(candidate)
+            elif self._ready(candidate):
+                debug_print("ready in", now - candidate.started)
+                self.candidate = None
+                if self.current is not None:
+                    self._stop(self.current)
+                self.current = candidate
+            elif now - candidate.started >= self._probe_timeout:
+                print("eventloop: new server process is not ready in {} seconds, old one keeps running".format(self._probe_timeout), file=sys.stderr)
+                self.candidate = None
+                self._kill(candidate)
+        elif self.current is not None and not self.current.ready and self._probe is not None:
+            if self._ready(self.current):
+                debug_print("ready in", now - self.current.started)
+
+        current = self.current
+        if current is not None and not current.running():
+            # exited (crashed) on its own with its tree, detached from output pump now rather than on next restart
+            code = current.returncode()
+            debug_print("exited", code)
+            self.returncode = -1 if code is None else code
+            self.current = None
+            current.close()
+            if self._on_exit is not None:
+                self._on_exit(self.returncode)
+
+        if self._pending is not None and len(self._stopping) == 0:
+            cmd, cwd = self._pending
+            self._pending = None
+            self.current = self._start(cmd, cwd)
+
+        # running process is polled too to notice when it exits on its own
+        waiting = len(self._stopping) > 0 or self.candidate is not None or self._pending is not None or self.current is not None
+        if waiting and self._timer is None:
+            from . import Timer
+            self._timer = Timer()
+            self._timer.start(self._poll_interval, self._poll)
+        elif not waiting and self._timer is not None:
+            self._timer.stop()
+            self._timer = None
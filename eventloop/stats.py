@@ -0,0 +1,135 @@
+"""
+Counters and histograms of watch and schedule internals.
+Disabled by default: instrumented code checks `stats.current is not None` and does nothing else.
+Enable with EVENTLOOP_STATS=1 or loop.enable_stats().
+
+Names:
+    events_received - events reported by backend
+    events_filtered - events dropped by include/exclude patterns
+    events_overflow - inotify queue overflows (roots are reported for rescan)
+    schedule_coalesced - appended tasks merged into pending ones (dedup hits)
+    schedule_pending - histogram of pending tasks after append (queue depth)
+    execute_seconds - histogram of executor durations
+    walk_seconds - histogram of directory walk durations
+    server_reaped - processes of stopped server trees (server and its descendants)
+"""
+
+import json
+import math
+import os
+import sys
+import time
+
+class Histogram:
+    """
+    Counts values in power of two buckets, bucket key is exclusive upper bound of bucket.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.buckets = dict()
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value > 0:
+            bound = math.ldexp(1, math.frexp(value)[1])
+        else:
+            bound = 0
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count > 0 else None,
+            'buckets': {repr(bound): count for bound, count in sorted(self.buckets.items())},
+        }
+
+class Stats:
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = dict()
+        self.histograms = dict()
+
+    def incr(self, name, value = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+        histogram.add(value)
+
+    def reset(self):
+        self.started = time.time()
+        self.counters = dict()
+        self.histograms = dict()
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'counters': dict(self.counters),
+            'histograms': {name: h.as_dict() for name, h in self.histograms.items()},
+        }
+
+    def dump(self, file = None):
+        if file is None:
+            file = sys.stderr
+        print(json.dumps(self.as_dict()), file=file, flush=True)
+
+current = None
+
+def enable():
+    global current
+    if current is None:
+        current = Stats()
+    return current
+
+def disable():
+    global current
+    current = None
+
+def install_signal(signum = None, file = None):
+    """
+    Dumps stats as json line to file (stderr by default) on signal (SIGUSR1 by default, not available on Windows).
+    """
+    import signal
+    if signum is None:
+        signum = signal.SIGUSR1
+    def handler(signum, frame):
+        if current is not None:
+            current.dump(file)
+    signal.signal(signum, handler)
+
+class StatsLogger:
+    """
+    Dumps stats every interval seconds using loop timer.
+    """
+
+    def __init__(self, interval, file = None):
+        from . import Timer
+        self._file = file
+        self._timer = Timer()
+        self._timer.start(interval, self.on_timeout)
+
+    def on_timeout(self):
+        if current is not None:
+            current.dump(self._file)
+
+    def stop(self):
+        self._timer.stop()
+
+if os.environ.get('EVENTLOOP_STATS') == "1":
+    enable()
@@ -1,11 +1,25 @@
 import sys
-from .common import path_matches
-from . import EventLoop, on_file_changed
+from .common import path_matches, PathMatcher, walk, new_session_kwargs
+from . import EventLoop, on_file_changed, on_files_changed, Schedule, base, OVERFLOW_DROP_OLDEST, DEBOUNCE_LEADING, Timer, SingleShotTimer, PoolExecutor
+from .common import EVENT_CHANGE, EVENT_RENAME, ContentFilter, FileEvent, KIND_CHANGE, KIND_RENAME
+from .index import SnapshotIndex, default_index_path
+from .aio import awatch
+from .manager import WatchManager, PrefixTrie
+from . import stats
+from .budget import WatchBudget
+from . import FileSystemWatch
+from .pump import OutputPump
+from . import restart
+import threading
+import io
+import asyncio
 import unittest
 import time
 import tempfile
 from multiprocessing import Process
 import os
+import shutil
+import subprocess
 
 pjoin = os.path.join
 
@@ -33,6 +47,17 @@ def rmfiles(paths):
         except Exception as e:
             print(e)
 
+def qt_flavour():
+    from .common import get_flavour, FLAVOUR_PYSIDE2, FLAVOUR_PYQT5, FLAVOUR_PYSIDE6, FLAVOUR_PYQT6
+    return get_flavour() in [FLAVOUR_PYSIDE2, FLAVOUR_PYQT5, FLAVOUR_PYSIDE6, FLAVOUR_PYQT6]
+
+class PopenProcess(restart.Process):
+    def __init__(self, proc):
+        super().__init__(proc.pid)
+        self.proc = proc
+    def exited(self):
+        return self.proc.poll() is not None
+
 class TestEventLoop(unittest.TestCase):
     def test_terminate(self):
         tmp = mkdtemp()
@@ -79,7 +104,7 @@ class TestEventLoop(unittest.TestCase):
         os.rmdir(tmp)
         self.assertEqual(changed, expected)
 
-    def _test(self, tmp, ign, notign, recursive, include, exclude, expected):
+    def _test(self, tmp, ign, notign, recursive, include, exclude, expected, poll=False):
         paths = [
             pjoin(tmp, "file.c"),
             pjoin(tmp, "file.o"),
@@ -91,7 +116,7 @@ class TestEventLoop(unittest.TestCase):
         proc = Process(target=modify_files, args=(paths,))
         proc.start()
         changed = []
-        @on_file_changed(tmp, recursive=recursive, include=include, exclude=exclude, timeout=0.1, terminate_after=2)
+        @on_file_changed(tmp, recursive=recursive, include=include, exclude=exclude, timeout=0.1, terminate_after=2, poll=poll)
         def handler(path):
             changed.append(path)
         proc.join()
@@ -134,10 +159,1004 @@ class TestEventLoop(unittest.TestCase):
         ]
         self._test(tmp, ign, notign, recursive=False, include=['*.c'], exclude=None, expected=expected)
 
+    def test_poll(self):
+        tmp = mkdtemp()
+        ign = os.path.join(tmp, 'ign')
+        notign = os.path.join(tmp, 'notign')
+        expected = [
+            pjoin(tmp, "file.c"),
+            pjoin(notign, "file.c"),
+        ]
+        self._test(tmp, ign, notign, recursive=True, include=['*.c'], exclude=['ign'], expected=expected, poll=True)
+
     def test_path_matches(self):
         self.assertEqual(path_matches('/tmp/tmpxmkx1p7f/ign', include=['*.c'], exclude=['ign']), False)
         self.assertEqual(path_matches('/tmp/tmpxmkx1p7f/notign', include=['*.c'], exclude=['ign']), False)
         self.assertEqual(path_matches('/tmp/tmpxmkx1p7f/notign', include=None, exclude=['ign']), True)
 
+    def test_path_matcher(self):
+        paths = ['/tmp/x/ign', '/tmp/x/notign', '/tmp/ign/file.c', '/tmp/x/moc_file.cpp', '/tmp/x/file.o', '/tmp/build/file.c']
+        patterns = [None, [], ['*.c'], ['ign'], ['*/build/*'], ['moc_*', '*.o']]
+        for path in paths:
+            for include in patterns:
+                for exclude in patterns:
+                    self.assertEqual(PathMatcher(include, exclude).matches(path), path_matches(path, include, exclude))
+
+    def test_walk(self):
+        tmp = mkdtemp()
+        paths = [pjoin(tmp, "file.c"), pjoin(tmp, "file.o")]
+        for name in ["a", "b", "ign"]:
+            paths += [pjoin(tmp, name, "file.c"), pjoin(tmp, name, "sub", "file.c")]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('bump')
+        dirs, files = walk(tmp, ['*.c'], ['ign'], all_dirs=True)
+        self.assertEqual(sorted(files), sorted([p for p in paths if p.endswith('.c') and 'ign' not in p]))
+        self.assertNotIn(pjoin(tmp, "ign"), dirs)
+        self.assertEqual(walk(tmp, ['*.c'], ['ign'], all_dirs=True, workers=4), (dirs, files))
+        dirs, files = walk(tmp, ['*.c'], ['ign'], recursive=False)
+        self.assertEqual(files, [pjoin(tmp, "file.c")])
+        shutil.rmtree(tmp)
+
+    def test_schedule_overflow(self):
+        executed = []
+        executor = base.FuncExecutor(executed.append)
+        schedule = Schedule(executor, max_pending=3)
+        schedule.append(['a', 'b', 'a', 'c'], 1)
+        self.assertEqual(schedule.pending(), ['a', 'b', 'c'])
+        self.assertEqual(schedule.coalesced, 1)
+        schedule.append(['d', 'e'], 1)
+        self.assertEqual(schedule.pending(), [None])
+        self.assertEqual(schedule.coalesced, 5)
+        schedule.on_timeout()
+        self.assertEqual(executed, [None])
+        schedule._timer.stop()
+        schedule = Schedule(executor, max_pending=2, overflow=OVERFLOW_DROP_OLDEST)
+        schedule.append(['a', 'b', 'c'], 1)
+        self.assertEqual(schedule.pending(), ['b', 'c'])
+        self.assertEqual(schedule.dropped, 1)
+        schedule._timer.stop()
+
+    def test_overflow_rescan_root(self):
+        tmp = mkdtemp()
+        paths = [pjoin(tmp, "a.c"), pjoin(tmp, "b.c"), pjoin(tmp, "c.c")]
+        proc = Process(target=modify_files, args=(paths,))
+        proc.start()
+        changed = []
+        @on_file_changed(tmp, timeout=1, max_pending=2, terminate_after=2)
+        def handler(path):
+            changed.append(path)
+        proc.join()
+        rmfiles(paths)
+        os.rmdir(tmp)
+        self.assertEqual(changed, [tmp])
+
+    def test_schedule_batch(self):
+        batches = []
+        executor = base.FuncBatchExecutor(batches.append)
+        schedule = Schedule(executor)
+        schedule.append('a', 1, EVENT_CHANGE)
+        schedule.append('b', 1, EVENT_RENAME)
+        schedule.append('a', 1, EVENT_RENAME)
+        schedule.on_timeout()
+        schedule._timer.stop()
+        self.assertEqual([{task: set(record) for task, record in batch.items()} for batch in batches], [{'a': {EVENT_CHANGE, EVENT_RENAME}, 'b': {EVENT_RENAME}}])
+
+    def test_file_event(self):
+        batches = []
+        schedule = Schedule(base.FuncBatchExecutor(batches.append))
+        schedule.append('a', 1, FileEvent('a', KIND_CHANGE))
+        schedule.append('a', 1, FileEvent('a', KIND_RENAME, old_path='b'))
+        schedule.on_timeout()
+        schedule._timer.stop()
+        record = batches[0]['a']
+        self.assertEqual(record.kinds, KIND_CHANGE | KIND_RENAME)
+        self.assertEqual(record.old_path, 'b')
+        self.assertIn(EVENT_CHANGE, record)
+
+    def test_rename(self):
+        from . import poll
+        tmp = mkdtemp()
+        src, dst = pjoin(tmp, "a.c"), pjoin(tmp, "b.c")
+        with open(src, 'w') as f:
+            f.write('a')
+        events = []
+        watch = poll.FileSystemWatch(None)
+        watch.start(tmp, lambda path, event: events.append(event), recursive=True, timer=False)
+        os.rename(src, dst)
+        os.utime(tmp, ns=(0, 0))
+        watch.tick()
+        shutil.rmtree(tmp)
+        renamed = [e for e in events if e.path == dst]
+        self.assertEqual(len(renamed), 1)
+        self.assertEqual(renamed[0].old_path, src)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is linux only")
+    def test_inotify_create(self):
+        from . import inotify
+        tmp = mkdtemp()
+        events = []
+        watch = inotify.FileSystemWatch(inotify.EventLoop())
+        watch.start(tmp, lambda path, event: events.append(event), recursive=True)
+        os.makedirs(pjoin(tmp, "a", "b"))
+        path = pjoin(tmp, "a", "b", "file.c")
+        with open(path, 'w') as f:
+            f.write('a')
+        watch.onReadable()
+        watch.onReadable()
+        with open(path, 'a') as f:
+            f.write('b')
+        watch.onReadable()
+        watched = pjoin(tmp, "a", "b") in watch._path_to_wd
+        watch.stop()
+        shutil.rmtree(tmp)
+        self.assertTrue(watched)
+        self.assertGreater(len(events), 1)
+        self.assertEqual([e.path for e in events], [path] * len(events))
+        self.assertTrue(any(KIND_CHANGE & e.kinds for e in events[1:]))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is linux only")
+    def test_inotify_file_replace(self):
+        # file root survives atomic saves (temp file renamed over it), other files of directory are not reported
+        from . import inotify
+        tmp = mkdtemp()
+        path = pjoin(tmp, "app.py")
+        with open(path, 'w') as f:
+            f.write('a')
+        events = []
+        watch = inotify.FileSystemWatch(inotify.EventLoop())
+        watch.start(path, lambda path_, event: events.append(path_))
+        for content in ['b', 'c']:
+            with open(path + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+            watch.onReadable()
+            self.assertEqual(events, [path])
+            events.clear()
+        with open(path, 'a') as f:
+            f.write('d')
+        watch.onReadable()
+        watch.stop()
+        shutil.rmtree(tmp)
+        self.assertEqual(set(events), {path})
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is linux only")
+    def test_inotify_move(self):
+        from . import inotify
+        tmp = mkdtemp()
+        os.makedirs(pjoin(tmp, "a"))
+        src, dst = pjoin(tmp, "a.c"), pjoin(tmp, "a", "b.c")
+        with open(src, 'w') as f:
+            f.write('a')
+        events = []
+        watch = inotify.FileSystemWatch(inotify.EventLoop())
+        watch.start(tmp, lambda path, event: events.append(event), recursive=True)
+        os.rename(src, dst)
+        watch.onReadable()
+        watch.stop()
+        shutil.rmtree(tmp)
+        moved = [e for e in events if e.path == dst]
+        self.assertEqual(len(moved), 1)
+        self.assertEqual(moved[0].old_path, src)
+        self.assertTrue(moved[0].kinds & KIND_RENAME)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is linux only")
+    def test_inotify_overflow(self):
+        from . import inotify
+        tmp = mkdtemp()
+        events = []
+        watch = inotify.FileSystemWatch(inotify.EventLoop())
+        watch.start(tmp, lambda path, event: events.append(event), recursive=True)
+        # events of new directory are lost in overflow
+        os.makedirs(pjoin(tmp, "a"))
+        os.read(watch._fd, 64 * 1024)
+        watch._onData(inotify._EVENT.pack(-1, inotify.IN_Q_OVERFLOW, 0, 0))
+        watched = pjoin(tmp, "a") in watch._path_to_wd
+        # directory is watched again after rescan
+        with open(pjoin(tmp, "a", "file.c"), 'w') as f:
+            f.write('a')
+        watch.onReadable()
+        watch.stop()
+        shutil.rmtree(tmp)
+        self.assertTrue(watched)
+        self.assertEqual(events[0].path, tmp)
+        self.assertTrue(events[0].is_dir)
+        self.assertIn(pjoin(tmp, "a", "file.c"), [e.path for e in events[1:]])
+
+    @unittest.skipUnless(qt_flavour(), "needs Qt")
+    def test_qt_replace(self):
+        from . import qt
+        tmp = mkdtemp()
+        path = pjoin(tmp, "a.c")
+        with open(path, 'w') as f:
+            f.write('a')
+        changed = []
+        loop = EventLoop()
+        watch = qt.FileSystemWatch(loop)
+        watch.start(tmp, lambda path_, event: changed.append(path_), recursive=True)
+
+        def replace():
+            # atomic save: qt drops watch of replaced inode
+            with open(path + '.tmp', 'w') as f:
+                f.write('b')
+            os.replace(path + '.tmp', path)
+
+        def modify():
+            changed.clear()
+            with open(path, 'a') as f:
+                f.write('c')
+
+        timers = [SingleShotTimer(), SingleShotTimer(), SingleShotTimer()]
+        timers[0].start(0.3, replace)
+        timers[1].start(0.8, modify)
+        timers[2].start(1.5, lambda: loop.stop())
+        loop.start()
+        watch.stop()
+        shutil.rmtree(tmp)
+        self.assertIn(path, changed)
+
+    @unittest.skipUnless(qt_flavour(), "needs Qt")
+    def test_qt_threaded(self):
+        from . import qt
+        tmp = mkdtemp()
+        paths = [pjoin(tmp, "a.c"), pjoin(tmp, "sub", "b.c")]
+        os.makedirs(pjoin(tmp, "sub"))
+        with open(paths[0], 'w') as f:
+            f.write('a')
+        changed = []
+        threads = set()
+        def callback(path, event):
+            changed.append(path)
+            threads.add(threading.current_thread())
+        loop = EventLoop()
+        watch = FileSystemWatch(loop, threaded=True)
+        self.assertIsInstance(watch, qt.ThreadedFileSystemWatch)
+        watch.start(tmp, callback, recursive=True)
+
+        def modify():
+            with open(paths[0], 'a') as f:
+                f.write('b')
+            with open(paths[1], 'w') as f:
+                f.write('b')
+
+        timers = [SingleShotTimer(), SingleShotTimer()]
+        timers[0].start(0.5, modify)
+        timers[1].start(1.5, lambda: loop.stop())
+        loop.start()
+        watch.stop()
+        shutil.rmtree(tmp)
+        for path in paths:
+            self.assertIn(path, changed)
+        # batches are delivered on main thread
+        self.assertEqual(threads, {threading.main_thread()})
+
+    def test_watch_budget(self):
+        tmp = mkdtemp()
+        paths = [pjoin(tmp, "file.c"), pjoin(tmp, "a", "b", "c", "d", "file.c")]
+        os.makedirs(os.path.dirname(paths[1]))
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write('a')
+        loop = EventLoop()
+        budget = WatchBudget(limit=3, reserve=0, in_use=0)
+        watch = FileSystemWatch(loop)
+        watch.budget = budget
+        changed = set()
+        watch.start(tmp, lambda path, event: changed.add(path), recursive=True)
+        self.assertEqual(budget.in_use, 3)
+        self.assertEqual(budget.left, 0)
+        self.assertGreater(budget.polled, 0)
+        proc = Process(target=modify_files, args=(paths,))
+        proc.start()
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(2, loop.stop)
+        loop.start()
+        proc.join()
+        watch.stop()
+        shutil.rmtree(tmp)
+        self.assertEqual(budget.in_use, 0)
+        self.assertEqual(changed, set(paths))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is linux only")
+    def test_inotify_enospc(self):
+        # kernel refuses watch (other processes of user took the rest), rest of tree is polled
+        from . import inotify
+        tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        os.makedirs(pjoin(tmp, "a", "b", "c"))
+        loop = EventLoop()
+        budget = WatchBudget(limit=1000, reserve=10, in_use=0)
+        watch = inotify.FileSystemWatch(loop)
+        watch.budget = budget
+        add_watch = watch._addWatch
+        watch._addWatch = lambda path: len(watch._path_to_wd) < 2 and add_watch(path)
+        watch.start(tmp, lambda path, event: None, recursive=True)
+        try:
+            self.assertEqual(budget.in_use, 2)
+            self.assertEqual(budget.left, 0)
+            self.assertGreater(budget.polled, 0)
+        finally:
+            watch.stop()
+        self.assertEqual(budget.in_use, 0)
+        self.assertEqual(budget.left, 2)
+
+    def test_batch(self):
+        tmp = mkdtemp()
+        paths = [pjoin(tmp, "file1.c"), pjoin(tmp, "file2.c")]
+        proc = Process(target=modify_files, args=(paths,))
+        proc.start()
+        changed = []
+        @on_files_changed(tmp, timeout=0.5, terminate_after=2)
+        def handler(batch):
+            changed.append(sorted(batch))
+        proc.join()
+        rmfiles(paths)
+        os.rmdir(tmp)
+        self.assertEqual(changed, [paths])
+
+    def _test_debounce(self, **kwargs):
+        loop = EventLoop()
+        executed = []
+        schedule = Schedule(base.FuncExecutor(lambda task: executed.append((task, time.time()))), **kwargs)
+        t1 = time.time()
+        count = [0]
+        def append():
+            count[0] += 1
+            if count[0] <= 10:
+                schedule.append(count[0], 0.3)
+        timer = Timer()
+        timer.start(0.1, append)
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(2, loop.stop)
+        loop.start()
+        timer.stop()
+        return [(task, t - t1) for task, t in executed]
+
+    def test_debounce_trailing(self):
+        executed = self._test_debounce()
+        self.assertEqual([task for task, t in executed], list(range(1, 11)))
+        self.assertGreater(executed[0][1], 1.2)
+
+    def test_debounce_leading(self):
+        executed = self._test_debounce(debounce=DEBOUNCE_LEADING)
+        self.assertLess(executed[0][1], 0.2)
+        self.assertEqual([task for task, t in executed], list(range(1, 11)))
+
+    def test_debounce_max_wait(self):
+        executed = self._test_debounce(max_wait=0.5)
+        self.assertLess(executed[0][1], 0.7)
+        self.assertEqual([task for task, t in executed], list(range(1, 11)))
+
+    def test_pool_executor(self):
+        loop = EventLoop()
+        attempts = dict()
+        done = []
+        def execute(task):
+            attempts[task] = attempts.get(task, 0) + 1
+            time.sleep(0.2)
+            if task == 'b' and attempts[task] < 3:
+                return False
+            done.append(task)
+        executor = PoolExecutor(base.FuncExecutor(execute), max_workers=2)
+        schedule = Schedule(executor, retry_timeout=0.1)
+        schedule.append(['a', 'b'], 0.1)
+        t1 = time.time()
+        blocked = []
+        def check():
+            # loop is not blocked by running tasks
+            blocked.append(time.time() - t1)
+        timer = SingleShotTimer()
+        timer.start(0.2, check)
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(1.5, loop.stop)
+        loop.start()
+        executor.shutdown()
+        self.assertLess(blocked[0], 0.25)
+        self.assertEqual(attempts, {'a': 1, 'b': 3})
+        self.assertEqual(sorted(done), ['a', 'b'])
+
+    def test_pool_executor_exception(self):
+        import contextlib
+        calls = []
+        def execute(task):
+            calls.append(task)
+            raise ValueError("broken handler")
+        loop = EventLoop()
+        executor = PoolExecutor(base.FuncExecutor(execute), max_workers=1)
+        schedule = Schedule(executor, retry_timeout=0.1)
+        schedule.append('a', 0.1)
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(1, loop.stop)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            loop.start()
+        executor.shutdown()
+        # reported with traceback and not retried
+        self.assertEqual(calls, ['a'])
+        self.assertIn("handler failed for 'a'", err.getvalue())
+        self.assertIn("ValueError: broken handler", err.getvalue())
+        self.assertIn("Traceback", err.getvalue())
+        # handler that can't reach process pool is rejected when executor is built
+        with self.assertRaises(ValueError):
+            PoolExecutor(base.FuncExecutor(lambda task: True), processes=True)
+
+    def test_async_func_executor(self):
+        from .common import use_qasync
+        async def handler(task):
+            return True
+        if not use_qasync():
+            # nothing would run asyncio loop, handler would never finish
+            with self.assertRaises(RuntimeError):
+                base.AsyncFuncExecutor(handler)
+        results = []
+        async def main():
+            executor = base.AsyncFuncExecutor(handler)
+            executor.submit('a', results.append)
+            await asyncio.sleep(0.1)
+        asyncio.run(main())
+        self.assertEqual(results, [True])
+
+    def test_content_filter(self):
+        tmp = mkdtemp()
+        path = pjoin(tmp, "file.c")
+        with open(path, 'w') as f:
+            f.write('abc')
+        content_filter = ContentFilter(max_entries=1)
+        self.assertTrue(content_filter.changed(path))
+        self.assertFalse(content_filter.changed(path))
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertFalse(content_filter.changed(path))
+        with open(path, 'w') as f:
+            f.write('abd')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+        self.assertTrue(content_filter.changed(path))
+        # size changed, then touched without changing content
+        with open(path, 'w') as f:
+            f.write('abde')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 3 * 10 ** 9))
+        self.assertTrue(content_filter.changed(path))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 4 * 10 ** 9))
+        self.assertFalse(content_filter.changed(path))
+        self.assertEqual(content_filter.suppressed, 3)
+        self.assertTrue(content_filter.changed(tmp))
+        self.assertTrue(content_filter.changed(pjoin(tmp, "missing.c")))
+        os.remove(path)
+        self.assertTrue(content_filter.changed(path))
+        os.rmdir(tmp)
+
+    def test_content_filter_initial(self):
+        # files are hashed when watch starts, first touch of unchanged file is not reported
+        tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        paths = [pjoin(tmp, "a.c"), pjoin(tmp, "b.c")]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write('abc')
+        changed = []
+        loop = EventLoop()
+
+        @on_file_changed(tmp, loop=loop, timeout=0.1, content_filter=True)
+        def handler(path):
+            changed.append(path)
+
+        def touch():
+            for path in paths:
+                st = os.stat(path)
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            with open(paths[1], 'a') as f:
+                f.write('d')
+
+        timers = [SingleShotTimer(), SingleShotTimer()]
+        timers[0].start(0.3, touch)
+        timers[1].start(1, lambda: loop.stop())
+        loop.start()
+        self.assertEqual(changed, [paths[1]])
+
+        content_filter = ContentFilter(max_entries=1)
+        content_filter.add(paths)
+        self.assertFalse(content_filter.changed(paths[0]))
+        self.assertTrue(content_filter.changed(paths[1]))
+
+    def test_index(self):
+        tmp = mkdtemp()
+        cache = mkdtemp()
+        environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = cache
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.pop, 'XDG_CACHE_HOME', None)
+        self.addCleanup(shutil.rmtree, cache)
+        paths = [pjoin(tmp, "file.c"), pjoin(tmp, "file.o"), pjoin(tmp, "a", "file.c"), pjoin(tmp, "b", "file.c")]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('bump')
+        index = SnapshotIndex(tmp, include=['*.c'])
+        self.assertEqual(index.scan(), [])
+        index.save()
+        # index is in cache dir, parent of watched tree is not touched
+        self.assertEqual(os.path.dirname(default_index_path(tmp)), pjoin(cache, 'eventloop'))
+        self.assertTrue(os.path.exists(default_index_path(tmp)))
+        self.assertNotEqual(default_index_path(tmp), default_index_path(pjoin(tmp, 'a', '..', 'b')))
+        self.assertEqual([name for name in os.listdir(os.path.dirname(tmp)) if 'eventloop' in name], [])
+        with open(paths[0], 'a') as f:
+            f.write('bump')
+        with open(paths[1], 'a') as f:
+            f.write('bump')
+        os.remove(paths[2])
+        os.makedirs(pjoin(tmp, "c"))
+        with open(pjoin(tmp, "c", "file.c"), 'w') as f:
+            f.write('bump')
+        changes = SnapshotIndex(tmp, include=['*.c']).scan()
+        self.assertEqual(sorted(changes), sorted([
+            (paths[0], EVENT_CHANGE),
+            (paths[2], EVENT_RENAME),
+            (pjoin(tmp, "c", "file.c"), EVENT_RENAME),
+        ]))
+        self.assertEqual(SnapshotIndex(tmp, include=['*.h']).scan(), [])
+        os.remove(default_index_path(tmp))
+        shutil.rmtree(tmp)
+
+    def test_index_save_not_postponed(self):
+        # index is saved index_save_timeout after first change even if changes keep coming
+        tmp = mkdtemp()
+        cache = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        self.addCleanup(shutil.rmtree, tmp)
+        index_path = pjoin(cache, "index")
+        path = pjoin(tmp, "file.c")
+        with open(path, 'w') as f:
+            f.write('bump')
+        loop = EventLoop()
+
+        @on_file_changed(tmp, loop=loop, index=index_path, index_save_timeout=0.3, timeout=0.05)
+        def handler(path):
+            pass
+
+        mtime = os.stat(index_path).st_mtime_ns
+        saved = []
+
+        def bump():
+            with open(path, 'a') as f:
+                f.write('bump')
+
+        def check():
+            saved.append(os.stat(index_path).st_mtime_ns)
+            loop.stop()
+
+        bump_timer = Timer()
+        bump_timer.start(0.1, bump)
+        check_timer = SingleShotTimer()
+        check_timer.start(1.2, check)
+        loop.start()
+        bump_timer.stop()
+        self.assertNotEqual(saved, [mtime])
+
+    def _test_awatch(self, poll):
+        tmp = mkdtemp()
+        paths = [pjoin(tmp, "file.c"), pjoin(tmp, "sub", "file.c"), pjoin(tmp, "file.o")]
+        async def main():
+            batches = []
+            async def consume():
+                async for batch in awatch(tmp, exclude=['*.o'], debounce=0.5, poll=poll):
+                    batches.append(sorted(batch))
+                    break
+            task = asyncio.ensure_future(asyncio.wait_for(consume(), 5))
+            await asyncio.sleep(0.5)
+            proc = Process(target=modify_files, args=(paths,))
+            proc.start()
+            await task
+            await asyncio.get_running_loop().run_in_executor(None, proc.join)
+            return batches
+        batches = asyncio.run(main())
+        self.assertEqual(batches, [sorted(paths[:2])])
+        shutil.rmtree(tmp)
+
+    def test_awatch(self):
+        self._test_awatch(False)
+
+    def test_awatch_poll(self):
+        self._test_awatch(True)
+
+    def test_awatch_budget(self):
+        # paths over budget are polled by fallback, its timer runs on asyncio loop
+        from . import budget as watch_budget
+        default = watch_budget._default
+        watch_budget._default = WatchBudget(limit=1, reserve=0, in_use=0)
+        try:
+            self._test_awatch(False)
+            self.assertGreater(watch_budget._default.polled, 0)
+            self.assertEqual(watch_budget._default.in_use, 0)
+        finally:
+            watch_budget._default = default
+
+    def test_watch_manager(self):
+        tmp = os.path.realpath(mkdtemp())
+        sub = pjoin(tmp, "sub")
+        os.makedirs(sub)
+        paths = [pjoin(tmp, "file.c"), pjoin(tmp, "file.h"), pjoin(sub, "file.c"), pjoin(sub, "deep", "file.c")]
+        proc = Process(target=modify_files, args=(paths,))
+        proc.start()
+        loop = EventLoop()
+        manager = WatchManager(loop)
+        changed = {'all': [], 'c': [], 'sub': []}
+        manager.add(tmp, changed['all'].append, timeout=0.1)
+        manager.add(tmp, changed['c'].append, include=['*.c'], timeout=0.1)
+        manager.add(sub, changed['sub'].append, recursive=False, timeout=0.1)
+        self.assertEqual(manager._plan(), [(tmp, True, [])])
+        manager.start()
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(2, loop.stop)
+        loop.start()
+        proc.join()
+        shutil.rmtree(tmp)
+        self.assertEqual(changed['all'], paths)
+        self.assertEqual(changed['c'], [paths[0], paths[2], paths[3]])
+        self.assertEqual(changed['sub'], [paths[2]])
+
+    def test_prefix_trie(self):
+        trie = PrefixTrie()
+        trie.add('/a', 1)
+        trie.add('/a/b', 2)
+        trie.add('/ab', 3)
+        self.assertEqual(trie.find('/a/b/c'), [1, 2])
+        self.assertEqual(trie.find('/ab/c'), [3])
+        self.assertEqual(trie.find('/c'), [])
+
+    def test_stats(self):
+        self.assertIsNone(stats.current)
+        executor = base.FuncExecutor(lambda task: None)
+        schedule = Schedule(executor)
+        loop = EventLoop()
+        loop.enable_stats()
+        try:
+            schedule.append(['a', 'b', 'a'], 1)
+            schedule.on_timeout()
+            schedule._timer.stop()
+            tmp = mkdtemp()
+            walk(tmp, [], [])
+            res = loop.stats.as_dict()
+        finally:
+            stats.disable()
+        os.rmdir(tmp)
+        self.assertEqual(res['counters'], {'schedule_coalesced': 1})
+        self.assertEqual(res['histograms']['schedule_pending']['max'], 2)
+        self.assertEqual(res['histograms']['execute_seconds']['count'], 1)
+        self.assertEqual(res['histograms']['walk_seconds']['count'], 1)
+        self.assertIsNone(loop.stats)
+
+    def test_import_time(self):
+        # backends, bindings and cli extras must not be imported with package
+        code = "import sys, time; t = time.perf_counter(); import eventloop.onchange; print(time.perf_counter() - t); print(' '.join(sys.modules))"
+        proc = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        seconds, modules = proc.stdout.splitlines()
+        modules = modules.split(' ')
+        for name in ['eventloop.uv', 'eventloop.qt', 'eventloop.qta', 'eventloop.inotify', 'pyuv', 'PySide6', 'PyQt6', 'PySide2', 'PyQt5', 'qasync', 'colorama', 'chime']:
+            self.assertNotIn(name, modules)
+        self.assertLess(float(seconds), 0.5)
+        # asyncio, pools, servers and watch budget are imported when used
+        code = "import sys, eventloop; print(' '.join(sys.modules))"
+        proc = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        modules = proc.stdout.split()
+        for name in ['asyncio', 'concurrent.futures', 'subprocess', 'hashlib', 'eventloop.aio', 'eventloop.budget', 'eventloop.pump', 'eventloop.restart']:
+            self.assertNotIn(name, modules)
+
+    def test_onchange_args(self):
+        from .onchange import make_parser
+        parser = make_parser()
+        # options between src and cmd
+        args = parser.parse_intermixed_args(['src', '-i', '*.c', '*.h', '-t', '0.5', '--restart-on-change', '--', 'make', '&&', 'make', 'test'])
+        self.assertEqual(args.src, 'src')
+        self.assertEqual(args.include, ['*.c', '*.h'])
+        self.assertEqual(args.timeout, 0.5)
+        self.assertTrue(args.restart_on_change)
+        self.assertEqual(args.cmd, ['make', '&&', 'make', 'test'])
+        args = parser.parse_intermixed_args(['src', '--server', '--preload', 'numpy', '--', 'python', '-u', 'app.py'])
+        self.assertEqual(args.src, 'src')
+        self.assertEqual(args.preload, ['numpy'])
+        self.assertEqual(args.cmd, ['python', '-u', 'app.py'])
+        # src and cmd are optional with --rules
+        args = parser.parse_intermixed_args(['--rules', 'onchange.json', '-j', '4'])
+        self.assertIsNone(args.src)
+        self.assertEqual(args.cmd, [])
+        self.assertEqual(args.jobs, 4)
+
+    def test_rules(self):
+        from .onchange.rules import Rule, Rules, RulesExecutor
+        tmp = mkdtemp()
+        log = pjoin(tmp, 'log.txt')
+        def cmd(name, code = 0):
+            return [sys.executable, '-c', "import sys; open({!r}, 'a').write({!r}); sys.exit({})".format(log, name + ' ', code)]
+        rules = Rules([
+            Rule('test', cmd('test'), include=['*.py'], deps=['gen']),
+            Rule('gen', cmd('gen'), include=['*.proto'], outputs=['gen/*']),
+            Rule('lint', cmd('lint', 1), include=['*.py']),
+            Rule('docs', cmd('docs'), include=['*.md'], deps=['lint']),
+        ], root=tmp)
+        self.assertEqual([rule.name for rule in rules.rules], ['gen', 'test', 'lint', 'docs'])
+        self.assertEqual(rules.dirty([pjoin(tmp, 'a.proto'), pjoin(tmp, 'gen', 'a.py')]), {'gen': [pjoin(tmp, 'a.proto')], 'test': []})
+        loop = EventLoop()
+        results = []
+        executor = RulesExecutor(rules, base.Logger(), on_done=results.append)
+        batch = {pjoin(tmp, 'a.proto'): None, pjoin(tmp, 'b.py'): None}
+        timer = SingleShotTimer()
+        timer.start(0, lambda: executor.submit(batch, lambda res: loop.stop()))
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(5, loop.stop)
+        loop.start()
+        terminate_timer.stop()
+        with open(log) as f:
+            ran = f.read().split()
+        shutil.rmtree(tmp)
+        self.assertEqual(results, [False])
+        self.assertEqual(sorted(ran), ['gen', 'lint', 'test'])
+        self.assertLess(ran.index('gen'), ran.index('test'))
+
+    def test_chain_runner(self):
+        from .onchange import ChainRunner
+        tmp = mkdtemp()
+        log = pjoin(tmp, 'log.txt')
+        def cmd(name, code = 0, sleep = 0):
+            return [sys.executable, '-c', "import os, sys, time; open({!r}, 'a').write({!r} + str(os.getpid()) + ' '); time.sleep({}); sys.exit({})".format(log, name + ':', sleep, code)]
+        loop = EventLoop()
+        results = []
+        runner = ChainRunner(base.Logger(), on_done=results.append)
+        # first chain is killed in the middle of slow command, && stops second one on failure
+        runner.restart([cmd('slow', sleep=30), cmd('after-slow')])
+        timer = SingleShotTimer()
+        timer.start(0.5, lambda: runner.restart([cmd('fail', 1), cmd('after-fail'), cmd('never')]))
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(2, loop.stop)
+        loop.start()
+        runner.kill()
+        with open(log) as f:
+            ran = dict(item.split(':') for item in f.read().split())
+        shutil.rmtree(tmp)
+        self.assertEqual(sorted(ran), ['fail', 'slow'])
+        self.assertFalse(restart._alive(int(ran['slow'])))
+        self.assertEqual(results, [False])
+
+    def test_output_pump(self):
+        out = io.BytesIO()
+        pump = OutputPump(max_buffer=16, ring_size=10, labels=True, stdout=out, stderr=io.BytesIO())
+        pump.write('srv', b'hel')
+        self.assertEqual(out.getvalue(), b'')
+        pump.write('srv', b'lo\nwor')
+        self.assertEqual(out.getvalue(), b'[srv] hello\n')
+        pump.write('srv', b'ld\n')
+        pump.flush()
+        expected = b'[srv] hello\n[srv] world\n'
+        self.assertEqual(out.getvalue(), expected)
+        self.assertEqual(pump.recent('srv'), expected[-10:])
+
+    def test_output_pump_blocked_sink(self):
+
+        class Sink(io.BytesIO):
+            def __init__(self):
+                super().__init__()
+                self.entered = threading.Event()
+                self.release = threading.Event()
+            def write(self, data):
+                self.entered.set()
+                self.release.wait(5)
+                return super().write(data)
+
+        out = Sink()
+        pump = OutputPump(max_buffer=4, stdout=out, stderr=io.BytesIO())
+        writer = threading.Thread(target=pump.write, args=('srv', b'one\n'))
+        writer.start()
+        self.assertTrue(out.entered.wait(5))
+        # sink is blocked in other thread, write only buffers
+        started = time.monotonic()
+        pump.write('srv', b'two\n')
+        pump.flush()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(pump.recent('srv'), b'one\ntwo\n')
+        out.release.set()
+        writer.join()
+        self.assertEqual(out.getvalue(), b'one\ntwo\n')
+
+    def test_server_inherits_stdio(self):
+        from . import ps
+        server = ps.Server()
+        loop = EventLoop()
+        server.restart([sys.executable, '-c', 'import time; time.sleep(30)'])
+        try:
+            self.assertIsNone(server._restarter.current.proc.stdout)
+            self.assertEqual(server.recent_output(), b'')
+        finally:
+            server.stop()
+        server = ps.Server(probe=restart.OutputProbe('ready'))
+        server.restart([sys.executable, '-c', 'import os; print(os.environ.get("PYTHONUNBUFFERED"))'])
+        try:
+            process = server._restarter.current
+            process.proc.wait()
+            time.sleep(0.2)
+            self.assertEqual(server.recent_output().strip(), b'1')
+        finally:
+            server.stop()
+
+    def test_restart_handover(self):
+
+        processes = []
+        output = []
+
+        threads = []
+
+        def read(process):
+            with process.proc.stdout as pipe:
+                for line in pipe:
+                    output.append(line)
+                    restarter.feed(process, line)
+
+        def spawn(cmd, cwd, env, pass_fds):
+            proc = subprocess.Popen(cmd, cwd=cwd, env=env, pass_fds=pass_fds, stdout=subprocess.PIPE, **new_session_kwargs())
+            process = PopenProcess(proc)
+            processes.append(process)
+            thread = threading.Thread(target=read, args=(process,), daemon=True)
+            thread.start()
+            threads.append(thread)
+            return process
+
+        # port 0 binds random port
+        restarter = restart.Restarter(spawn, restart.RESTART_HANDOVER, grace=1, probe=restart.OutputProbe('ready'), listen=0)
+        port = restarter.socket().getsockname()[1]
+        code = "import eventloop, time; sock = eventloop.inherited_socket(); time.sleep(0.3); print('ready', sock.getsockname()[1], flush=True); time.sleep(10)"
+        cmd = [sys.executable, '-c', code]
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        loop = EventLoop()
+        restarter.restart(cmd, cwd)
+        timer = SingleShotTimer()
+        timer.start(0.5, lambda: restarter.restart(cmd, cwd))
+        # old process is still running while new one is not ready
+        check_timer = SingleShotTimer()
+        check_timer.start(0.6, lambda: self.assertTrue(processes[0].running()))
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(2, lambda: loop.stop())
+        loop.start()
+
+        first, second = processes
+        try:
+            self.assertFalse(first.running())
+            self.assertTrue(second.running())
+            self.assertIs(restarter.current, second)
+            self.assertEqual(output, ['ready {}\n'.format(port).encode()] * 2)
+        finally:
+            second.kill()
+            second.proc.wait()
+            restarter.socket().close()
+            # readers close pipes at end of output
+            for thread in threads:
+                thread.join(5)
+
+    def test_restart_crash(self):
+        # server that exits on its own is detached from pump and forgotten without restart
+        from . import ps
+        out = io.BytesIO()
+        pump = OutputPump(stdout=out)
+        codes = []
+        server = ps.Server(pump=pump, on_exit=lambda code: codes.append((code, server.recent_output())))
+        loop = EventLoop()
+        server.restart([sys.executable, '-c', 'import sys; print("crash"); sys.exit(3)'])
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(1, lambda: loop.stop())
+        loop.start()
+        self.assertIsNone(server._restarter.current)
+        self.assertEqual(server.exit_code(), 3)
+        self.assertEqual(len(pump._attached), 0)
+        self.assertIsNone(pump._timer)
+        self.assertEqual(out.getvalue(), b'crash\n')
+        self.assertEqual(codes, [(3, b'crash\n')])
+
+    def test_restart_tree(self):
+        processes = []
+
+        def spawn(cmd, cwd, env, pass_fds):
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True, **new_session_kwargs())
+            process = PopenProcess(proc)
+            processes.append(process)
+            return process
+
+        # wrapper leaves grandchild that must be killed with it
+        code = "import subprocess, sys, time; child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)']); print(child.pid, flush=True); time.sleep(30)"
+        cmd = [sys.executable, '-c', code]
+        restarter = restart.Restarter(spawn)
+
+        loop = EventLoop()
+        restarter.restart(cmd)
+        timer = SingleShotTimer()
+        timer.start(0.5, lambda: restarter.restart(cmd))
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(1.5, lambda: loop.stop())
+        loop.start()
+
+        first, second = processes
+        try:
+            grandchild = int(first.proc.stdout.readline())
+            self.assertFalse(first.running())
+            self.assertEqual(first.tree, {grandchild})
+            self.assertEqual(restarter.reaped, 2)
+            self.assertTrue(second.running())
+        finally:
+            second.kill()
+            second.proc.wait()
+            for process in processes:
+                process.proc.stdout.close()
+
+    def test_restart_reaped_leader(self):
+        # leader exits leaving child in its group, group is killed without signalling reaped pid
+        code = "import subprocess, sys; subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])"
+        proc = subprocess.Popen([sys.executable, '-c', code], **new_session_kwargs())
+        proc.wait()
+        process = PopenProcess(proc)
+        self.assertTrue(process.running())
+        process.kill()
+        self.assertEqual(process.tree, set())
+        deadline = time.monotonic() + 5
+        while process.running() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(process.running())
+
+    def test_zygote(self):
+        from . import ps, zygote
+        self.assertEqual(zygote.split_cmd(['python3', '-u', '-m', 'http.server']), (['python3', '-u'], ['-m', 'http.server']))
+        self.assertEqual(zygote.split_cmd(['python', 'app.py', '-u']), (['python'], ['app.py', '-u']))
+        self.assertIsNone(zygote.split_cmd(['python', '-c', 'pass']))
+        self.assertIsNone(zygote.split_cmd(['node', 'app.js']))
+
+        tmp = mkdtemp()
+        with open(pjoin(tmp, 'app.py'), 'w') as f:
+            f.write("import sys, time; print(sys.argv, 'xml.dom.minidom' in sys.modules, flush=True); time.sleep(30)\n")
+        out = io.BytesIO()
+        server = ps.Server(pump=OutputPump(stdout=out), preload=['xml.dom.minidom'])
+        cmd = [sys.executable, '-u', 'app.py', 'arg']
+
+        loop = EventLoop()
+        server.restart(cmd, cwd=tmp)
+        timer = SingleShotTimer()
+        timer.start(1, lambda: server.restart(cmd, cwd=tmp))
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(2, lambda: loop.stop())
+        loop.start()
+        try:
+            # second run is taken from spare started by first one
+            self.assertEqual(out.getvalue().decode().splitlines(), ["['app.py', 'arg'] True"] * 2)
+            self.assertIsNotNone(server._spare)
+        finally:
+            server.stop()
+            shutil.rmtree(tmp)
+
+    @unittest.skipUnless(qt_flavour(), "needs Qt")
+    def test_qt_spare_send_failed(self):
+        from . import qt
+        tmp = mkdtemp()
+        with open(pjoin(tmp, 'app.py'), 'w') as f:
+            f.write("import sys; print(sys.argv, flush=True)\n")
+        out = io.BytesIO()
+        server = qt.Server(pump=OutputPump(stdout=out), preload=['json'])
+        cmd = [sys.executable, '-u', 'app.py', 'arg']
+
+        def restart():
+            # spare dies after it is checked, command is started cold
+            spare = server._spare
+            spare.exited = lambda: False
+            spare.process.close()
+            server.restart(cmd, cwd=tmp)
+
+        loop = EventLoop()
+        server.restart(cmd, cwd=tmp)
+        timer = SingleShotTimer()
+        timer.start(1, restart)
+        terminate_timer = SingleShotTimer()
+        terminate_timer.start(2.5, lambda: loop.stop())
+        loop.start()
+        try:
+            self.assertEqual(out.getvalue().decode().splitlines(), ["['app.py', 'arg']"] * 2)
+        finally:
+            server.stop()
+            shutil.rmtree(tmp)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
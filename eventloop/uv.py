@@ -1,5 +1,7 @@
 from . import base
-from .common import debug_print, path_matches, EVENT_RENAME, EVENT_CHANGE
+from . import stats
+from .common import debug_print, DEBUG, FileEvent, KIND_RENAME, KIND_CHANGE
+from .budget import default_budget, Fallback
 import signal
 import sys
 import os
@@ -36,6 +38,13 @@ class Timer(base.Timer):
         timer.ref = False
         self._timer = timer
 
+    def restart(self, interval):
+        timer = self._timer
+        if timer is None:
+            return super().restart(interval)
+        timer.stop()
+        timer.start(self.on_timeout, interval, 0 if self._once else interval)
+
     def on_timeout(self, timer):
         self._callback()
         """
@@ -53,7 +62,7 @@ class Timer(base.Timer):
             timer.close()
 
 class SingleShotTimer(Timer):
-    def start(self, timeout, callback):
+    def start(self, timeout, callback, once = True):
         super().start(timeout, callback, True)
 
 class FileSystemWatch(base.FileSystemWatch):
@@ -61,10 +70,15 @@ class FileSystemWatch(base.FileSystemWatch):
     def __init__(self, loop):
         super().__init__()
         self._loop = loop
+        self._handles = []
+        self._budget = None
+        self._fallback = None
 
     def start(self, path, callback, include = None, exclude = None, recursive = False):
         super().start(path, callback, include, exclude, recursive)
         loop = pyuv.Loop.default_loop()
+        self._budget = self.budget or default_budget()
+        self._fallback = Fallback(self._loop, self)
 
         if glob.has_magic(path):
             paths = glob.glob(path)
@@ -76,36 +90,46 @@ class FileSystemWatch(base.FileSystemWatch):
         UV_FS_EVENT_RECURSIVE = 4
         flags = UV_FS_EVENT_RECURSIVE if recursive else 0
 
-        for path in paths:
-            handle = pyuv.fs.FSEvent(loop)
-            handle.start(path, flags, self.onChanged)
-            handle.ref = False
-            handles.append(handle)
-
+        inner = []
         if sys.platform != 'win32' and recursive:
-            inner = []
             for path in paths:
                 if os.path.isdir(path):
                     for root, dirs, files in os.walk(path):
                         for d in dirs:
                             inner.append(os.path.join(root, d))
-            for path in inner:
-                handle = pyuv.fs.FSEvent(loop)
-                handle.start(path, flags, self.onChanged)
-                handle.ref = False
-                handles.append(handle)
+
+        # one handle per directory, ones that don't fit into budget are polled
+        paths = paths + inner
+        taken = self._budget.take(len(paths))
+        for path in paths[:taken]:
+            handle = pyuv.fs.FSEvent(loop)
+            handle.start(path, flags, self.onChanged)
+            handle.ref = False
+            handles.append(handle)
+        if taken < len(paths):
+            self._fallback.add(paths[taken:])
 
         self._handles = handles
+
     def stop(self):
-        pass
+        for handle in self._handles:
+            handle.close()
+        if self._budget is not None:
+            self._budget.release(len(self._handles))
+        self._handles = []
+        if self._fallback is not None:
+            self._fallback.stop()
 
     def onChanged(self, handle, filename: str, events, error):
-        events_ = []
-
         if filename is None:
             return
 
-        debug_print('handle.path', handle.path, 'filename', filename)
+        stats_ = stats.current
+        if stats_ is not None:
+            stats_.incr('events_received')
+
+        if DEBUG:
+            debug_print('handle.path', handle.path, 'filename', filename)
 
         if os.path.isdir(handle.path):
             
@@ -116,10 +140,13 @@ class FileSystemWatch(base.FileSystemWatch):
             if os.path.isdir(path):
                 # workaround for platforms without recursive support
                 if sys.platform not in ['win32', 'darwin'] and self._recursive:
-                    if path_matches(path, None, self._exclude):
+                    if not self._matcher.excluded(path):
                         for handle in self._handles:
                             if handle.path == path:
                                 return
+                        if self._budget.take(1) == 0:
+                            self._fallback.add([path])
+                            return
                         flags = 0
                         loop = pyuv.Loop.default_loop()
                         new_handle = pyuv.fs.FSEvent(loop)
@@ -129,17 +156,18 @@ class FileSystemWatch(base.FileSystemWatch):
                         debug_print('install handle for {}'.format(path))
                 return
 
-            if not path_matches(path, self._include, self._exclude):
+            if not self._matcher.matches(path):
+                if stats_ is not None:
+                    stats_.incr('events_filtered')
                 return
         else:
             path = handle.path
 
+        kinds = 0
         if events & pyuv.fs.UV_RENAME:
-            events_.append(EVENT_RENAME)
-            
+            kinds |= KIND_RENAME
         if events & pyuv.fs.UV_CHANGE:
-            events_.append(EVENT_CHANGE)
-
-        for event in events_:
-            self._callback(path, event)
+            kinds |= KIND_CHANGE
+        if kinds != 0:
+            self._callback(path, FileEvent(path, kinds))
     
\ No newline at end of file
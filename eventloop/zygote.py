@@ -0,0 +1,111 @@
+"""
+Warm spare interpreters for Server: spare is started as `python [flags] zygote.py path0 module ...`,
+imports modules and waits for command (json line) on stdin, then runs script or module of command
+in the same interpreter as cold `python [flags] script args` would, so restart skips interpreter startup and imports.
+If some imported module file changed after import spare execs command in cold interpreter instead.
+
+Runs standalone (by path, stdlib only) so it works with whatever python command uses.
+"""
+
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+# interpreter options without argument, passed to spare as is
+FLAGS = ['-u', '-B', '-O', '-OO', '-E', '-s', '-S', '-I']
+
+def split_cmd(cmd):
+    """
+    Splits python command into (interpreter with flags, rest) where rest is [script, args...] or ['-m', module, args...],
+    returns None if cmd is not python command or uses options spare can't reproduce (-c, -X, -W).
+    """
+    if len(cmd) < 2 or not os.path.basename(cmd[0]).lower().startswith('python'):
+        return None
+    i = 1
+    while i < len(cmd) and cmd[i] in FLAGS:
+        i += 1
+    rest = cmd[i:]
+    if len(rest) == 0:
+        return None
+    if rest[0] == '-m':
+        if len(rest) < 2:
+            return None
+    elif rest[0].startswith('-'):
+        return None
+    return cmd[:i], rest
+
+def path0(rest, cwd = None):
+    """
+    sys.path[0] of cold interpreter: directory of script or cwd for -m.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    if rest[0] == '-m':
+        return cwd
+    return os.path.dirname(os.path.join(cwd, rest[0]))
+
+def spare_cmd(interpreter, path0, preload):
+    return interpreter + [os.path.abspath(__file__), path0] + list(preload)
+
+def request(cmd):
+    return (json.dumps(cmd) + '\n').encode('utf-8')
+
+def _stale(since):
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if not path:
+            continue
+        try:
+            if os.stat(path).st_mtime > since:
+                return True
+        except OSError:
+            pass
+    return False
+
+def _cold(cmd):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if sys.platform == 'win32':
+        # exec on Windows starts new process and exits, keep this one as parent
+        sys.exit(subprocess.call(cmd))
+    os.execvp(cmd[0], cmd)
+
+def main():
+    # zygote directory is not on path of cold interpreter
+    sys.path[0] = sys.argv[1]
+    started = time.time()
+    for name in sys.argv[2:]:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print("zygote: failed to import {}: {}".format(name, e), file=sys.stderr, flush=True)
+
+    line = sys.stdin.buffer.readline()
+    if not line:
+        # server is gone
+        return
+    cmd = json.loads(line.decode('utf-8'))
+    # stdin was used for command, server reads nothing
+    fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(fd, 0)
+    os.close(fd)
+
+    split = split_cmd(cmd)
+    if split is None or _stale(started):
+        _cold(cmd)
+        return
+    interpreter, rest = split
+    import runpy
+    if rest[0] == '-m':
+        sys.argv = rest[1:]
+        runpy.run_module(rest[1], run_name='__main__', alter_sys=True)
+    else:
+        sys.argv = rest
+        sys.path[0] = os.path.dirname(os.path.abspath(rest[0]))
+        runpy.run_path(rest[0], run_name='__main__')
+
+if __name__ == "__main__":
+    main()
@@ -88,15 +88,21 @@ async def main():
         'USE_PYQT5':'1',
     }
 
+    env_inotify = {
+        'DEBUG_EVENTLOOP':DEBUG_EVENTLOOP,
+        'USE_INOTIFY':'1',
+    }
+
     quiet = False
 
     has_pyuv = sys.modules.get('pyuv') is not None
     has_PySide2 = sys.modules.get('PySide2') is not None
     has_PyQt5 = sys.modules.get('PyQt5') is not None
     has_qasync = sys.modules.get('qasync') is not None
+    has_inotify = sys.platform.startswith('linux')
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('names', nargs='+', choices=['pyuv','qt5','pyside2','qt5a','pyside2a','all'])
+    parser.add_argument('names', nargs='+', choices=['pyuv','qt5','pyside2','qt5a','pyside2a','inotify','all'])
     args = parser.parse_args()
     #print(args); exit(0)
     names = args.names
@@ -106,6 +112,7 @@ async def main():
     do_PySide2_qasync = has_PySide2 and has_qasync and ('all' in names or 'pyside2a' in names)
     do_PyQt5 = has_PyQt5 and ('all' in names or 'qt5' in names)
     do_PyQt5_qasync = has_PyQt5 and has_qasync and ('all' in names or 'qt5a' in names)
+    do_inotify = has_inotify and ('all' in names or 'inotify' in names)
 
     coros = []
     if do_pyuv:
@@ -118,6 +125,8 @@ async def main():
         coros.append(run_test('env_pyqt5', env_pyqt5, quiet))
     if do_PyQt5_qasync:
         coros.append(run_test('env_pyqt5_qasync', env_pyqt5_qasync, quiet))
+    if do_inotify:
+        coros.append(run_test('env_inotify', env_inotify, quiet))
     
     print("{} envs to test".format(len(coros)))
     await asyncio.gather(*coros)